@@ -1,15 +1,100 @@
+import hashlib
+from functools import partial
+
+from django.conf import settings
 from django.contrib import admin
-from django.db.models import F
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FullResultSet
+from django.template.response import TemplateResponse
+from django.utils import timezone
 
-from .models import Comment, Post
+from .cache import (
+    admin_facets_version,
+    invalidate_admin_facets,
+    invalidate_sidebar,
+    post_detail_pages,
+    touch_pages,
+)
+from .checks import shared_cache
+from .middleware import timing_summary
+from .models import Comment, OutgoingEmail, Post
+from .paginators import EstimatedCountPaginator
 
 # admin.site.register(Post)
 
 
+class CachedFacetsMixin:
+    """
+    List filter caching its facet counts ("(123)" next to each option). Each filter counts its options with one
+    aggregate query over the rows matching the other filters, on every load of the changelist.
+
+    The counts are cached for settings.BLOG_ADMIN_FACETS_CACHE_TIMEOUT seconds, keyed by the SQL of the
+    aggregate (the other filters, the search, the options of the filter) and versioned per model: saving or
+    deleting a post or a comment makes the counts of its model stale (see signals.py and the bulk changes)
+    """
+
+    def get_facet_queryset(self, changelist):
+        count = partial(super().get_facet_queryset, changelist)
+        if not settings.BLOG_ADMIN_FACETS_CACHE_TIMEOUT:
+            return count()
+        # The queryset and the aggregates counted by super().get_facet_queryset()
+        filtered_qs = changelist.get_queryset(
+            self.request, exclude_parameters=self.expected_parameters()
+        )
+        counts = self.get_facet_counts(changelist.pk_attname, filtered_qs)
+        try:
+            sql, params = filtered_qs.query.sql_with_params()
+        except (EmptyResultSet, FullResultSet):
+            return count()
+        # NOTE: the options of date filters ("Today", "Past 7 days"...) are parameters too, so the counts of
+        # yesterday aren't used today
+        digest = hashlib.md5(repr((sql, params, sorted(counts.items()))).encode()).hexdigest()
+        return cache.get_or_set(
+            f"blog:admin_facets:{changelist.model._meta.label_lower}:{digest}",
+            count,
+            timeout=settings.BLOG_ADMIN_FACETS_CACHE_TIMEOUT,
+            version=admin_facets_version(changelist.model),
+        )
+
+
+class CachedBooleanFilter(CachedFacetsMixin, admin.BooleanFieldListFilter):
+    pass
+
+
+class CachedChoicesFilter(CachedFacetsMixin, admin.ChoicesFieldListFilter):
+    pass
+
+
+class CachedDateFilter(CachedFacetsMixin, admin.DateFieldListFilter):
+    pass
+
+
+class CachedRelatedFilter(CachedFacetsMixin, admin.RelatedFieldListFilter):
+    pass
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    ModelAdmin for tables with millions of rows: an estimated row count instead of the COUNT(*) of the
+    paginator, and no second COUNT(*) of the whole table for "X of Y selected". Their list filters should cache
+    their facet counts (see CachedFacetsMixin)
+    """
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(LargeTableAdmin):
     list_display = ["title", "slug", "author", "publish", "status"]
-    list_filter = ["status", "created", "publish", "author"]
+    # Fetch the authors of the page in the same query (a JOIN), instead of one query per post
+    list_select_related = ["author"]
+    list_filter = [
+        ("status", CachedChoicesFilter),
+        ("created", CachedDateFilter),
+        ("publish", CachedDateFilter),
+        ("author", CachedRelatedFilter),
+    ]
     search_fields = ["title", "body"]
     prepopulated_fields = {"slug": ("title",)}
     # Allows to search for user name when creating a post, instead of having a dropdown
@@ -22,21 +107,73 @@ class PostAdmin(admin.ModelAdmin):
 
 
 @admin.register(Comment)
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(LargeTableAdmin):
     list_display = ["name", "email", "post", "created", "active"]
-    list_filter = ["active", "created", "updated"]  # last day, last month...
+    list_select_related = ["post"]
+    # last day, last month...
+    list_filter = [
+        ("active", CachedBooleanFilter),
+        ("created", CachedDateFilter),
+        ("updated", CachedDateFilter),
+    ]
     search_fields = ["name", "email", "body"]
     # You can define action as a normal function and add it here too
     actions = ["deactivate_comments", "toggle_activate"]
 
     def deactivate_comments(self, request, queryset):
         """Takes queryset of comments and deactivates them"""
-        queryset.update(active=False)
+        # Like queryset.update(active=False), also updating Post.comment_count
+        queryset.deactivate()
+        self.comments_changed(queryset)
 
     deactivate_comments.short_description = "Deactivate selected comments"
 
     def toggle_activate(self, request, queryset):
-        # NOTE: "F" expressions allow to reference a model field to make operations without having to fetch them in Python first
-        queryset.update(active=~F("active"))
+        # Like queryset.update(active=~F("active")), also updating Post.comment_count
+        queryset.toggle_active()
+        self.comments_changed(queryset)
 
     toggle_activate.short_description = "Toggle activate in selected comments"
+
+    def comments_changed(self, queryset):
+        """Make the caches showing the comments stale after a bulk change (which doesn't send the signals)"""
+        invalidate_sidebar()
+        invalidate_admin_facets(Comment)
+        touch_pages(
+            *(
+                post_detail_pages(post)
+                for post in Post.objects.filter(comments__in=queryset).distinct()
+            )
+        )
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ["subject", "status", "attempts", "next_attempt", "created", "sent"]
+    list_filter = ["status", "created"]
+    search_fields = ["subject", "recipients"]
+    readonly_fields = ["attempts", "last_error", "created", "sent"]
+    actions = ["retry_now"]
+
+    def retry_now(self, request, queryset):
+        """Send the selected unsent emails (including failed ones) in the next run of ./manage.py sendemails"""
+        queryset.exclude(status=OutgoingEmail.Status.SENT).update(
+            status=OutgoingEmail.Status.PENDING, attempts=0, next_attempt=timezone.now()
+        )
+
+    retry_now.short_description = "Retry selected emails now"
+
+
+@admin.site.admin_view
+def request_timings(request):
+    """
+    The summary of ./manage.py timings as an admin page (/admin/timings/). Served by a server process, it shows
+    the samples of that process when the cache isn't shared (see CACHES in settings.py)
+    """
+    context = {
+        **admin.site.each_context(request),
+        "title": "Request timings",
+        "summary": timing_summary(),
+        "shared_cache": shared_cache(),
+    }
+    return TemplateResponse(request, "admin/blog/timings.html", context)
@@ -0,0 +1,179 @@
+"""
+Async versions of the public read-only views (post_list, post_detail, post_search, the feed and the sitemap),
+used instead of views.py and sitemaps.py when settings.BLOG_ASYNC_VIEWS is enabled (see urls.py).
+
+They use the async ORM (aget, acount, async for...) and must not touch the database synchronously: querysets
+are evaluated before rendering and the sidebar is loaded with sidebar.asidebar() (the template tags use it).
+
+NOTE: the async ORM still runs every query through sync_to_async(thread_sensitive=True), that is, in a single
+thread with its own connection. asyncio.gather() overlaps the Python work and cache lookups, but the queries of
+a request are serialized on that connection. What async views buy is serving many slow/idle clients with few
+threads under an ASGI server, not faster queries.
+"""
+
+import asyncio
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.http.request import HttpRequest
+from django.shortcuts import aget_object_or_404, render
+from taggit.models import Tag
+
+from .cache import LIST_PAGES, SIDEBAR_PAGES, SITEMAP_PAGES, post_pages, public_page, tag_pages
+from .feeds import build_feed_snapshot, feed_key, feed_response
+from .forms import CommentForm, SearchForm
+from .models import Post
+from .paginators import KeysetPaginator, aget_page
+from .sidebar import asidebar
+from .sitemaps import (
+    CHUNK_SIZE,
+    URLSET_END,
+    URLSET_START,
+    _before_key,
+    _from_key,
+    _site_url,
+    _sitemapindex,
+    _url_entries,
+    shard_starts,
+)
+
+
+@public_page(
+    lambda request, tag_slug=None: [tag_pages(tag_slug) if tag_slug else LIST_PAGES, SIDEBAR_PAGES]
+)
+async def post_list(request: HttpRequest, tag_slug=None):
+    post_list = Post.published.select_related("author").prefetch_related("tags")
+    tag = None
+
+    if tag_slug:
+        tag = await aget_object_or_404(Tag, slug=tag_slug)
+        post_list = post_list.filter(tags__in=[tag])
+
+    if settings.BLOG_KEYSET_PAGINATION:
+        paginator = KeysetPaginator(post_list, settings.BLOG_POSTS_PER_PAGE)
+        posts, sidebar = await asyncio.gather(
+            paginator.apage(after=request.GET.get("after"), before=request.GET.get("before")),
+            asidebar(),
+        )
+    else:
+        paginator = Paginator(post_list, settings.BLOG_POSTS_PER_PAGE)
+        # get_page() falls back to the first/last page like the PageNotAnInteger/EmptyPage handling of views.py
+        posts, sidebar = await asyncio.gather(
+            aget_page(paginator, request.GET.get("page", 1)), asidebar()
+        )
+
+    return render(request, "blog/post/list.html", {"posts": posts, "tag": tag, "sidebar": sidebar})
+
+
+@public_page(lambda request, **kwargs: [post_pages(**kwargs), SIDEBAR_PAGES])
+async def post_detail(request: HttpRequest, year: int, month: int, day: int, slug: str):
+    try:
+        posts = Post.published.on_date(year, month, day)
+    except (ValueError, OverflowError):
+        raise Http404("Invalid date")
+    post = await aget_object_or_404(posts.select_related("author"), slug=slug)
+
+    # The comments, similar posts and sidebar only depend on the post: fetched concurrently
+    comments = post.comments.filter(active=True)
+    similar_posts = (
+        Post.published.filter(similar_in__post=post)
+        .order_by("similar_in__rank")
+        .only("title", "slug", "publish")[: settings.BLOG_SIMILAR_POSTS]
+    )
+    comments, similar_posts, sidebar = await asyncio.gather(
+        _alist(comments), _alist(similar_posts), asidebar()
+    )
+    return render(
+        request,
+        "blog/post/detail.html",
+        {
+            "post": post,
+            "comments": comments,
+            "form": CommentForm(),
+            "similar_posts": similar_posts,
+            "sidebar": sidebar,
+        },
+    )
+
+
+async def post_search(request: HttpRequest):
+    form = SearchForm()
+    query = None
+    results = Post.published.none()
+
+    if "query" in request.GET:
+        form = SearchForm(request.GET)
+        if form.is_valid():
+            query = form.cleaned_data["query"]
+
+            if form.cleaned_data["trigram"]:
+                # NOTE: trigram_search() fetches the posts with sync queries (in a transaction, see models.py)
+                results = await sync_to_async(Post.published.trigram_search)(query)
+            else:
+                results = Post.published.search(query)[: settings.BLOG_SEARCH_RESULTS_LIMIT]
+
+    paginator = Paginator(results, settings.BLOG_SEARCH_RESULTS_PER_PAGE)
+    results, sidebar = await asyncio.gather(
+        aget_page(paginator, request.GET.get("page")), asidebar()
+    )
+
+    return render(
+        request,
+        "blog/post/search.html",
+        {"form": form, "query": query, "results": results, "sidebar": sidebar},
+    )
+
+
+async def post_feed(request: HttpRequest, tag_slug: str | None = None):
+    # A cache read, the feed is only rendered (in a thread, it queries the database) if its snapshot is missing
+    snapshot = cache.get(feed_key(tag_slug)) or await sync_to_async(build_feed_snapshot)(tag_slug)
+    return feed_response(request, snapshot)
+
+
+async def ashard_starts() -> list[tuple]:
+    # NOTE: a loop of dependent keyset queries (cached afterwards): one sync_to_async call instead of one per query
+    return await sync_to_async(shard_starts)()
+
+
+@public_page(lambda request: [SITEMAP_PAGES])
+async def sitemap_index(request: HttpRequest):
+    site_url = await sync_to_async(_site_url)(request)
+    shards = len(await ashard_starts()) + 1
+    return HttpResponse(_sitemapindex(site_url, shards), content_type="application/xml")
+
+
+# NOTE: streamed, so not page-cached (store=False): clients that have the shard get a 304 from its ETag
+@public_page(lambda request, shard: [SITEMAP_PAGES], store=False)
+async def sitemap_shard(request: HttpRequest, shard: int):
+    starts = await ashard_starts()
+    if not 1 <= shard <= len(starts) + 1:
+        raise Http404("No such sitemap")
+
+    posts = Post.published.order_by("publish", "id")
+    if shard > 1:
+        posts = posts.filter(_from_key(*starts[shard - 2]))
+    if shard <= len(starts):
+        posts = posts.filter(_before_key(*starts[shard - 1]))
+    # NOTE: iterator() is a lazy generator, the query runs in the sync thread on the first chunk
+    rows = posts.values_list("slug", "publish", "updated").iterator(chunk_size=CHUNK_SIZE)
+    site_url = await sync_to_async(_site_url)(request)
+    # An async iterator: the ASGI handler streams it without a thread per response
+    return StreamingHttpResponse(_aurlset(rows, site_url), content_type="application/xml")
+
+
+async def _aurlset(rows, site_url: str):
+    """_urlset() reading the server-side cursor from the thread of the async ORM, a chunk per switch"""
+    # NOTE: values_list().aiterator() runs the query in the event loop thread (SynchronousOnlyOperation)
+    next_chunk = sync_to_async(lambda: list(islice(rows, CHUNK_SIZE)))
+    yield URLSET_START
+    while chunk := await next_chunk():
+        yield _url_entries(chunk, site_url)
+    yield URLSET_END
+
+
+async def _alist(queryset) -> list:
+    return [obj async for obj in queryset]
@@ -0,0 +1,498 @@
+"""
+Benchmark scenarios for ``./manage.py benchmark <scenario>``.
+
+Each scenario receives the command options and returns a dict of ``{label: timings}``
+where timings are produced by ``measure()`` (milliseconds), or ``measure_request()``
+which adds the number of queries and requests/s of an endpoint, or ``throughput()`` for
+concurrent requests.
+"""
+
+import asyncio
+import importlib.util
+import statistics
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any
+from urllib.parse import urlencode
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.core.paginator import Paginator
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection, connections
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+from django.db.models import Count
+from django.template import Context, Template
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from taggit.models import Tag
+
+from .cache import post_html_key
+from .middleware import QueryStats, percentile
+from .models import Post
+from .paginators import KeysetPaginator
+from .urlbuilders import post_detail_url
+
+# Registry of available scenarios: {name: function(options)}
+SCENARIOS: dict[str, Callable[[dict[str, Any]], dict[str, dict[str, float]]]] = {}
+
+# Words that actually appear in the Faker-generated bodies of addposts ("the" is a stop word)
+DEFAULT_SEARCH_QUERIES = ["world", "culture language", "the"]
+
+
+def scenario(name: str):
+    """Register a benchmark function under a name (same idea as @register.simple_tag)"""
+
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+
+    return decorator
+
+
+def measure(func: Callable[[], Any], repeat: int = 5) -> dict[str, float]:
+    """Call func() `repeat` times and return min/median/max wall-clock time in ms"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": min(timings), "median_ms": statistics.median(timings), "max_ms": max(timings)}
+
+
+@scenario("search")
+def search(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """Per-query SearchVector (old post_search) vs. the stored, GIN-indexed Post.search_vector"""
+    results = {}
+    for query in options["queries"] or DEFAULT_SEARCH_QUERIES:
+        # Old implementation: every published row is tokenized and ranked on each request
+        search_vector = SearchVector("title", weight="A") + SearchVector("body", weight="B")
+        search_query = SearchQuery(query)
+        old = (
+            Post.published.annotate(rank=SearchRank(search_vector, search_query))
+            .filter(rank__gte=0.3)
+            .order_by("-rank")
+        )
+        # NOTE: all() returns a fresh clone so the queryset cache does not hide the query time
+        results[f"search {query!r} (per-query vector)"] = measure(
+            lambda old=old: list(old.all()), options["repeat"]
+        )
+        new = Post.published.search(query)
+        results[f"search {query!r} (stored vector)"] = measure(
+            lambda new=new: list(new.all()), options["repeat"]
+        )
+    return results
+
+
+@scenario("trigram")
+def trigram(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """TrigramSimilarity filter (old post_search) vs. the indexed "%" filter with KNN "<->" ordering"""
+    results = {}
+    for query in options["queries"] or DEFAULT_SEARCH_QUERIES:
+        old = (
+            Post.published.annotate(similarity=TrigramSimilarity("title", query))
+            .filter(similarity__gt=0.1)
+            .order_by("-similarity")
+        )
+        results[f"trigram {query!r} (similarity filter)"] = measure(
+            lambda old=old: list(old.all()), options["repeat"]
+        )
+        results[f"trigram {query!r} (trigram index)"] = measure(
+            lambda query=query: Post.published.trigram_search(query), options["repeat"]
+        )
+    return results
+
+
+def keyset_cursor(paginator: KeysetPaginator, page: int) -> str | None:
+    """Cursor of the last post of the previous page, as the "Next" link of that page would have it"""
+    if page <= 1:
+        return None
+    last = paginator.queryset.order_by(*paginator.ordering)[(page - 1) * paginator.per_page - 1]
+    return paginator.encode_cursor(last)
+
+
+@scenario("pagination")
+def pagination(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """First vs. deep page of post_list with Paginator (COUNT + OFFSET) and KeysetPaginator"""
+    per_page = 3
+    queryset = Post.published.all()
+    num_pages = Paginator(queryset, per_page).num_pages
+    deep_page = min(options["page"], num_pages)
+    results = {}
+
+    def offset_page(number):
+        # Same work as post_list: COUNT(*) for num_pages and the OFFSET query
+        page = Paginator(queryset, per_page).page(number)
+        return page.paginator.num_pages, list(page)
+
+    results["offset page 1"] = measure(lambda: offset_page(1), options["repeat"])
+    results[f"offset page {deep_page}"] = measure(lambda: offset_page(deep_page), options["repeat"])
+
+    paginator = KeysetPaginator(queryset, per_page)
+    cursor = keyset_cursor(paginator, deep_page)
+    results["keyset page 1"] = measure(lambda: list(paginator.page()), options["repeat"])
+    results[f"keyset page {deep_page}"] = measure(
+        lambda: list(paginator.page(after=cursor)), options["repeat"]
+    )
+    return results
+
+
+# Markdown with headers, lists, emphasis, links and code, repeated to build long bodies
+MARKDOWN_SECTION = """
+## Section title
+
+Some *emphasis*, some **strong text**, a [link](https://example.com) and `inline code`.
+
+* First item of the list
+* Second item with **bold**
+* Third item
+
+    code_block = "indented"
+
+> A quote that spans a couple of lines
+> to make the parser work a little bit.
+"""
+
+
+@scenario("markdown")
+def markdown_render(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """Post list body rendering: markdown + truncatewords_html on each render vs. the cached excerpt"""
+    now = timezone.now()
+    # Unsaved posts (no DB needed) with long bodies, as many as a page of post_list
+    posts = [
+        Post(pk=-i, title=f"Post {i}", body=MARKDOWN_SECTION * options["sections"], updated=now)
+        for i in range(1, 11)
+    ]
+    old = Template(
+        "{% load blog_tags %}{% for post in posts %}{{ post.body|markdown|truncatewords_html:30 }}{% endfor %}"
+    )
+    new = Template("{% for post in posts %}{{ post.excerpt_html }}{% endfor %}")
+
+    def render_new():
+        # Fresh instances: nothing memoized on them, the HTML comes from the cache
+        for post in posts:
+            post.__dict__.pop("excerpt_html", None)
+        return new.render(Context({"posts": posts}))
+
+    results = {}
+    results[f"{len(posts)} posts, markdown filter"] = measure(
+        lambda: old.render(Context({"posts": posts})), options["repeat"]
+    )
+    for post in posts:
+        cache.delete(post_html_key(post))
+    results[f"{len(posts)} posts, cached excerpt (cold)"] = measure(render_new, 1)
+    results[f"{len(posts)} posts, cached excerpt (warm)"] = measure(render_new, options["repeat"])
+    return results
+
+
+@scenario("urls")
+def urls(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """URL of 100k posts with reverse() (old get_absolute_url) vs. the precompiled URLBuilder"""
+    now = timezone.now()
+    # (year, month, day, slug) of unsaved posts, no DB needed
+    args = [(now.year, now.month, now.day, f"post-{i}") for i in range(100_000)]
+
+    results = {}
+    results[f"{len(args)} URLs, reverse()"] = measure(
+        lambda: [reverse("blog:post_detail", args=arg) for arg in args], options["repeat"]
+    )
+    results[f"{len(args)} URLs, URLBuilder"] = measure(
+        lambda: [post_detail_url(*arg) for arg in args], options["repeat"]
+    )
+    # Without looking up the URLconf and script prefix for every URL (as the sitemap does)
+    results[f"{len(args)} URLs, URLBuilder.formatter()"] = measure(
+        lambda: list(map(post_detail_url.formatter(), *zip(*args))), options["repeat"]
+    )
+    return results
+
+
+def measure_request(client: Client, url: str, repeat: int = 5) -> dict[str, float]:
+    """measure() a GET request, plus its number of queries and the requests/s of the median time"""
+
+    def get():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError(f"GET {url} returned {response.status_code}")
+        if response.streaming:
+            # NOTE: iterating the response (not streaming_content) also consumes the async iterators of async views
+            b"".join(response)
+
+    # Warm up the caches that are meant to be warm (e.g. the sidebar), then count the queries
+    get()
+    # NOTE: CaptureQueriesContext can't be used: the request_started signal resets connection.queries
+    stats = QueryStats()
+    with connection.execute_wrapper(stats):
+        get()
+    timings = measure(get, repeat)
+    timings["queries"] = stats.count
+    timings["requests_per_s"] = 1000 / timings["median_ms"]
+    return timings
+
+
+@scenario("endpoints")
+def endpoints(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """GET the public pages with the test client (in-process: no network or WSGI server in the timings)"""
+    post = Post.published.order_by("-publish").first()
+    if post is None:
+        raise CommandError("No published posts, generate some with --seed")
+    # Deep page of post_list, as numbered page or keyset cursor depending on the pagination in use
+    per_page = settings.BLOG_POSTS_PER_PAGE
+    deep_page = max(1, min(options["page"], Post.published.count() // per_page))
+    if settings.BLOG_KEYSET_PAGINATION:
+        cursor = keyset_cursor(KeysetPaginator(Post.published.all(), per_page), deep_page)
+        deep_query = urlencode({"after": cursor}) if cursor else ""
+    else:
+        deep_query = urlencode({"page": deep_page})
+    query = (options["queries"] or DEFAULT_SEARCH_QUERIES)[0]
+    search_url = reverse("blog:post_search")
+
+    urls = {
+        "post_list": reverse("blog:post_list"),
+        f"post_list page {deep_page}": f"{reverse('blog:post_list')}?{deep_query}",
+        "post_detail": post.get_absolute_url(),
+        f"post_search {query!r} (full-text)": f"{search_url}?{urlencode({'query': query})}",
+        f"post_search {query!r} (trigram)": f"{search_url}?{urlencode({'query': query, 'trigram': 'on'})}",
+        "post_feed": reverse("blog:post_feed"),
+        "sitemap": reverse("sitemap"),
+        "sitemap_shard 1": reverse("sitemap_shard", args=[1]),
+    }
+    tag = Tag.objects.annotate(posts=Count("taggit_taggeditem_items")).order_by("-posts").first()
+    if tag is not None:
+        urls[f"post_list_by_tag {tag.slug!r}"] = reverse("blog:post_list_by_tag", args=[tag.slug])
+        urls[f"post_feed_by_tag {tag.slug!r}"] = reverse("blog:post_feed_by_tag", args=[tag.slug])
+
+    results = {}
+    with endpoint_settings(options):
+        client = Client()
+        for label, url in urls.items():
+            results[label] = measure_request(client, url, options["repeat"])
+    return results
+
+
+def endpoint_settings(options: dict[str, Any]):
+    """Settings to GET the public pages with the test client"""
+    # NOTE: without the page cache every request would be a cache hit after the first one
+    page_cache_timeout = settings.BLOG_PAGE_CACHE_TIMEOUT if options["warm"] else 0
+    return override_settings(
+        ALLOWED_HOSTS=["testserver"],
+        BLOG_PAGE_CACHE_TIMEOUT=page_cache_timeout,
+        BLOG_TIMING_SAMPLE_RATE=0,
+    )
+
+
+def throughput(latencies: list[float], elapsed: float) -> dict[str, float]:
+    """Latency percentiles (ms) of concurrent requests and the requests/s of the whole run"""
+    return {
+        "min_ms": min(latencies),
+        "median_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 95),
+        "max_ms": max(latencies),
+        "requests_per_s": len(latencies) / elapsed,
+    }
+
+
+def wsgi_throughput(url: str, concurrency: int, requests: int) -> dict[str, float]:
+    """`requests` GETs of `url` from `concurrency` threads, like a threaded WSGI server (one thread per request)"""
+
+    def worker(count: int) -> list[float]:
+        client = Client()
+        latencies = []
+        try:
+            for _ in range(count):
+                start = time.perf_counter()
+                _check_response(url, client.get(url))
+                latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            # Each thread opened its own connection
+            connections.close_all()
+        return latencies
+
+    counts = [len(part) for part in _split(requests, concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [latency for part in executor.map(worker, counts) for latency in part]
+    return throughput(latencies, time.perf_counter() - start)
+
+
+def asgi_throughput(url: str, concurrency: int, requests: int) -> dict[str, float]:
+    """
+    `requests` GETs of `url` from `concurrency` tasks of a single event loop, like an ASGI server.
+    Sync views (and the async ORM) run in a thread of their own per request, as in django.core.handlers.asgi
+    """
+
+    async def get(client: AsyncClient, latencies: list[float]):
+        start = time.perf_counter()
+        async with ThreadSensitiveContext():
+            _check_response(url, await client.get(url))
+            # Connections of the thread of this request (CONN_MAX_AGE: closed or kept, as after a request)
+            await sync_to_async(close_old_connections)()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    async def worker(count: int, latencies: list[float]):
+        client = AsyncClient()
+        for _ in range(count):
+            await get(client, latencies)
+
+    async def run() -> list[float]:
+        latencies = []
+        await asyncio.gather(
+            *(worker(len(part), latencies) for part in _split(requests, concurrency))
+        )
+        return latencies
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run())
+    return throughput(latencies, time.perf_counter() - start)
+
+
+def _split(requests: int, concurrency: int) -> list[range]:
+    return [range(worker, requests, concurrency) for worker in range(min(concurrency, requests))]
+
+
+def _check_response(url: str, response):
+    # NOTE: the pages of the concurrency scenario aren't streamed
+    if response.status_code != 200:
+        raise CommandError(f"GET {url} returned {response.status_code}")
+
+
+@scenario("concurrency")
+def concurrency(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """
+    Throughput of post_list, post_detail and post_search under `--concurrency` simultaneous clients, served
+    the WSGI way (a thread per request) and the ASGI way (an event loop). Run it with BLOG_ASYNC_VIEWS=0 and
+    BLOG_ASYNC_VIEWS=1 (--json/--compare) to compare the sync and async views
+    """
+    post = Post.published.order_by("-publish").first()
+    if post is None:
+        raise CommandError("No published posts, generate some with --seed")
+    query = (options["queries"] or DEFAULT_SEARCH_QUERIES)[0]
+    urls = {
+        "post_list": reverse("blog:post_list"),
+        "post_detail": post.get_absolute_url(),
+        f"post_search {query!r}": f"{reverse('blog:post_search')}?{urlencode({'query': query})}",
+    }
+
+    results = {}
+    concurrency, requests = options["concurrency"], options["requests"]
+    views = "async views" if settings.BLOG_ASYNC_VIEWS else "sync views"
+    with endpoint_settings(options):
+        for label, url in urls.items():
+            # Warm up (sidebar cache, SITE_CACHE, URL builders...)
+            _check_response(url, Client().get(url))
+            results[f"WSGI {label}, {views}"] = wsgi_throughput(url, concurrency, requests)
+            results[f"ASGI {label}, {views}"] = asgi_throughput(url, concurrency, requests)
+    return results
+
+
+def connection_modes() -> dict[str, dict]:
+    """Settings of the default database for each way of managing connections (see DB_POOL in settings.py)"""
+    current = connections[DEFAULT_DB_ALIAS].settings_dict
+    options = {key: value for key, value in current["OPTIONS"].items() if key != "pool"}
+    modes = {
+        "new connection per request": {**current, "CONN_MAX_AGE": 0, "OPTIONS": options},
+        "persistent connection": {
+            **current,
+            "CONN_MAX_AGE": 600,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": options,
+        },
+    }
+    if is_psycopg3 and importlib.util.find_spec("psycopg_pool"):
+        # The configured pool if DB_POOL is on
+        pool = current["OPTIONS"].get("pool") or {"min_size": 1, "max_size": 4}
+        modes["psycopg 3 pool"] = {
+            **current,
+            "CONN_MAX_AGE": 0,
+            "OPTIONS": {**options, "pool": pool},
+        }
+    return modes
+
+
+@contextmanager
+def default_connection(settings_dict: dict):
+    """Make a connection with these settings the default connection of the current thread"""
+    # NOTE: connections are per thread (and async context): the connection of another thread isn't replaced
+    original = connections[DEFAULT_DB_ALIAS]
+    wrapper = original.__class__(settings_dict, DEFAULT_DB_ALIAS)
+    connections[DEFAULT_DB_ALIAS] = wrapper
+    try:
+        yield wrapper
+    finally:
+        wrapper.close()
+        connections[DEFAULT_DB_ALIAS] = original
+
+
+def served(func: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    `func` run like a request by a server: close_old_connections() before and after it, as on the
+    request_started and request_finished signals (the test client disconnects it from both)
+    """
+
+    def request():
+        close_old_connections()
+        try:
+            return func()
+        finally:
+            close_old_connections()
+
+    return request
+
+
+def select_one():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+
+@scenario("connections")
+def connection_setup(options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """
+    Cost of getting a database connection in each request: a new connection per request (CONN_MAX_AGE=0),
+    persistent connections (checked before the first query of each request) and a psycopg 3 pool (if psycopg 3
+    and psycopg_pool are installed). For SELECT 1 (the connection alone) and post_detail, with the requests of a
+    thread served one after the other (WSGI) or each request in a thread of its own (as sync code under ASGI)
+    """
+    post = Post.published.order_by("-publish").first()
+    if post is None:
+        raise CommandError("No published posts, generate some with --seed")
+    url = post.get_absolute_url()
+    repeat = options["repeat"]
+
+    def get():
+        _check_response(url, Client().get(url))
+
+    def in_new_thread(settings_dict: dict, func: Callable[[], Any]) -> Callable[[], Any]:
+        def run():
+            with default_connection(settings_dict):
+                served(func)()
+
+        # NOTE: a persistent connection of a request thread would stay open until the thread is garbage
+        # collected, here it's closed when the thread ends
+        def request():
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(run).result()
+
+        return request
+
+    results = {}
+    with endpoint_settings(options):
+        # Warm up (sidebar cache, SITE_CACHE, URL builders...)
+        get()
+        for mode, settings_dict in connection_modes().items():
+            with default_connection(settings_dict) as wrapper:
+                for label, func in (("SELECT 1", select_one), ("post_detail", get)):
+                    request = served(func)
+                    # Warm up (opens the pool, or the persistent connection)
+                    request()
+                    results[f"{label}, {mode}"] = measure(request, repeat)
+                    results[f"{label}, {mode}, thread per request"] = measure(
+                        in_new_thread(settings_dict, func), repeat
+                    )
+                if wrapper.pool is not None and not settings.DB_POOL:
+                    # Only opened for the benchmark
+                    wrapper.close_pool()
+    return results
@@ -0,0 +1,334 @@
+"""
+Cache helpers for data shared by many pages (e.g. the sidebar of blog/base.html).
+
+Sidebar values are stored under a "generation" number: invalidating bumps the generation so every
+variant of a key (e.g. latest_posts 3 and latest_posts 5) becomes stale at once. The facet counts of the admin
+changelists are versioned the same way, with a generation per model.
+Rendered post bodies are keyed by post id and `updated`, so editing a post never serves stale HTML.
+Public pages belong to "page groups" (the post list, a tag, a post, the sidebar...) with a last-modified
+timestamp that is used for ETag/Last-Modified and as the version of the cached pages of the group.
+"""
+
+import hashlib
+import re
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.template.defaultfilters import truncatewords_html
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+from markdown import markdown
+
+from .routers import pin_recent_changes
+
+SIDEBAR_VERSION_KEY = "blog:sidebar:version"
+ADMIN_FACETS_VERSION_KEY = "blog:admin_facets:{}:version"
+# The hidden input of {% csrf_token %}, its value is the token of each visitor
+CSRF_TOKEN_RE = re.compile(rb'(<input type="hidden" name="csrfmiddlewaretoken" value=")[^"]*(">)')
+BLANK_CSRF_TOKEN = b'<input type="hidden" name="csrfmiddlewaretoken" value="">'
+
+
+def sidebar_version() -> int:
+    return cache.get_or_set(SIDEBAR_VERSION_KEY, 1, timeout=None)
+
+
+async def asidebar_version() -> int:
+    return await cache.aget_or_set(SIDEBAR_VERSION_KEY, 1, timeout=None)
+
+
+def invalidate_sidebar():
+    """
+    Make all the cached sidebar values stale, and the pages showing the sidebar.
+    Called when a post or a comment changes
+    """
+    _bump_version(SIDEBAR_VERSION_KEY)
+    touch_pages(SIDEBAR_PAGES)
+
+
+def admin_facets_version(model) -> int:
+    return cache.get_or_set(
+        ADMIN_FACETS_VERSION_KEY.format(model._meta.label_lower), 1, timeout=None
+    )
+
+
+def invalidate_admin_facets(*models):
+    """Make the cached facet counts of the admin changelists of these models stale (see admin.py)"""
+    for model in models:
+        _bump_version(ADMIN_FACETS_VERSION_KEY.format(model._meta.label_lower))
+
+
+def _bump_version(key: str):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key is missing (e.g. evicted): anything cached under the old version is unreachable anyway
+        cache.add(key, 1, timeout=None)
+
+
+def cached_sidebar(func):
+    """
+    Cache the result of a sidebar function for settings.BLOG_SIDEBAR_CACHE_TIMEOUT seconds.
+    Async functions (used by the async views) are cached under their own name, e.g. "atotal_posts", with the
+    async cache API
+    """
+
+    def make_key(args, kwargs) -> str:
+        return ":".join(
+            [
+                "blog:sidebar",
+                func.__name__,
+                *map(str, args),
+                *(f"{k}={v}" for k, v in sorted(kwargs.items())),
+            ]
+        )
+
+    if iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not settings.BLOG_SIDEBAR_CACHE_TIMEOUT:
+                return await func(*args, **kwargs)
+            key, version = make_key(args, kwargs), await asidebar_version()
+            value = await cache.aget(key, version=version)
+            if value is None:
+                value = await func(*args, **kwargs)
+                await cache.aset(
+                    key, value, timeout=settings.BLOG_SIDEBAR_CACHE_TIMEOUT, version=version
+                )
+            return value
+
+        return async_wrapper
+
+    @wraps(func)  # NOTE: the template tag library reads the signature of the wrapped function
+    def wrapper(*args, **kwargs):
+        if not settings.BLOG_SIDEBAR_CACHE_TIMEOUT:
+            return func(*args, **kwargs)
+        return cache.get_or_set(
+            make_key(args, kwargs),
+            lambda: func(*args, **kwargs),
+            timeout=settings.BLOG_SIDEBAR_CACHE_TIMEOUT,
+            version=sidebar_version(),
+        )
+
+    return wrapper
+
+
+# Words of the excerpt shown in post lists and feeds
+EXCERPT_WORDS = 30
+
+
+def post_html_key(post) -> str:
+    return f"blog:post_html:{post.pk}:{post.updated.timestamp()}"
+
+
+def render_post_html(post) -> tuple[str, str]:
+    """Render the Markdown body of a post, returns (body HTML, excerpt HTML) and caches them"""
+    body = markdown(post.body)
+    html = (body, truncatewords_html(body, EXCERPT_WORDS))
+    cache.set(post_html_key(post), html, timeout=settings.BLOG_POST_HTML_CACHE_TIMEOUT)
+    return html
+
+
+def get_post_html(post) -> tuple[str, str]:
+    """(body HTML, excerpt HTML) of a post, only rendered if they aren't cached for its current version"""
+    html = cache.get(post_html_key(post))
+    if html is None:
+        html = render_post_html(post)
+    # NOTE: by default Django escapes all variables in templates, so we need to mark them as safe
+    return mark_safe(html[0]), mark_safe(html[1])
+
+
+# Page groups: the pages rendered from the same data
+LIST_PAGES = "list"
+SITEMAP_PAGES = "sitemap"
+# Every page extending blog/base.html
+SIDEBAR_PAGES = "sidebar"
+
+
+def tag_pages(tag_slug: str) -> str:
+    return f"tag:{tag_slug}"
+
+
+def post_pages(year: int, month: int, day: int, slug: str) -> str:
+    # Built from the URL arguments of post_detail, so the view doesn't need to fetch the post
+    return f"post:{year}/{month}/{day}/{slug}"
+
+
+def pages_key(group: str) -> str:
+    return f"blog:pages:{group}"
+
+
+def touch_pages(*groups: str, when=None):
+    """Mark page groups as modified at `when` (default now): their cached pages become stale"""
+    timestamp = (when or timezone.now()).timestamp()
+    cache.set_many({pages_key(group): timestamp for group in groups}, timeout=None)
+
+
+def post_detail_pages(post) -> str:
+    return post_pages(post.publish.year, post.publish.month, post.publish.day, post.slug)
+
+
+def touch_post_pages(post, when=None):
+    """Touch all the pages showing a post: its detail page, the post lists, its tags and the sitemap"""
+    groups = {post_detail_pages(post), LIST_PAGES, SITEMAP_PAGES}
+    groups.update(tag_pages(slug) for slug in post.tags.values_list("slug", flat=True))
+    touch_pages(*groups, when=when)
+
+
+def pages_last_modified(groups: list[str]) -> float:
+    """Last modification timestamp of the given page groups (never touched groups count as modified now)"""
+    return _pages_timestamp(groups)[0]
+
+
+def _pages_timestamp(groups: list[str]) -> tuple[float, list[str]]:
+    """(last modification timestamp of the page groups, the groups without a timestamp)"""
+    return _last_modified(groups, cache.get_many([pages_key(group) for group in groups]))
+
+
+async def _apages_timestamp(groups: list[str]) -> tuple[float, list[str]]:
+    return _last_modified(groups, await cache.aget_many([pages_key(group) for group in groups]))
+
+
+def _last_modified(groups: list[str], timestamps: dict) -> tuple[float, list[str]]:
+    missing = [group for group in groups if pages_key(group) not in timestamps]
+    if missing:
+        return timezone.now().timestamp(), missing
+    return max(timestamps.values()), missing
+
+
+def remember_pages(groups: list[str], timestamp: float):
+    """
+    Store the timestamp of page groups that were never touched, once a view served one of their pages.
+    NOTE: never before: any URL can be requested, a timestamp for each 404 would let clients fill the cache
+    """
+    for group in groups:
+        # add() doesn't overwrite a timestamp written concurrently by touch_pages()
+        cache.add(pages_key(group), timestamp, timeout=None)
+
+
+async def aremember_pages(groups: list[str], timestamp: float):
+    for group in groups:
+        await cache.aadd(pages_key(group), timestamp, timeout=None)
+
+
+def public_page(groups, store: bool = True):
+    """
+    Conditional GET and page cache for a read-only view. `groups(request, *args, **kwargs)` returns the page
+    groups its output depends on. While none of them is touched (see signals.py):
+    * clients sending If-None-Match/If-Modified-Since get a 304 without running the view
+    * with `store` the response is kept in the cache for settings.BLOG_PAGE_CACHE_TIMEOUT seconds (streaming
+      responses never are: buffering them would hold the whole content in memory, which streaming avoids)
+    NOTE: pages with forms are cached without their CSRF token, the token of each visitor is filled in when
+    the page is served from the cache (see blank_csrf_token())
+    Works with sync and async views (the async wrapper uses the async cache API)
+    """
+
+    def before_view(request, last_modified):
+        """(304 response without running the view or None, etag, page cache key or None)"""
+        # A replica may not have the latest changes yet: rendered from the primary (see routers.py)
+        pin_recent_changes(last_modified)
+        path_hash = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        etag = quote_etag(f"{path_hash}-{last_modified}")
+        # 304 Not Modified (or None if the client copy is outdated)
+        response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+        # The key changes with the last modification: touching a group makes its cached pages unreachable
+        key = f"blog:page:{path_hash}:{last_modified}"
+        if not (store and settings.BLOG_PAGE_CACHE_TIMEOUT > 0):
+            key = None
+        return response, etag, key
+
+    def cached_page(response, request):
+        if response is not None:
+            fill_csrf_token(response, request)
+        return response
+
+    def cacheable(response, key) -> bool:
+        if hasattr(response, "render") and not response.is_rendered:
+            response.render()  # TemplateResponse (e.g. the sitemap) must be rendered to be cached
+        return bool(
+            key and response.status_code == 200 and not response.cookies and not response.streaming
+        )
+
+    def add_headers(response, etag, last_modified):
+        if response.status_code == 200:
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method not in ("GET", "HEAD"):
+                    return await view(request, *args, **kwargs)
+                last_modified, missing = await _apages_timestamp(groups(request, *args, **kwargs))
+                response, etag, key = before_view(request, last_modified)
+                if response is None and key:
+                    response = cached_page(await cache.aget(key), request)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                    if missing and response.status_code == 200:
+                        await aremember_pages(missing, last_modified)
+                    if cacheable(response, key):
+                        with csrf_token_blanked(response):
+                            await cache.aset(
+                                key, response, timeout=settings.BLOG_PAGE_CACHE_TIMEOUT
+                            )
+                return add_headers(response, etag, last_modified)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+            last_modified, missing = _pages_timestamp(groups(request, *args, **kwargs))
+            response, etag, key = before_view(request, last_modified)
+            if response is None and key:
+                response = cached_page(cache.get(key), request)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if missing and response.status_code == 200:
+                    remember_pages(missing, last_modified)
+                if cacheable(response, key):
+                    with csrf_token_blanked(response):
+                        cache.set(key, response, timeout=settings.BLOG_PAGE_CACHE_TIMEOUT)
+            return add_headers(response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
+
+
+def blank_csrf_token(content: bytes) -> bytes:
+    """The content with the CSRF token of its forms removed: the same for every visitor (cache, static export)"""
+    return CSRF_TOKEN_RE.sub(rb"\1\2", content)
+
+
+@contextmanager
+def csrf_token_blanked(response):
+    """The response without the CSRF token of its forms (see blank_csrf_token()) inside the block"""
+    content = response.content
+    response.content = blank_csrf_token(content)
+    try:
+        # NOTE: LocMemCache and the other backends pickle the response when it's set
+        yield response
+    finally:
+        response.content = content
+
+
+def fill_csrf_token(response, request):
+    """Put the CSRF token of the visitor in the forms of a page cached with blank_csrf_token()"""
+    if not response.streaming and BLANK_CSRF_TOKEN in response.content:
+        # NOTE: get_token() makes CsrfViewMiddleware set the CSRF cookie the token belongs to
+        token = get_token(request).encode()
+        response.content = response.content.replace(
+            BLANK_CSRF_TOKEN, BLANK_CSRF_TOKEN.replace(b'value=""', b'value="%s"' % token)
+        )
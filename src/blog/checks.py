@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PER_PROCESS_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def shared_cache() -> bool:
+    """Whether the default cache is seen by every process (server workers and management commands)"""
+    return settings.CACHES["default"]["BACKEND"] not in PER_PROCESS_CACHES
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    # Page group timestamps, cache generations, queued comments... live in the cache (see CACHES in settings.py)
+    if shared_cache():
+        return []
+    return [
+        Warning(
+            "The default cache is per process: invalidations, queued comments and request timings don't "
+            "reach the other processes (server workers, management commands).",
+            hint="Set CACHE_REDIS_URL to use a shared cache.",
+            id="blog.W001",
+        )
+    ]
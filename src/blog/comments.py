@@ -0,0 +1,164 @@
+"""
+Comment write path: rate limiting, duplicate submissions and buffered ingestion (settings.BLOG_BUFFERED_COMMENTS).
+
+Saving a comment runs an INSERT, an UPDATE of Post.comment_count (a lock on the post row, contended when many
+people comment the same post), and invalidates the sidebar and the page of the post (see signals.py), so that
+every reader misses the cache afterwards. In buffered mode post_comment only validates the form and appends
+the comment to a queue in the cache; ``./manage.py flushcomments`` inserts the queued comments with bulk_create,
+updates each comment_count once and invalidates the caches once per batch.
+
+The queue is a sequence of cache keys: enqueue_comment() takes the next number with cache.incr() and the worker
+reads the keys from the last flushed one onwards.
+NOTE: the web processes and the worker must share the cache (Redis, Memcached, database cache). LocMemCache only
+works within a process (e.g. the tests). Queued comments are in the cache only: they may be lost if it's evicted
+"""
+
+import hashlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import invalidate_admin_facets, invalidate_sidebar, post_detail_pages, touch_pages
+from .models import Comment, Post, adjust_comment_counts
+
+QUEUE_TAIL_KEY = "blog:comments:tail"  # number of the last queued comment
+QUEUE_HEAD_KEY = "blog:comments:head"  # number of the next comment to flush
+FLUSH_LOCK_KEY = "blog:comments:flush_lock"
+# Seconds after which a missing queue entry followed by newer ones is considered lost (evicted)
+QUEUE_GAP_TIMEOUT = 10
+# Seconds a post looked up by the buffered post_comment is cached
+POST_LOOKUP_TIMEOUT = 60
+
+
+def client_ip(request) -> str:
+    # NOTE: behind a reverse proxy REMOTE_ADDR is the proxy, configure it to set the real client address
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def rate_limited(request, post_id: int) -> bool:
+    """
+    Count a comment of the client on a post. True once it sent more than settings.BLOG_COMMENT_RATE_LIMIT
+    comments in the current window of settings.BLOG_COMMENT_RATE_WINDOW seconds
+    """
+    if not settings.BLOG_COMMENT_RATE_LIMIT:
+        return False
+    window = settings.BLOG_COMMENT_RATE_WINDOW
+    # Fixed windows: the key changes every `window` seconds and expires with it
+    key = f"blog:comments:rate:{client_ip(request)}:{post_id}:{int(timezone.now().timestamp()) // window}"
+    cache.add(key, 0, timeout=window)
+    try:
+        return cache.incr(key) > settings.BLOG_COMMENT_RATE_LIMIT
+    except ValueError:  # expired between add() and incr()
+        return False
+
+
+def is_duplicate(post_id: int, data: dict) -> bool:
+    """True if the same comment was already submitted in the last settings.BLOG_COMMENT_DUPLICATE_TIMEOUT seconds"""
+    # Whitespace and case changes don't make a different comment
+    content = "\0".join(
+        [str(post_id), data["name"], data["email"].lower(), " ".join(data["body"].split()).lower()]
+    )
+    key = f"blog:comments:hash:{hashlib.sha256(content.encode()).hexdigest()}"
+    # NOTE: add() is atomic, of 2 simultaneous submissions (e.g. a double click) only 1 is accepted
+    return not cache.add(key, 1, timeout=settings.BLOG_COMMENT_DUPLICATE_TIMEOUT)
+
+
+def published_post(post_id: int) -> Post | None:
+    """The fields of a published post needed by post_comment, cached so that bursts of comments don't query it"""
+    key = f"blog:comments:post:{post_id}"
+    post = cache.get(key)
+    if post is None:
+        # False: not found (cached too)
+        post = Post.published.filter(pk=post_id).only("title", "slug", "publish").first() or False
+        cache.set(key, post, timeout=POST_LOOKUP_TIMEOUT)
+    return post or None
+
+
+def enqueue_comment(post_id: int, data: dict):
+    """Queue a validated comment (the cleaned_data of a CommentForm)"""
+    cache.add(QUEUE_TAIL_KEY, 0, timeout=None)
+    number = cache.incr(QUEUE_TAIL_KEY)
+    cache.set(
+        queue_key(number),
+        {
+            "post_id": post_id,
+            "name": data["name"],
+            "email": data["email"],
+            "body": data["body"],
+            "queued": timezone.now().timestamp(),
+        },
+        timeout=None,
+    )
+
+
+def queue_key(number: int) -> str:
+    return f"blog:comments:queue:{number}"
+
+
+def queued_comments() -> int:
+    return cache.get(QUEUE_TAIL_KEY, 0) - cache.get(QUEUE_HEAD_KEY, 1) + 1
+
+
+def flush_comments(batch_size: int) -> int | None:
+    """
+    Save up to `batch_size` queued comments. Returns the number of comments processed (saved or dropped
+    because their post is no longer published), None if another worker is flushing
+    """
+    if not cache.add(FLUSH_LOCK_KEY, 1, timeout=60):
+        return None
+    try:
+        head = cache.get(QUEUE_HEAD_KEY, 1)
+        tail = cache.get(QUEUE_TAIL_KEY, 0)
+        numbers = range(head, min(tail, head + batch_size - 1) + 1)
+        entries = cache.get_many([queue_key(number) for number in numbers])
+
+        # A missing entry is being written by enqueue_comment() right now or was evicted from the cache.
+        # It's skipped (lost) only if some newer entry was queued more than QUEUE_GAP_TIMEOUT seconds ago
+        cutoff = timezone.now().timestamp() - QUEUE_GAP_TIMEOUT
+        old_entry_after = {}
+        seen_old = False
+        for number in reversed(numbers):
+            old_entry_after[number] = seen_old
+            entry = entries.get(queue_key(number))
+            seen_old = seen_old or (entry is not None and entry["queued"] < cutoff)
+
+        comments = []
+        next_head = head
+        for number in numbers:
+            entry = entries.get(queue_key(number))
+            if entry is None and not old_entry_after[number]:
+                break
+            if entry is not None:
+                comments.append(entry)
+            next_head = number + 1
+
+        save_comments(comments)
+        cache.set(QUEUE_HEAD_KEY, next_head, timeout=None)
+        cache.delete_many([queue_key(number) for number in range(head, next_head)])
+        return next_head - head
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def save_comments(entries: list[dict]):
+    """bulk_create() queued comments, then do once what the Comment signals do for each comment"""
+    posts = Post.published.only("slug", "publish").in_bulk({entry["post_id"] for entry in entries})
+    comments = [
+        Comment(
+            post_id=entry["post_id"], name=entry["name"], email=entry["email"], body=entry["body"]
+        )
+        for entry in entries
+        if entry["post_id"] in posts
+    ]
+    if not comments:
+        return
+    with transaction.atomic():
+        # NOTE: bulk_create() doesn't send post_save: no per-comment UPDATE of the post or cache invalidations
+        Comment.objects.bulk_create(comments, batch_size=500)
+        adjust_comment_counts(Counter(comment.post_id for comment in comments))
+    invalidate_sidebar()
+    invalidate_admin_facets(Comment)
+    touch_pages(*{post_detail_pages(posts[comment.post_id]) for comment in comments})
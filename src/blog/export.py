@@ -0,0 +1,419 @@
+"""
+Static export of the public pages (``./manage.py exportsite <directory>``): every published page is rendered
+through the live views (the full middleware stack of the test client) into a file that nginx serves without
+running Django:
+
+    /blog/                          -> blog/index.html
+    /blog/?page=2                   -> blog/index.page=2.html (the raw query string, as linked by the pages)
+    /blog/2025/1/31/my-post/        -> blog/2025/1/31/my-post/index.html
+    /blog/tag/django/feed/          -> blog/tag/django/feed/index.html
+    /sitemap.xml                    -> sitemap.xml
+
+Anything that wasn't exported (search, share, comment POSTs, unknown query strings...) falls back to Django.
+The files are the same for every visitor: the CSRF token of the comment form is blank, a script of the page
+gets one (and its cookie) from the csrf_token view.
+
+
+    map $args $export_index { "" index.html; default index.$args.html; }
+    server {
+        root /srv/blog;
+        location /blog/ { try_files $uri$export_index @django; }
+        location ~ /feed/$ { default_type "application/rss+xml; charset=utf-8"; try_files $uri$export_index @django; }
+        location ~ ^/sitemap[-\\w]*\\.xml$ { try_files $uri @django; }
+        location @django { proxy_pass http://127.0.0.1:8000; }
+    }
+
+Incremental exports only render the pages affected by the posts and comments whose `updated` is newer than the
+start of the previous export (kept in the manifest file of the directory, with a line for the URL and tags of
+every exported post): their detail pages, the detail pages showing them as similar posts, the lists and feeds of
+the blog and of their tags (old and new), and the sitemap. Removed posts and tags are deleted. If the sidebar
+(shown on every page) or the export settings changed, everything is rendered again.
+The posts are streamed from a server-side cursor, ordered by pk like the lines of the manifest: both are compared
+in one pass and the new manifest is written to a temporary file meanwhile, whatever the number of posts.
+NOTE: each list page costs what its view costs: with numbered pages (OFFSET) exporting a long list is quadratic,
+keyset pagination (settings.BLOG_KEYSET_PAGINATION) reads each post once.
+NOTE: deleted comments, renamed tags and ./manage.py similarposts don't change any `updated`: export without
+--incremental afterwards
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.http import QueryDict
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .cache import blank_csrf_token
+from .models import Comment, Post, SimilarPost
+from .paginators import KeysetPaginator
+from .sidebar import SIDEBAR_POSTS, latest_posts, most_commented_posts, total_posts
+from .sitemaps import shard_starts
+from .urlbuilders import post_detail_url, tag_url
+
+MANIFEST_FILE = ".export.json"
+# Changes when the lines of the manifest change: the next export can't be incremental
+MANIFEST_FORMAT = 2
+# Rows fetched at once from the server-side cursors
+CHUNK_SIZE = 2000
+
+
+def export_file(url: str) -> str:
+    """File of a URL, relative to the export directory"""
+    path, _, query = url.partition("?")
+    path = path.lstrip("/")
+    if not path.endswith("/") and path:
+        return path  # e.g. sitemap.xml
+    return f"{path}index.{query}.html" if query else f"{path}index.html"
+
+
+def export_settings():
+    """Settings to render the pages with the test client"""
+    # NOTE: without the page cache every page is rendered by its view (and doesn't fill the cache)
+    return override_settings(
+        ALLOWED_HOSTS=["testserver"], BLOG_PAGE_CACHE_TIMEOUT=0, BLOG_TIMING_SAMPLE_RATE=0
+    )
+
+
+def settings_key(scheme: str) -> dict:
+    """Settings that change the exported pages: a full export is needed if any of them changes"""
+    return {
+        "scheme": scheme,
+        "posts_per_page": settings.BLOG_POSTS_PER_PAGE,
+        "keyset_pagination": settings.BLOG_KEYSET_PAGINATION,
+        "feed_items": settings.BLOG_FEED_ITEMS,
+        "sitemap_shard_size": settings.BLOG_SITEMAP_SHARD_SIZE,
+        "similar_posts": settings.BLOG_SIMILAR_POSTS,
+    }
+
+
+def sidebar_fingerprint() -> str:
+    """Hash of the data of the sidebar"""
+    posts = [
+        (post.pk, post.title, post.slug, post.publish.isoformat())
+        for post in [*latest_posts(SIDEBAR_POSTS), *most_commented_posts(SIDEBAR_POSTS)]
+    ]
+    return hashlib.md5(json.dumps([total_posts(), posts]).encode()).hexdigest()
+
+
+def published_posts():
+    """(pk, URL, tag slugs) of the published posts ordered by pk, streamed from a server-side cursor"""
+    rows = (
+        Post.published.order_by("pk")
+        .values_list("pk", "publish", "slug", "tags__slug")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    # One row per tag of the post (a single one with None if the post has no tags)
+    for pk, post_rows in groupby(rows, key=itemgetter(0)):
+        post_rows = list(post_rows)
+        _, publish, slug, _ = post_rows[0]
+        # Sorted: comparable with the manifest of the previous export
+        tags = sorted(tag_slug for *_, tag_slug in post_rows if tag_slug)
+        yield pk, post_detail_url(publish.year, publish.month, publish.day, slug), tags
+
+
+def merge_posts(old_posts, new_posts):
+    """(pk, old (URL, tags) or None, new (URL, tags) or None) of two streams of posts ordered by pk"""
+    merged = heapq.merge(
+        ((pk, 0, (url, tags)) for pk, url, tags in old_posts),
+        ((pk, 1, (url, tags)) for pk, url, tags in new_posts),
+    )
+    for pk, rows in groupby(merged, key=itemgetter(0)):
+        posts = [None, None]
+        for _, side, post in rows:
+            posts[side] = post
+        yield pk, *posts
+
+
+def list_urls(path: str, posts):
+    """URLs of every page of a post list, with the query strings of the links of the pagination templates"""
+    yield path
+    per_page = settings.BLOG_POSTS_PER_PAGE
+    if settings.BLOG_KEYSET_PAGINATION:
+        paginator = KeysetPaginator(posts, per_page)
+        keys = [name for name, _ in paginator.keys]
+        rows = (
+            posts.order_by(*paginator.ordering).values_list(*keys).iterator(chunk_size=CHUNK_SIZE)
+        )
+        previous = None
+        for i, row in enumerate(rows):
+            if i and i % per_page == 0:
+                # "Next" of the page ending with `previous`, "Previous" of the page starting with `row`
+                yield f"{path}?{_query(after=paginator.encode_cursor(_row(keys, previous)))}"
+                yield f"{path}?{_query(before=paginator.encode_cursor(_row(keys, row)))}"
+            previous = row
+    else:
+        num_pages = Paginator(posts, per_page).num_pages
+        yield from (f"{path}?{_query(page=number)}" for number in range(1, num_pages + 1))
+
+
+def _query(**params) -> str:
+    # Encoded like the {% querystring %} links
+    query = QueryDict(mutable=True)
+    query.update(params)
+    return query.urlencode()
+
+
+def _row(keys: list[str], values: tuple) -> SimpleNamespace:
+    # encode_cursor() only reads the key attributes of the object
+    return SimpleNamespace(**dict(zip(keys, values)))
+
+
+class ExportPlan:
+    """
+    The pages to render and the files to delete. `full`: everything is rendered, either because it was requested
+    or because an incremental export isn't possible (no manifest, different settings or sidebar)
+    Use as a context manager: the posts of the new manifest are kept in a temporary file until it's closed
+    """
+
+    def __init__(self, directory: str, scheme: str, incremental: bool = False):
+        self.directory = directory
+        previous = read_manifest(directory)
+        self.manifest = {
+            "format": MANIFEST_FORMAT,
+            "started": timezone.now().isoformat(),
+            "settings": settings_key(scheme),
+            "sidebar": sidebar_fingerprint(),
+        }
+        self.full = not (
+            incremental
+            and previous
+            and all(
+                previous.get(key) == self.manifest[key] for key in ("format", "settings", "sidebar")
+            )
+        )
+        if not self.full:
+            since = datetime.fromisoformat(previous["started"])
+            updated = set(Post.objects.filter(updated__gt=since).values_list("pk", flat=True))
+
+        # Lines of the new manifest: one per published post
+        self.posts_file = tempfile.TemporaryFile()  # noqa: SIM115 closed by __exit__()
+        self.tags = set()
+        old_tags = set()
+        self.stale_files = []
+        edited = set()
+        self.list_tags = set()
+        same_format = previous and previous.get("format") == MANIFEST_FORMAT
+        old_posts = manifest_posts(directory) if same_format else []
+        for pk, old, new in merge_posts(old_posts, published_posts()):
+            if new:
+                self.posts_file.write(json.dumps([pk, *new]).encode() + b"\n")
+                self.tags.update(new[1])
+            if old:
+                old_tags.update(old[1])
+                # Pages of removed posts, and of posts whose URL changed (date or slug)
+                if not new or new[0] != old[0]:
+                    self.stale_files.append(export_file(old[0]))
+            if not self.full and (old != new or pk in updated):
+                edited.add(pk)
+                for post in (old, new):
+                    if post:
+                        self.list_tags.update(post[1])
+        self.stale_tags = old_tags - self.tags
+
+        if self.full:
+            self.detail_posts = None  # all of them
+            self.list_changed = True
+            self.list_tags = set(self.tags)
+        else:
+            # The detail page also shows the comments and the similar posts
+            self.detail_posts = edited | set(
+                Comment.objects.filter(updated__gt=since).values_list("post_id", flat=True)
+            )
+            self.detail_posts.update(
+                SimilarPost.objects.filter(similar__in=edited).values_list("post_id", flat=True)
+            )
+            self.list_changed = bool(edited)
+            self.list_tags &= self.tags
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.posts_file.close()
+
+    def posts(self):
+        """(pk, URL, tag slugs) of the published posts, read from the new manifest"""
+        self.posts_file.seek(0)
+        for line in self.posts_file:
+            yield json.loads(line)
+
+    def urls(self):
+        """URLs of the pages to render, lazily: the lists are read from server-side cursors"""
+        yield from (
+            url
+            for pk, url, _ in self.posts()
+            if self.detail_posts is None or pk in self.detail_posts
+        )
+        if self.list_changed:
+            yield from list_urls(reverse("blog:post_list"), Post.published.all())
+            yield reverse("blog:post_feed")
+        for slug in sorted(self.list_tags):
+            yield from list_urls(tag_url(slug), Post.published.filter(tags__slug=slug))
+            yield reverse("blog:post_feed_by_tag", args=[slug])
+        if self.list_changed:
+            yield reverse("sitemap")
+            self.sitemap_shards = len(shard_starts()) + 1
+            yield from (
+                reverse("sitemap_shard", args=[shard])
+                for shard in range(1, self.sitemap_shards + 1)
+            )
+
+    def write_manifest(self):
+        """Write the manifest of this export (call once the pages are exported)"""
+        with atomic_file(os.path.join(self.directory, MANIFEST_FILE)) as file:
+            file.write(json.dumps(self.manifest).encode() + b"\n")
+            self.posts_file.seek(0)
+            shutil.copyfileobj(self.posts_file, file)
+
+    def delete_stale(self):
+        """Delete the files of removed posts and tags, and the pages of the lists that will be rendered again"""
+        for file in self.stale_files:
+            remove_file(self.directory, file)
+        for slug in self.stale_tags:
+            shutil.rmtree(self._path(tag_url(slug)), ignore_errors=True)
+        # Lists can have fewer pages (or other cursors) now, their first page is just overwritten
+        list_paths = [tag_url(slug) for slug in self.list_tags]
+        if self.list_changed:
+            list_paths.append(reverse("blog:post_list"))
+        for path in list_paths:
+            directory = self._path(path)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    if (
+                        name.startswith("index.")
+                        and name.endswith(".html")
+                        and name != "index.html"
+                    ):
+                        os.remove(os.path.join(directory, name))
+
+    def delete_stale_shards(self):
+        """Delete the sitemap shards past the last one (call after urls() was consumed)"""
+        if not self.list_changed or not os.path.isdir(self.directory):
+            return
+        current = {
+            export_file(reverse("sitemap_shard", args=[n]))
+            for n in range(1, self.sitemap_shards + 1)
+        }
+        for name in os.listdir(self.directory):
+            if name.startswith("sitemap-posts-") and name not in current:
+                os.remove(os.path.join(self.directory, name))
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, export_file(url).rpartition("/")[0])
+
+
+def read_manifest(directory: str) -> dict | None:
+    """The first line of the manifest: the start, settings and sidebar of the previous export"""
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as file:
+            manifest = json.loads(file.readline())
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def manifest_posts(directory: str):
+    """(pk, URL, tag slugs) of the posts of the previous export, ordered by pk: the next lines of the manifest"""
+    with open(os.path.join(directory, MANIFEST_FILE)) as file:
+        file.readline()
+        for line in file:
+            yield json.loads(line)
+
+
+@contextmanager
+def atomic_file(path: str):
+    """Binary file written atomically: the web server never serves half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        yield file
+    os.replace(temporary, path)
+
+
+def write_file(path: str, content: bytes):
+    with atomic_file(path) as file:
+        file.write(content)
+
+
+def remove_file(directory: str, file: str):
+    """Remove an exported file and its parent directories left empty (up to the export directory)"""
+    try:
+        os.remove(os.path.join(directory, file))
+    except FileNotFoundError:
+        return
+    parent = os.path.dirname(file)
+    while parent:
+        try:
+            os.rmdir(os.path.join(directory, parent))
+        except OSError:  # not empty
+            break
+        parent = os.path.dirname(parent)
+
+
+def exported_files(directory: str) -> set[str]:
+    """Files of an export directory (but the manifest), relative to it"""
+    files = set()
+    for root, _, names in os.walk(directory):
+        relative = os.path.relpath(root, directory)
+        files.update(os.path.normpath(os.path.join(relative, name)) for name in names)
+    files.discard(MANIFEST_FILE)
+    return files
+
+
+# Client of the rendering process
+_client = None
+
+
+def render_pages(
+    directory: str, urls: list[str], scheme: str, verify: bool = False
+) -> tuple[int, int, list[str]]:
+    """
+    GET the URLs through the views and write each response to its file, or with `verify` compare it byte for
+    byte with the file. Returns (pages, bytes, URLs that failed: not 200 or different from the file)
+    Runs in the workers of the process pool too (spawned processes, set up by django.setup())
+    """
+    global _client
+    if _client is None:
+        _client = Client()
+    with export_settings():
+        return _render_pages(directory, urls, scheme == "https", verify)
+
+
+def _render_pages(directory: str, urls: list[str], secure: bool, verify: bool):
+    pages = size = 0
+    failed = []
+    for url in urls:
+        response = _client.get(url, secure=secure)
+        if response.status_code != 200:
+            failed.append(f"{url} ({response.status_code})")
+            continue
+        content = b"".join(response) if response.streaming else response.content
+        # The same file for every visitor: the comment form gets a token from the csrf_token view
+        content = blank_csrf_token(content)
+        path = os.path.join(directory, export_file(url))
+        if verify:
+            try:
+                with open(path, "rb") as file:
+                    same = file.read() == content
+            except FileNotFoundError:
+                same = False
+            if not same:
+                failed.append(url)
+                continue
+        else:
+            write_file(path, content)
+        pages += 1
+        size += len(content)
+    return pages, size, failed
@@ -0,0 +1,62 @@
+"""
+Fake data used by the addposts command.
+
+NOTE: this module doesn't import Django models on purpose: generate_posts() runs in worker processes
+(ProcessPoolExecutor) that may be started with "spawn"/"forkserver", where Django isn't set up.
+It only returns plain Python values that the main process turns into database rows.
+"""
+
+from datetime import UTC, datetime
+
+from faker import Faker
+
+
+def generate_posts(
+    seed: int,
+    size: int,
+    author_ids: list[int],
+    statuses: list[str],
+    tag_names: list[str],
+    tags_per_post: int,
+    comments_per_post: int,
+) -> list[dict]:
+    """
+    Generate `size` fake posts as dicts. The same seed always generates the same batch.
+    Each post has a "comments" list of (name, email, body, active) tuples and a "tags" list of tag names
+    """
+    fake = Faker()
+    fake.seed_instance(seed)
+    now = datetime.now(UTC)
+    tags_per_post = min(tags_per_post, len(tag_names))
+
+    posts = []
+    for _ in range(size):
+        comments = [
+            (
+                fake.name(),
+                fake.email(),
+                fake.paragraph(nb_sentences=5),
+                fake.boolean(chance_of_getting_true=95),
+            )
+            for _ in range(comments_per_post)
+        ]
+        posts.append(
+            {
+                "title": fake.sentence(nb_words=7),
+                # NOTE: fake.slug() alone repeats often and slugs must be unique for each publish date
+                "slug": f"{fake.slug()}-{fake.hexify('^^^^^^')}",
+                "author_id": fake.random_element(author_ids),
+                "body": fake.paragraph(nb_sentences=10),
+                "publish": fake.date_time(tzinfo=UTC),
+                "created": now,
+                "updated": now,
+                "status": fake.random_element(statuses),
+                # NOTE: the denormalized counter is known up front, no recount needed afterwards
+                "comment_count": sum(1 for *_, active in comments if active),
+                "tags": fake.random_sample(tag_names, length=tags_per_post)
+                if tags_per_post
+                else [],
+                "comments": comments,
+            }
+        )
+    return posts
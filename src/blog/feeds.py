@@ -1,26 +1,144 @@
-import markdown
+"""
+RSS feeds of the latest posts (feed/) and of the latest posts of each tag (tag/<slug>/feed/).
+
+Feed readers poll constantly, so the feeds aren't rendered on request: each feed document is a "snapshot" in the
+cache (content, ETag and Last-Modified) rebuilt when the posts it shows change (see signals.py). A poll is a
+single cache read and, if the reader has the current version, a 304. The database is only queried if a
+snapshot is missing (e.g. evicted, expired after settings.BLOG_FEED_SNAPSHOT_TIMEOUT or never built).
+
+NOTE: the feeds of tags that don't exist are never stored: any slug can be requested, and a snapshot for each of
+them would let clients fill the cache (evicting the real snapshots). Their 404 is a single index lookup
+"""
+
+import hashlib
+from io import BytesIO
+
+from django.conf import settings
 from django.contrib.syndication.views import Feed
-from django.template.defaultfilters import truncatewords_html
-from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404, HttpRequest, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse, reverse_lazy
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from taggit.models import Tag
 
 from .models import Post
+from .urlbuilders import tag_url
 
 
 class LatestPostsFeed(Feed):
     # <title>, <link> and <description> from feed
     title = "My blog"
-    link = reverse_lazy("blog:post_list")  # URL won't be evaluated until project URL config is loaded
+    # URL won't be evaluated until project URL config is loaded
+    link = reverse_lazy("blog:post_list")
     description = "Latest posts of my blog"
 
     def items(self):
         # FIXME: does it work without all()??
-        return Post.published.all()[:5]
+        return Post.published.all()[: settings.BLOG_FEED_ITEMS]
 
     def item_title(self, obj):
         return obj.title
 
     def item_description(self, item):
-        return truncatewords_html(markdown.markdown(item.body), 30)
+        # Cached, already truncated HTML (was: truncatewords_html(markdown.markdown(item.body), 30))
+        return item.excerpt_html
 
     def item_pubdate(self, item):
         return item.publish
+
+
+class TagPostsFeed(LatestPostsFeed):
+    """Latest posts of a tag. NOTE: get_object() receives the URL arguments, the other methods its result"""
+
+    def get_object(self, request, tag_slug):
+        return get_object_or_404(Tag, slug=tag_slug)
+
+    def title(self, tag):
+        return f"My blog: {tag.name}"
+
+    def link(self, tag):
+        return tag_url(tag.slug)
+
+    def description(self, tag):
+        return f"Latest posts tagged with {tag.name}"
+
+    def items(self, tag):
+        return Post.published.filter(tags__in=[tag])[: settings.BLOG_FEED_ITEMS]
+
+
+def feed_key(tag_slug: str | None = None) -> str:
+    return f"blog:feed:{tag_slug}" if tag_slug else "blog:feed"
+
+
+class SnapshotRequest(HttpRequest):
+    """The request feeds are rendered for: only its path and scheme end up in the document"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = self.path_info = path
+
+    def _get_scheme(self):
+        return settings.BLOG_FEED_SCHEME
+
+
+def build_feed_snapshot(tag_slug: str | None = None) -> dict:
+    """
+    Render a feed and store its snapshot: {"status", "content", "content_type", "etag", "last_modified"}
+    NOTE: the {"status": 404} of a tag that doesn't exist isn't stored (see the module docstring)
+    """
+    if tag_slug:
+        feed, path = TagPostsFeed(), reverse("blog:post_feed_by_tag", args=[tag_slug])
+    else:
+        feed, path = LatestPostsFeed(), reverse("blog:post_feed")
+    request = SnapshotRequest(path)
+    try:
+        # The same as Feed.__call__() without building an HttpResponse
+        document = feed.get_feed(feed.get_object(request, tag_slug) if tag_slug else None, request)
+    except Http404:
+        return {"status": 404}
+
+    content = BytesIO()
+    document.write(content, "utf-8")
+    content = content.getvalue()
+    snapshot = {
+        "status": 200,
+        "content": content,
+        "content_type": document.content_type,
+        "etag": quote_etag(hashlib.md5(content).hexdigest()),
+        "last_modified": int(document.latest_post_date().timestamp()),
+    }
+    cache.set(feed_key(tag_slug), snapshot, timeout=settings.BLOG_FEED_SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def refresh_feeds(tag_slugs=(), latest: bool = True):
+    """
+    Drop the snapshots of the feed of latest posts and of the given tags now (no poll gets a stale feed), and
+    build them again once the current transaction commits (rolled back changes are never published)
+    """
+    slugs = [None, *tag_slugs] if latest else list(tag_slugs)
+    cache.delete_many([feed_key(slug) for slug in slugs])
+    transaction.on_commit(lambda: [build_feed_snapshot(slug) for slug in slugs])
+
+
+def feed_response(request, snapshot: dict) -> HttpResponse:
+    """304 if the client has the snapshot, the snapshot otherwise"""
+    if snapshot["status"] == 404:
+        raise Http404("No Tag matches the given query.")
+    response = get_conditional_response(
+        request, etag=snapshot["etag"], last_modified=snapshot["last_modified"]
+    )
+    if response is None:
+        response = HttpResponse(snapshot["content"], content_type=snapshot["content_type"])
+    response["ETag"] = snapshot["etag"]
+    response["Last-Modified"] = http_date(snapshot["last_modified"])
+    return response
+
+
+def post_feed(request, tag_slug: str | None = None):
+    """The feed of the latest posts, or of the latest posts of a tag, from its snapshot"""
+    snapshot = cache.get(feed_key(tag_slug)) or build_feed_snapshot(tag_slug)
+    return feed_response(request, snapshot)
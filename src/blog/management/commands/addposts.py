@@ -1,12 +1,36 @@
-from datetime import UTC
+import csv
+import io
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
 from django.db import connection, transaction
+from django.utils.text import slugify
 from faker import Faker
-
+from taggit.models import Tag, TaggedItem
+
+from blog.cache import (
+    LIST_PAGES,
+    SITEMAP_PAGES,
+    invalidate_admin_facets,
+    invalidate_sidebar,
+    tag_pages,
+    touch_pages,
+)
+from blog.fakedata import generate_posts
+from blog.feeds import refresh_feeds
 from blog.models import Comment, Post
 
+POST_COLUMNS = ["title", "slug", "author_id", "body", "publish", "created", "updated", "status", "comment_count"]
+COMMENT_COLUMNS = ["post_id", "name", "email", "body", "created", "updated", "active"]
+# Upper bounds of the arguments (larger values are reduced to these)
+MAX_POSTS = 10_000_000
+MAX_COMMENTS = 100
+
 
 class Command(BaseCommand):
     help = "Add fake blog posts to database"
@@ -14,12 +38,24 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("num_posts", type=int, help="Number of blog posts to create.", default=10)
         parser.add_argument("--comments", "-c", type=int, help="Number of comments per post to create.", default=10)
+        parser.add_argument("--tags", "-t", type=int, help="Number of tags per post.", default=0)
+        parser.add_argument("--tag-pool", type=int, help="Number of distinct tags to choose from.", default=50)
+        parser.add_argument(
+            "--batch-size", "-b", type=int, help="Number of posts generated and inserted at once.", default=1000
+        )
+        parser.add_argument(
+            "--workers", "-w", type=int, help="Processes generating fake data (1: no process pool).", default=1
+        )
+        parser.add_argument("--copy", action="store_true", help="Insert rows with COPY (PostgreSQL only).")
+        parser.add_argument("--seed", type=int, help="Seed for reproducible data.")
 
     def handle(self, *args, **options):
-        MAX_POSTS = 100000
-        MAX_COMMENTS = 100
         num_posts = min(options["num_posts"], MAX_POSTS)
         num_comments = min(options["comments"], MAX_COMMENTS)
+        num_tags = options["tags"]
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        use_copy = options["copy"]
         verbosity = options.get("verbosity", 1)
         if num_posts < 1:
             self.stdout.write(self.style.ERROR("Number of posts must be greater or equal to 1"))
@@ -27,56 +63,158 @@ class Command(BaseCommand):
         if num_comments < 0:
             self.stdout.write(self.style.ERROR("Number of comments must be greater or equal to 0"))
             return
+        if num_tags < 0 or options["tag_pool"] < num_tags:
+            self.stdout.write(self.style.ERROR("Number of tags must be between 0 and the size of the tag pool"))
+            return
+        if batch_size < 1 or workers < 1:
+            self.stdout.write(self.style.ERROR("Batch size and workers must be greater or equal to 1"))
+            return
+        if use_copy and connection.vendor != "postgresql":
+            self.stdout.write(self.style.ERROR("COPY is only available with PostgreSQL"))
+            return
 
-        fake = Faker()
         User = get_user_model()
 
         if not User.objects.exists():
             self.stdout.write(self.style.ERROR("At least 1 existing user is required to generate posts"))
             return
 
-        posts = []
-        comments = []
-
-        users = list(User.objects.all())
-
-        for _ in range(num_posts):
-            user = fake.random_element(users)
-            post = Post(
-                title=fake.sentence(nb_words=7),
-                slug=fake.slug(),
-                author=user,
-                body=fake.paragraph(nb_sentences=10),
-                publish=fake.date_time(tzinfo=UTC),
-                status=fake.random_element(elements=list(Post.Status)),
+        author_ids = list(User.objects.values_list("pk", flat=True))
+        seed = options["seed"] if options["seed"] is not None else random.randrange(2**32)
+        tag_ids = self.create_tags(options["tag_pool"], seed) if num_tags else {}
+
+        # NOTE: PRAGMA statements only exist in SQLite
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode=WAL;")
+                # cursor.execute("PRAGMA journal_mode=MEMORY;")
+                cursor.execute("PRAGMA synchronous=OFF;")
+                cursor.execute("PRAGMA cache_size=10000;")  # default: 2000 pages
+                # cursor.execute('PRAGMA page_size=4096;')  # default: 1024 bytes (1 KB), units: bytes
+
+        # Every batch is generated from its own seed: the result doesn't depend on the number of workers
+        specs = [
+            (seed + i, min(batch_size, num_posts - start), author_ids, list(Post.Status.values), list(tag_ids),
+             num_tags, num_comments)
+            for i, start in enumerate(range(0, num_posts, batch_size))
+        ]  # fmt: skip
+        insert = self.copy_batch if use_copy else self.bulk_create_batch
+        content_type = ContentType.objects.get_for_model(Post)
+
+        # NOTE: only one batch (and a few pending ones from the workers) is kept in memory at a time
+        started = time.perf_counter()
+        inserted_posts = inserted_rows = 0
+        for posts in self.generate(specs, workers):
+            with transaction.atomic():
+                inserted_rows += insert(posts, tag_ids, content_type)
+            inserted_posts += len(posts)
+            if verbosity > 1:
+                rate = inserted_rows / (time.perf_counter() - started)
+                self.stdout.write(f"Inserted {inserted_posts}/{num_posts} posts ({rate:,.0f} rows/s)")
+        elapsed = time.perf_counter() - started
+
+        # bulk_create() and COPY don't send signals: invalidate what the post_save receivers would have
+        invalidate_sidebar()
+        invalidate_admin_facets(Post, Comment)
+        tag_slugs = [slugify(name) for name in tag_ids]
+        touch_pages(LIST_PAGES, SITEMAP_PAGES, *(tag_pages(slug) for slug in tag_slugs))
+        refresh_feeds(tag_slugs)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Successfully generated {num_posts} posts with {num_comments} comments and {num_tags} tags each: "
+                f"{inserted_rows} rows in {elapsed:.1f}s ({inserted_rows / elapsed:,.0f} rows/s)."
             )
-            posts.append(post)
+        )
+        if num_tags and verbosity > 0:
+            self.stdout.write("Run the similarposts command to refresh the similar posts of the new posts.")
+
+    def create_tags(self, pool_size: int, seed: int) -> dict[str, int]:
+        """Create (or reuse) `pool_size` tags and return their ids by name"""
+        fake = Faker()
+        fake.seed_instance(seed)
+        names = {fake.word() for _ in range(pool_size)}
+        while len(names) < pool_size:
+            names.add(f"{fake.word()}-{fake.word()}")
+        Tag.objects.bulk_create([Tag(name=name, slug=slugify(name)) for name in names], ignore_conflicts=True)
+        return dict(Tag.objects.filter(name__in=names).values_list("name", "pk"))
+
+    @staticmethod
+    def generate(specs: list[tuple], workers: int):
+        """Yield the generated batches in order, fanning generation out over a process pool if workers > 1"""
+        if workers == 1:
+            for spec in specs:
+                yield generate_posts(*spec)
+            return
 
+        # Forked workers must not share the open database connection
+        connection.close()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Bounded number of pending batches so memory doesn't grow if inserting is slower than generating
+            pending = deque()
+            for spec in specs:
+                pending.append(executor.submit(generate_posts, *spec))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @staticmethod
+    def bulk_create_batch(posts: list[dict], tag_ids: dict[str, int], content_type: ContentType) -> int:
+        """Insert one batch with bulk_create(). Returns the number of rows inserted"""
+        post_objects = Post.objects.bulk_create([Post(**{name: data[name] for name in POST_COLUMNS}) for data in posts])
+        comments = [
+            Comment(post=post, name=name, email=email, body=body, active=active)
+            for post, data in zip(post_objects, posts)
+            for name, email, body, active in data["comments"]
+        ]
+        tagged_items = [
+            TaggedItem(content_type=content_type, object_id=post.pk, tag_id=tag_ids[tag])
+            for post, data in zip(post_objects, posts)
+            for tag in data["tags"]
+        ]
+        Comment.objects.bulk_create(comments)
+        TaggedItem.objects.bulk_create(tagged_items)
+        return len(post_objects) + len(comments) + len(tagged_items)
+
+    @staticmethod
+    def copy_batch(posts: list[dict], tag_ids: dict[str, int], content_type: ContentType) -> int:
+        """Insert one batch with PostgreSQL COPY. Returns the number of rows inserted"""
         with connection.cursor() as cursor:
-            cursor.execute("PRAGMA journal_mode=WAL;")
-            # cursor.execute("PRAGMA journal_mode=MEMORY;")
-            cursor.execute("PRAGMA synchronous=OFF;")
-            cursor.execute("PRAGMA cache_size=10000;")  # default: 2000 pages
-            # cursor.execute('PRAGMA page_size=4096;')  # default: 1024 bytes (1 KB), units: bytes
-
-        with transaction.atomic():
-            Post.objects.bulk_create(posts)
-
-            for post in posts:
-                for _ in range(num_comments):
-                    comment = Comment(
-                        post=post,
-                        name=fake.name(),
-                        email=fake.email(),
-                        body=fake.paragraph(nb_sentences=5),
-                        active=fake.boolean(chance_of_getting_true=95),
-                    )
-                    comments.append(comment)
-
-            Comment.objects.bulk_create(comments)
-
-        if verbosity > 1:
-            for post in posts:
-                self.stdout.write(self.style.SUCCESS(f"Generated post {post.slug}"))
-
-        self.stdout.write(self.style.SUCCESS(f"Successfully generated {num_posts} posts with {num_comments} comments."))
+            # NOTE: COPY doesn't return the generated ids: reserve them from the sequence beforehand
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [Post._meta.db_table, len(posts)],
+            )
+            post_ids = [row[0] for row in cursor.fetchall()]
+            post_rows = [[pk, *(data[name] for name in POST_COLUMNS)] for pk, data in zip(post_ids, posts)]
+            comment_rows = [
+                [pk, name, email, body, data["created"], data["updated"], active]
+                for pk, data in zip(post_ids, posts)
+                for name, email, body, active in data["comments"]
+            ]
+            tagged_rows = [
+                [pk, content_type.pk, tag_ids[tag]] for pk, data in zip(post_ids, posts) for tag in data["tags"]
+            ]
+            copy_rows(cursor, Post._meta.db_table, ["id", *POST_COLUMNS], post_rows)
+            copy_rows(cursor, Comment._meta.db_table, COMMENT_COLUMNS, comment_rows)
+            copy_rows(cursor, TaggedItem._meta.db_table, ["object_id", "content_type_id", "tag_id"], tagged_rows)
+        return len(post_rows) + len(comment_rows) + len(tagged_rows)
+
+
+def copy_rows(cursor, table: str, columns: list[str], rows: list[list]):
+    """COPY rows into a table with psycopg2 (copy_expert) or psycopg 3 (copy)"""
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    sql = f"COPY {quote(table)} ({', '.join(quote(column) for column in columns)}) FROM STDIN"
+    raw_cursor = cursor.cursor
+    if hasattr(raw_cursor, "copy_expert"):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        raw_cursor.copy_expert(f"{sql} WITH (FORMAT csv)", buffer)
+    else:
+        with raw_cursor.copy(sql) as copy:
+            for row in rows:
+                copy.write_row(row)
@@ -0,0 +1,131 @@
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from blog.benchmarks import SCENARIOS
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = "Measure the latency of hot blog queries against the current database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "scenario", choices=sorted(SCENARIOS), help="Benchmark scenario to run."
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Generate this many posts with addposts before measuring.",
+            default=0,
+        )
+        parser.add_argument(
+            "--repeat", "-r", type=int, help="Number of timed runs per measurement.", default=5
+        )
+        parser.add_argument(
+            "--query",
+            "-q",
+            action="append",
+            dest="queries",
+            help="Search query to benchmark (repeatable).",
+        )
+        parser.add_argument(
+            "--page", type=int, help="Deep page number for the pagination scenario.", default=10000
+        )
+        parser.add_argument(
+            "--sections",
+            type=int,
+            help="Markdown sections per post body for the markdown scenario.",
+            default=50,
+        )
+        parser.add_argument(
+            "--warm",
+            action="store_true",
+            help="Keep the page cache enabled in the endpoints scenario.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            "-c",
+            type=int,
+            help="Simultaneous clients in the concurrency scenario.",
+            default=50,
+        )
+        parser.add_argument(
+            "--requests",
+            "-n",
+            type=int,
+            help="Total requests per page in the concurrency scenario.",
+            default=500,
+        )
+        parser.add_argument("--json", help="Write the results to this JSON file.")
+        parser.add_argument(
+            "--compare", help="JSON file of a previous run (--json) to compare the results with."
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            help="Slowdown of the median flagged as a regression in --compare (0.2 = 20%%).",
+            default=0.2,
+        )
+
+    def handle(self, *args, **options):
+        if options["seed"] > 0:
+            # Seeded from the number of existing posts: the same dataset for the same starting database
+            call_command(
+                "addposts",
+                options["seed"],
+                comments=5,
+                tags=3,
+                seed=Post.objects.count(),
+                copy=connection.vendor == "postgresql",
+                verbosity=0,
+            )
+            call_command("similarposts", verbosity=0)
+
+        scenario = options["scenario"]
+        results = SCENARIOS[scenario](options)
+        baseline = {}
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                baseline = json.load(file)["results"]
+
+        self.stdout.write(
+            f"{'measurement':<50} {'min':>10} {'median':>10} {'max':>10} {'queries':>8} {'req/s':>8}"
+            + (f" {'baseline':>10} {'change':>8}" if baseline else "")
+        )
+        regressions = []
+        for label, timings in results.items():
+            line = (
+                f"{label:<50} {timings['min_ms']:>8.2f}ms {timings['median_ms']:>8.2f}ms "
+                f"{timings['max_ms']:>8.2f}ms {timings.get('queries', ''):>8}"
+                f" {_format(timings.get('requests_per_s'), '.1f'):>8}"
+            )
+            if label in baseline:
+                line, regression = self.compare(
+                    line, timings, baseline[label], options["threshold"]
+                )
+                if regression:
+                    regressions.append(label)
+            self.stdout.write(line)
+
+        if options["json"]:
+            with open(options["json"], "w") as file:
+                json.dump({"scenario": scenario, "results": results}, file, indent=2)
+        if regressions:
+            raise CommandError(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+
+    def compare(self, line: str, timings: dict, previous: dict, threshold: float):
+        """Add the baseline median and the change to the line. A regression is slower or has more queries"""
+        change = timings["median_ms"] / previous["median_ms"] - 1
+        line += f" {previous['median_ms']:>8.2f}ms {change:>+8.0%}"
+        more_queries = timings.get("queries", 0) > previous.get("queries", 0)
+        if change > threshold or more_queries:
+            reason = "more queries" if more_queries else "slower"
+            return self.style.ERROR(f"{line} REGRESSION ({reason})"), True
+        return line, False
+
+
+def _format(value, spec: str) -> str:
+    return "" if value is None else format(value, spec)
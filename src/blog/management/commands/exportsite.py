@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.export import (
+    ExportPlan,
+    export_file,
+    export_settings,
+    exported_files,
+    render_pages,
+)
+
+# Failed URLs listed in the output
+MAX_LISTED = 10
+
+
+class Command(BaseCommand):
+    help = "Render the published pages to a directory that a web server (e.g. nginx) serves without Django"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Export directory (created if it doesn't exist).")
+        parser.add_argument(
+            "--incremental",
+            "-i",
+            action="store_true",
+            help="Only render the pages affected by the posts and comments changed since the last export.",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Compare every page with the output of the views byte for byte instead of exporting.",
+        )
+        parser.add_argument(
+            "--workers",
+            "-w",
+            type=int,
+            help="Processes rendering pages (1: no process pool).",
+            default=os.cpu_count() or 1,
+        )
+        parser.add_argument(
+            "--batch-size", "-b", type=int, help="Pages rendered per task of a worker.", default=100
+        )
+        parser.add_argument(
+            "--scheme",
+            choices=["http", "https"],
+            help="Scheme of the requests (absolute URLs of the sitemap).",
+            default=settings.BLOG_FEED_SCHEME,
+        )
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        verify = options["verify"]
+        if options["workers"] < 1 or options["batch_size"] < 1:
+            raise CommandError("Workers and batch size must be greater or equal to 1")
+        if verify and not os.path.isdir(directory):
+            raise CommandError(f"{directory} doesn't exist")
+
+        incremental = options["incremental"] and not verify
+        with export_settings(), ExportPlan(directory, options["scheme"], incremental) as plan:
+            if not verify:
+                plan.delete_stale()
+
+            expected = set()
+
+            def urls():
+                for url in plan.urls():
+                    expected.add(export_file(url))
+                    yield url
+
+            started = time.perf_counter()
+            pages = size = 0
+            failed = []
+            for batch_pages, batch_size, batch_failed in self.render(
+                directory, urls(), verify, options
+            ):
+                pages += batch_pages
+                size += batch_size
+                failed += batch_failed
+                if options["verbosity"] > 1:
+                    self.stdout.write(
+                        f"{pages} pages ({pages / (time.perf_counter() - started):,.0f} pages/s)"
+                    )
+            elapsed = time.perf_counter() - started
+
+            rate = f"in {elapsed:.1f}s ({pages / elapsed:,.0f} pages/s)" if elapsed else ""
+            if verify:
+                # Files no page maps to: left behind by an export that missed a change
+                stale = sorted(exported_files(directory) - expected)
+                self.stdout.write(f"Verified {pages} pages {rate}.")
+                if failed or stale:
+                    for url in failed[:MAX_LISTED]:
+                        self.stdout.write(self.style.ERROR(f"Different: {url}"))
+                    for file in stale[:MAX_LISTED]:
+                        self.stdout.write(self.style.ERROR(f"Stale file: {file}"))
+                    raise CommandError(
+                        f"{len(failed)} pages differ from the views, {len(stale)} stale files"
+                    )
+                self.stdout.write(self.style.SUCCESS("The export matches the views byte for byte."))
+                return
+
+            plan.delete_stale_shards()
+            plan.write_manifest()
+            for url in failed[:MAX_LISTED]:
+                self.stdout.write(self.style.WARNING(f"Not exported: {url}"))
+            mode = "full" if plan.full else "incremental"
+            self.stdout.write(
+                self.style.SUCCESS(f"Exported {pages} pages ({size / 1e6:.1f} MB, {mode}) {rate}.")
+            )
+
+    @staticmethod
+    def render(directory: str, urls, verify: bool, options: dict):
+        """Yield the results of render_pages() for batches of URLs, rendered by a process pool if workers > 1"""
+        workers = options["workers"]
+        batches = (list(batch) for batch in batched(urls, options["batch_size"]))
+        if workers == 1:
+            for batch in batches:
+                yield render_pages(directory, batch, options["scheme"], verify)
+            return
+
+        # NOTE: spawned (not forked) workers open their own connections, this process keeps streaming the URLs
+        # from its server-side cursors meanwhile
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            # NOTE: a spawned process must set up Django before unpickling its first task (imports blog.export)
+            initializer=django.setup,
+        ) as executor:
+            # Bounded number of pending batches, like addposts
+            pending = deque()
+            for batch in batches:
+                pending.append(
+                    executor.submit(render_pages, directory, batch, options["scheme"], verify)
+                )
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.comments import flush_comments, queued_comments
+
+
+class Command(BaseCommand):
+    help = "Save the comments queued by post_comment (settings.BLOG_BUFFERED_COMMENTS) in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            type=int,
+            help="Number of comments saved per bulk insert.",
+            default=1000,
+        )
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="Keep running and flush the queue periodically (stop with Ctrl+C).",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Seconds between flushes with --watch.",
+            default=2.0,
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            self.stdout.write(self.style.ERROR("Batch size must be greater or equal to 1"))
+            return
+
+        processed = 0
+        try:
+            while True:
+                flushed = flush_comments(batch_size)
+                if flushed is None:
+                    self.stdout.write(self.style.WARNING("Another worker is flushing the comments"))
+                elif options["verbosity"] > 1 and flushed:
+                    self.stdout.write(f"Flushed {flushed} comments, {queued_comments()} queued")
+                processed += flushed or 0
+                # A full batch: there may be more comments waiting
+                if flushed == batch_size:
+                    continue
+                if not options["watch"]:
+                    break
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f"Flushed {processed} queued comments."))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blog.cache import invalidate_sidebar
+from blog.models import Post, recount_comments
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized comment_count of every post from the comments table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            type=int,
+            help="Number of posts updated per transaction.",
+            default=10000,
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            self.stdout.write(self.style.ERROR("Batch size must be greater or equal to 1"))
+            return
+
+        updated = 0
+        last_id = 0
+        # Walk the primary key in ranges so that each UPDATE (and its row locks) stays small
+        while True:
+            ids = list(
+                Post.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                updated += recount_comments(Post.objects.filter(pk__gte=ids[0], pk__lte=ids[-1]))
+            last_id = ids[-1]
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Recounted comments of {updated} posts")
+
+        invalidate_sidebar()
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully recounted comments of {updated} posts.")
+        )
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.outbox import claim_emails, send_emails
+
+
+class Command(BaseCommand):
+    help = "Send the emails queued in the outbox (e.g. by post_share), retrying failed ones with backoff"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            type=int,
+            help="Number of emails sent over each connection of the email backend.",
+            default=100,
+        )
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="Keep running and poll the outbox for new emails (stop with Ctrl+C).",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Seconds between polls of the outbox with --watch.",
+            default=5.0,
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            self.stdout.write(self.style.ERROR("Batch size must be greater or equal to 1"))
+            return
+
+        total_sent = total_failed = 0
+        try:
+            while True:
+                emails = claim_emails(batch_size)
+                if emails:
+                    sent, failed = send_emails(emails)
+                    total_sent += sent
+                    total_failed += failed
+                    if options["verbosity"] > 1:
+                        self.stdout.write(f"Sent {sent} emails, {failed} failed")
+                elif options["watch"]:
+                    time.sleep(options["interval"])
+                else:
+                    break
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Sent {total_sent} emails ({total_failed} failed attempts).")
+        )
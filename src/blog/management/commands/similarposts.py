@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Post
+from blog.similarity import refresh_similar_posts
+
+
+class Command(BaseCommand):
+    help = "Recompute the precomputed similar posts of every post"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            type=int,
+            help="Number of posts recomputed per transaction.",
+            default=1000,
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            self.stdout.write(self.style.ERROR("Batch size must be greater or equal to 1"))
+            return
+
+        processed = 0
+        last_id = 0
+        # Each batch is a range of ids ranked inside the database: memory doesn't grow with the number of posts
+        while True:
+            ids = list(
+                Post.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            refresh_similar_posts(ids[0], ids[-1])
+            processed += len(ids)
+            last_id = ids[-1]
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Recomputed similar posts of {processed} posts")
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully recomputed similar posts of {processed} posts.")
+        )
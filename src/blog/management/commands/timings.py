@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.checks import shared_cache
+from blog.middleware import reset_timings, timing_summary
+
+
+class Command(BaseCommand):
+    help = "Show the p50/p95 latency, SQL time and queries of each view measured by RequestTimingMiddleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Delete the collected samples.")
+
+    def handle(self, *args, **options):
+        # NOTE: the samples are in the cache of the server processes, this process only sees a shared cache
+        if not shared_cache():
+            raise CommandError(
+                "The cache is per process, the samples of the server can't be read from here: set "
+                "CACHE_REDIS_URL, or see the Request timings page of the admin (/admin/timings/)"
+            )
+        if options["reset"]:
+            reset_timings()
+            self.stdout.write(self.style.SUCCESS("Timings deleted"))
+            return
+
+        summary = timing_summary()
+        if not summary:
+            self.stdout.write("No requests measured yet (see BLOG_TIMING_SAMPLE_RATE)")
+            return
+
+        self.stdout.write(
+            f"{'view':<30} {'samples':>8} {'p50':>10} {'p95':>10} {'sql p50':>10} {'sql p95':>10}"
+            f" {'queries':>8} {'dups':>6}"
+        )
+        for view_name, row in summary.items():
+            self.stdout.write(
+                f"{view_name:<30} {row['samples']:>8} {row['p50_ms']:>8.2f}ms {row['p95_ms']:>8.2f}ms"
+                f" {row['db_p50_ms']:>8.2f}ms {row['db_p95_ms']:>8.2f}ms"
+                f" {row['queries']:>8.1f} {row['duplicates']:>6.1f}"
+            )
@@ -0,0 +1,279 @@
+"""
+Request instrumentation: number of queries, SQL time, duplicated queries and total time of each request.
+
+A sample of the requests (settings.BLOG_TIMING_SAMPLE_RATE) is measured with a DB execute wrapper, the results
+are sent to the client as a Server-Timing header (shown by the browser dev tools, next to the request) and counted
+in the cache so that every process/worker contributes to the summary:
+    ./manage.py timings
+Each request increments the counters of its view (cache.incr(), atomic: concurrent requests don't lose samples)
+for the current window of settings.BLOG_TIMING_WINDOW seconds: its number of queries and duplicates, and one
+bucket of its total time and one of its SQL time, from which the p50/p95 are estimated.
+"""
+
+import bisect
+import random
+import statistics
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .routers import finish_request, start_request
+
+TIMING_VIEWS_KEY = "blog:timing:views"
+# Upper bounds (ms) of the time buckets, from 0.5ms to 44s: each one is 25% above the previous one, the
+# percentiles are estimated within 25%. Longer requests are counted in the last bucket
+TIMING_BUCKETS = [round(0.5 * 1.25**i, 2) for i in range(52)]
+TIMING_COUNTERS = [
+    "queries",
+    "duplicates",
+    *(f"total:{bucket}" for bucket in range(len(TIMING_BUCKETS))),
+    *(f"db:{bucket}" for bucket in range(len(TIMING_BUCKETS))),
+]
+
+
+def timing_key(view_name: str, window: int, counter: str) -> str:
+    return f"blog:timing:{window}:{view_name}:{counter}"
+
+
+def timing_window() -> int:
+    return int(time.time()) // settings.BLOG_TIMING_WINDOW
+
+
+class QueryStats:
+    """DB execute wrapper counting the queries, their time and the queries repeated with the same parameters"""
+
+    def __init__(self):
+        self.count = 0
+        self.duplicates = 0
+        self.duration = 0.0
+        self._seen = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            key = (sql, str(params))
+            if key in self._seen:
+                self.duplicates += 1
+            else:
+                self._seen.add(key)
+
+
+class RequestTimingMiddleware:
+    """
+    Measure a sample of the requests. Must be the first middleware to include the time of the others.
+    NOTE: the time of a streaming response (e.g. sitemap shards) doesn't include sending its content
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Under ASGI with async views the whole chain is async: don't make Django adapt this middleware
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if random.random() >= settings.BLOG_TIMING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        stats = QueryStats()
+        start = time.perf_counter()
+        # NOTE: wrappers are only installed for the duration of this request, unsampled requests pay nothing
+        with wrap_connections(stats):
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+        self.add_timing(response, stats, total)
+        if request.resolver_match is not None:
+            record_timing(request.resolver_match.view_name, total, stats)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= settings.BLOG_TIMING_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        stats = QueryStats()
+        start = time.perf_counter()
+        # NOTE: connections belong to a thread: the async ORM runs the queries of the request in the thread of
+        # sync_to_async(thread_sensitive=True), so the wrappers are installed (and removed) from that thread
+        wrappers = await sync_to_async(wrap_connections)(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrappers.close)()
+        total = time.perf_counter() - start
+        self.add_timing(response, stats, total)
+        if request.resolver_match is not None:
+            await arecord_timing(request.resolver_match.view_name, total, stats)
+        return response
+
+    def add_timing(self, response, stats: QueryStats, total: float):
+        response["Server-Timing"] = ", ".join(
+            [
+                f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries, {stats.duplicates} duplicated"',
+                f"app;dur={(total - stats.duration) * 1000:.1f}",
+                f"total;dur={total * 1000:.1f}",
+            ]
+        )
+
+
+class ReplicaMiddleware:
+    """Send the reads of public GET/HEAD requests to the read replicas (see routers.py)"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = start_request(request)
+        response = self.get_response(request)
+        finish_request(state, response)
+        return response
+
+    async def __acall__(self, request):
+        state = start_request(request)
+        response = await self.get_response(request)
+        finish_request(state, response)
+        return response
+
+
+def wrap_connections(stats: QueryStats) -> ExitStack:
+    """Install `stats` as execute wrapper of all the connections of the current thread until the stack is closed"""
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(stats))
+    return stack
+
+
+def timing_increments(view_name: str, total: float, stats: QueryStats) -> dict[str, int]:
+    """The counters of the current window incremented by a measured request"""
+    window = timing_window()
+    counters = {
+        "queries": stats.count,
+        "duplicates": stats.duplicates,
+        f"total:{time_bucket(total)}": 1,
+        f"db:{time_bucket(stats.duration)}": 1,
+    }
+    return {timing_key(view_name, window, counter): n for counter, n in counters.items() if n}
+
+
+def time_bucket(seconds: float) -> int:
+    return min(bisect.bisect_left(TIMING_BUCKETS, seconds * 1000), len(TIMING_BUCKETS) - 1)
+
+
+def record_timing(view_name: str, total: float, stats: QueryStats):
+    """Count a measured request in the counters of its view"""
+    for key, n in timing_increments(view_name, total, stats).items():
+        try:
+            cache.incr(key, n)
+        except ValueError:
+            # First request of the window: add() fails if a concurrent request just created the counter
+            if not cache.add(key, n, timeout=settings.BLOG_TIMING_WINDOW * 2):
+                cache.incr(key, n)
+    views = cache.get(TIMING_VIEWS_KEY, set())
+    if view_name not in views:
+        # NOTE: the first requests of two views may overwrite each other: the next request adds the view back
+        cache.set(TIMING_VIEWS_KEY, views | {view_name}, timeout=None)
+
+
+async def arecord_timing(view_name: str, total: float, stats: QueryStats):
+    for key, n in timing_increments(view_name, total, stats).items():
+        try:
+            await cache.aincr(key, n)
+        except ValueError:
+            if not await cache.aadd(key, n, timeout=settings.BLOG_TIMING_WINDOW * 2):
+                await cache.aincr(key, n)
+    views = await cache.aget(TIMING_VIEWS_KEY, set())
+    if view_name not in views:
+        await cache.aset(TIMING_VIEWS_KEY, views | {view_name}, timeout=None)
+
+
+def timing_summary() -> dict[str, dict[str, float]]:
+    """
+    p50/p95 of the total and SQL time (ms), average queries and duplicates for each measured view, over the
+    current and the previous window
+    """
+    views = sorted(cache.get(TIMING_VIEWS_KEY, set()))
+    windows = [timing_window() - 1, timing_window()]
+    counts = cache.get_many(
+        [
+            timing_key(view_name, window, counter)
+            for view_name in views
+            for window in windows
+            for counter in TIMING_COUNTERS
+        ]
+    )
+    summary = {}
+    for view_name in views:
+        count = {
+            counter: sum(
+                counts.get(timing_key(view_name, window, counter), 0) for window in windows
+            )
+            for counter in TIMING_COUNTERS
+        }
+        totals = [count[f"total:{bucket}"] for bucket in range(len(TIMING_BUCKETS))]
+        db_times = [count[f"db:{bucket}"] for bucket in range(len(TIMING_BUCKETS))]
+        samples = sum(totals)
+        if not samples:
+            continue
+        summary[view_name] = {
+            "samples": samples,
+            "p50_ms": histogram_percentile(totals, 50),
+            "p95_ms": histogram_percentile(totals, 95),
+            "db_p50_ms": histogram_percentile(db_times, 50),
+            "db_p95_ms": histogram_percentile(db_times, 95),
+            "queries": count["queries"] / samples,
+            "duplicates": count["duplicates"] / samples,
+        }
+    return summary
+
+
+def reset_timings():
+    views = cache.get(TIMING_VIEWS_KEY, set())
+    window = timing_window()
+    cache.delete_many(
+        [
+            TIMING_VIEWS_KEY,
+            *(
+                timing_key(view_name, window, counter)
+                for view_name in views
+                for window in [window - 1, window]
+                for counter in TIMING_COUNTERS
+            ),
+        ]
+    )
+
+
+def histogram_percentile(histogram: list[int], percent: int) -> float:
+    """Percentile of the times counted in the TIMING_BUCKETS: the upper bound of the bucket it falls in"""
+    rank = sum(histogram) * percent / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS, histogram, strict=True):
+        seen += count
+        if seen >= rank:
+            return bound
+    return TIMING_BUCKETS[-1]
+
+
+def percentile(values, percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0006_post_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['title'], name='blog_post_title_trgm_idx', opclasses=['gist_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_post_title_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        # Backfill with the number of active comments of each post
+        migrations.RunSQL(
+            sql="""
+            UPDATE blog_post SET comment_count = (
+                SELECT COUNT(*) FROM blog_comment WHERE blog_comment.post_id = blog_post.id AND blog_comment.active
+            )
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('status', 'PB')), fields=['-comment_count'], name='blog_post_most_commented_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:28
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+from django.db.models import Count, Min
+from django.db.models.functions import TruncDate
+
+
+def deduplicate_slugs(apps, schema_editor):
+    """Add the id to the slugs repeated on the same date (e.g. fake.slug() in addposts) so the constraint can be created"""
+    Post = apps.get_model("blog", "Post")
+    duplicates = (
+        Post.objects.values("slug", date=TruncDate("publish"))
+        .annotate(n=Count("id"), first_id=Min("id"))
+        .filter(n__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        posts = Post.objects.annotate(date=TruncDate("publish")).filter(slug=duplicate["slug"], date=duplicate["date"])
+        for post in posts.exclude(id=duplicate["first_id"]):
+            suffix = f"-{post.id}"
+            Post.objects.filter(id=post.id).update(slug=post.slug[: 250 - len(suffix)] + suffix)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_similarpost'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='slug',
+            field=models.SlugField(db_index=False, max_length=250, unique_for_date='publish'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['slug', 'publish'], name='blog_post_slug_publish_idx'),
+        ),
+        migrations.RunPython(deduplicate_slugs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='post',
+            constraint=models.UniqueConstraint(models.F('slug'), django.db.models.functions.datetime.TruncDate('publish'), name='blog_post_unique_slug_publish_date'),
+        ),
+    ]
@@ -1,12 +1,65 @@
+from datetime import date, datetime, time, timedelta
+from functools import partial
+
 from django.conf import settings
-from django.db import models
-from django.db.models.functions import Now
-from django.urls import reverse
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+    TrigramDistance,
+    TrigramSimilarity,
+)
+from django.db import connections, models, router, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Now, TruncDate  # noqa: F401 (Now: see Post.publish)
 from django.utils import timezone
+from django.utils.functional import cached_property
 from taggit.managers import TaggableManager
 
+from .cache import get_post_html
+from .urlbuilders import post_detail_url
+
+# Text search configuration used both to build the stored vector and to parse search queries.
+# NOTE: it must be explicit (not the server default) so that the generated column expression is IMMUTABLE
+SEARCH_CONFIG = "english"
+
+
+def delete_comments_of(post_ids, using: str) -> int:
+    """
+    Delete the comments of the given posts with a single DELETE, returns the number of comments deleted.
+    NOTE: the CASCADE would load every comment and send its post_delete signals (comment counts, caches...),
+    all of them pointless when the post goes too. Its own delete signals already touch its pages and the sidebar.
+    Comment.objects.filter(...).delete() would do the same (the receivers disable its fast delete): raw SQL
+    """
+    quote_name = connections[using].ops.quote_name
+    table, column = Comment._meta.db_table, Comment._meta.get_field("post").column
+    sql = f"DELETE FROM {quote_name(table)} WHERE {quote_name(column)} = ANY(%s)"
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [list(post_ids)])
+        return cursor.rowcount
+
+
+def delete_with_comments(delete, post_ids, using: str) -> tuple[int, dict[str, int]]:
+    """Call delete() (of a post or of a Post queryset) after deleting the comments of its posts in bulk"""
+    with transaction.atomic(using=using):
+        comments = delete_comments_of(post_ids, using)
+        deleted, per_model = delete()
+    if comments:
+        per_model[Comment._meta.label] = comments
+    return deleted + comments, per_model
 
-class PublishedManager(models.Manager):
+
+class PostQuerySet(models.QuerySet):
+    def delete(self):
+        # NOTE: self.db is the database to read from (maybe a replica), QuerySet.delete() writes to this one
+        using = self._db or router.db_for_write(self.model)
+        post_ids = self.using(using).order_by().values_list("pk", flat=True)
+        return delete_with_comments(super().delete, post_ids, using)
+
+
+class PublishedManager(models.Manager.from_queryset(PostQuerySet)):
     def get_queryset(self):
         return super().get_queryset().filter(status=Post.Status.PUBLISHED)  # notice "Status" because it's the enum!
 
@@ -14,11 +67,62 @@ class PublishedManager(models.Manager):
         """Use with Post.published.not_published()"""
         return super().get_queryset().exclude(status=Post.Status.DRAFT)
 
+    def on_date(self, year: int, month: int, day: int):
+        """
+        Posts published on a day (in the current time zone): Post.published.on_date(2025, 1, 31)
+        NOTE: publish__year/month/day compile to EXTRACT(... AT TIME ZONE ...) which can't use an index on publish,
+        a half-open range [day, next day) can. Raises ValueError for invalid dates
+        """
+        day_start = datetime.combine(date(year, month, day), time.min, tzinfo=timezone.get_current_timezone())
+        next_day_start = datetime.combine(day_start.date() + timedelta(days=1), time.min, tzinfo=day_start.tzinfo)
+        return self.get_queryset().filter(publish__gte=day_start, publish__lt=next_day_start)
+
+    def search(self, query: str, min_rank: float = 0.3):
+        """Full-text search ranked by relevance: Post.published.search("django")"""
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return (
+            self.get_queryset()
+            # "search_vector @@ query" is answered by the GIN index, so only matching rows are ranked
+            .filter(search_vector=search_query)
+            # NOTE: F() ranks the stored vector. A plain "search_vector" string would be wrapped in SearchVector(),
+            # i.e. to_tsvector(search_vector::text), which loses the A/B weights
+            .annotate(rank=SearchRank(F("search_vector"), search_query))
+            .filter(rank__gte=min_rank)
+            # "id" breaks ties between equal ranks so that pages of results are stable
+            .order_by("-rank", "-id")
+        )
+
+    def trigram_similar(self, query: str, limit: int | None = None):
+        """
+        The `limit` titles closest to `query` among those more similar than pg_trgm.similarity_threshold (a
+        setting of the DB session, default 0.3). Use trigram_search() to fetch them with another threshold
+        """
+        return (
+            # "title % query" and the KNN ordering "title <-> query" are both answered by the GiST trigram index
+            # (filtering on TrigramSimilarity(...) > x instead would compute the similarity of every row)
+            self.get_queryset()
+            .filter(title__trigram_similar=query)
+            .annotate(similarity=TrigramSimilarity("title", query))
+            .order_by(TrigramDistance("title", query))[: limit or settings.BLOG_TRIGRAM_RESULTS]
+        )
+
+    def trigram_search(self, query: str, threshold: float | None = None, limit: int | None = None) -> list["Post"]:
+        """Fuzzy title search, the `limit` closest titles first: Post.published.trigram_search("djnago")"""
+        threshold = threshold if threshold is not None else settings.BLOG_TRIGRAM_SIMILARITY_THRESHOLD
+        queryset = self.trigram_similar(query, limit)
+        # NOTE: the threshold of the "%" operator is set with is_local=true, i.e. only for the transaction the posts
+        # are fetched in: it never leaks into the later queries of a persistent (or pooled) connection.
+        # The router is asked once (it may pick another replica every time) and the queryset is bound to its answer
+        alias = queryset.db
+        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(threshold)])
+            return list(queryset.using(alias))
+
 
 # IMPORTANT: an index will be created on "author_id", "slug" and also "publish" columns!
 class Post(models.Model):
     # FIRST DECLARED MANAGER WILL BE THE DEFAULT ONE!
-    objects = models.Manager()  # DEFAULT MANAGER NEEDS TO BE DECLARED IF WE HAVE MORE!
+    objects = PostQuerySet.as_manager()  # DEFAULT MANAGER NEEDS TO BE DECLARED IF WE HAVE MORE!
     published = PublishedManager()  # INSTANTIATE THE MANAGER
 
     class Status(models.TextChoices):
@@ -29,9 +133,10 @@ class Post(models.Model):
 
     title = models.CharField(max_length=250)  # VARCHAR
     # VARCHAR with only letters, numbers, hyphens and underscores
-    slug = models.SlugField(max_length=250, unique_for_date="publish")  # will create INDEX by default
+    # NOTE: no index of its own (db_index=False), the (slug, publish) index below starts with the slug
+    slug = models.SlugField(max_length=250, unique_for_date="publish", db_index=False)
     # slug must be unique for each "publish" DATE (only date?) to be able to build a url like /yyyy/mm/dd/slug
-    # NOTE: this is enforced in django, not in the DB. But migration will copy all table data to enforce uniqueness
+    # NOTE: unique_for_date is only validated by Django (forms), the UniqueConstraint in Meta enforces it in the DB
     # Can also use primary-key=True for this one
 
     # add null=True (and blank=True ???) to allow anonymous users to create snippets as well
@@ -50,6 +155,19 @@ class Post(models.Model):
     updated = models.DateTimeField(auto_now=True)  # DATETIME
     status = models.CharField(max_length=2, choices=Status, default=Status.DRAFT)
 
+    # Weighted lexemes of title (A) and body (B), computed by PostgreSQL itself (GENERATED ALWAYS AS ... STORED)
+    # NOTE: the DB keeps it current on every INSERT/UPDATE, including bulk_create() and raw COPY
+    search_vector = models.GeneratedField(
+        expression=SearchVector("title", weight="A", config=SEARCH_CONFIG)
+        + SearchVector("body", weight="B", config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    # Number of ACTIVE comments. Denormalized so that reads don't have to count comment rows
+    # NOTE: maintained with UPDATE ... SET comment_count = comment_count + 1 (see signals.py and CommentQuerySet)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
     tags = TaggableManager()
     # TAGS TABLE: id (pk), name, slug
     # TAGGEDITEM TABLE: id, tag (fk), content_type (fk), object_id (int)
@@ -60,7 +178,25 @@ class Post(models.Model):
     class Meta:
         ordering = ["-publish"]  # latest posts first
         # NOTE: order applies by default to QuerySet unless an explicit order_by() is used
-        indexes = [models.Index(fields=["-publish"])]
+        indexes = [
+            # Ordering of Post.objects (admin, drafts...)
+            models.Index(fields=["-publish"]),
+            # Partial index for PublishedManager queries (post lists, feed, sidebar, sitemap, keyset pagination):
+            # smaller than the full index and ordered like ORDER BY publish DESC, id DESC. "PB" = Status.PUBLISHED
+            models.Index(fields=["-publish", "-id"], condition=Q(status="PB"), name="blog_post_published_idx"),
+            # GIN index makes "search_vector @@ query" an index scan instead of re-parsing every body
+            GinIndex(fields=["search_vector"]),
+            # Trigram index for fuzzy title search. GiST (unlike GIN) also supports KNN ordering by distance "<->"
+            GistIndex(fields=["title"], name="blog_post_title_trgm_idx", opclasses=["gist_trgm_ops"]),
+            # "Most commented posts" reads this index instead of aggregating all the comments
+            models.Index(fields=["-comment_count"], condition=Q(status="PB"), name="blog_post_most_commented_idx"),
+            # post_detail: "slug = x AND publish >= day AND publish < next day" is a single index probe
+            models.Index(fields=["slug", "publish"], name="blog_post_slug_publish_idx"),
+        ]
+        constraints = [
+            # unique_for_date="publish" in the DB (the date in the TIME_ZONE setting, as publish__date lookups)
+            models.UniqueConstraint(F("slug"), TruncDate("publish"), name="blog_post_unique_slug_publish_date"),
+        ]
         # db_table = "custom_table_name"
         # Specify which manager will be the default one (for objects, django admin, serialization...)
         # default_manager_name = "published"
@@ -68,10 +204,80 @@ class Post(models.Model):
     def __str__(self):
         return self.title  # for Django-admin
 
+    def save(self, *args, **kwargs):
+        # comment_count is only changed with F() updates: never overwrite it with the (maybe stale) loaded value
+        if not self._state.adding and self.pk is not None and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and not field.generated and field.name != "comment_count"
+            ]
+        super().save(*args, **kwargs)
+
+    def delete(self, using=None, keep_parents=False):
+        # Comments go first, in bulk (see delete_comments_of)
+        using = using or router.db_for_write(Post, instance=self)
+        delete = partial(super().delete, using=using, keep_parents=keep_parents)
+        return delete_with_comments(delete, [self.pk], using)
+
+    # Markdown is rendered once per version of the post (see cache.py), not on every page that shows it
+    @cached_property
+    def body_html(self):
+        return get_post_html(self)[0]
+
+    @cached_property
+    def excerpt_html(self):
+        """The first words of body_html (HTML tags are kept balanced)"""
+        return get_post_html(self)[1]
+
     def get_absolute_url(self):
         # This will build the URL dynamically using the urlpatterns
         # return reverse("blog:post_detail", args=[self.id])
-        return reverse("blog:post_detail", args=[self.publish.year, self.publish.month, self.publish.day, self.slug])
+        # return reverse("blog:post_detail", args=[self.publish.year, self.publish.month, self.publish.day, self.slug])
+        # NOTE: same URL as reverse() but without resolving the pattern for every post (see urlbuilders.py)
+        return post_detail_url(self.publish.year, self.publish.month, self.publish.day, self.slug)
+
+
+def adjust_comment_counts(deltas: dict[int, int]):
+    """Add {post_id: delta} to Post.comment_count. F() makes the database do the addition (no lost updates)"""
+    for post_id, delta in deltas.items():
+        if delta:
+            Post.objects.filter(pk=post_id).update(comment_count=F("comment_count") + delta)
+
+
+def recount_comments(posts):
+    """Recompute comment_count of a Post queryset from the comments table in a single UPDATE"""
+    active_comments = (
+        Comment.objects.filter(post=OuterRef("pk"), active=True).order_by().values("post").annotate(n=Count("pk"))
+    )
+    return posts.update(comment_count=Coalesce(Subquery(active_comments.values("n")), 0))
+
+
+class CommentQuerySet(models.QuerySet):
+    # NOTE: QuerySet.update() doesn't send signals, so these keep Post.comment_count in sync themselves
+    # NOTE: nor does it set auto_now fields: `updated` is set explicitly (incremental exports read it)
+
+    def deactivate(self):
+        with transaction.atomic():
+            active = self.filter(active=True).order_by().values_list("post").annotate(n=Count("pk"))
+            deltas = {post_id: -n for post_id, n in active}
+            updated = self.update(active=False, updated=timezone.now())
+            adjust_comment_counts(deltas)
+        return updated
+
+    def toggle_active(self):
+        with transaction.atomic():
+            # inactive comments become active (+1) and active ones inactive (-1)
+            changes = (
+                self.order_by()
+                .values_list("post")
+                .annotate(delta=Count("pk", filter=Q(active=False)) - Count("pk", filter=Q(active=True)))
+            )
+            deltas = dict(changes)
+            # NOTE: "F" expressions allow to reference a model field to make operations without having to fetch them
+            updated = self.update(active=~F("active"), updated=timezone.now())
+            adjust_comment_counts(deltas)
+        return updated
 
 
 class Comment(models.Model):
@@ -87,11 +293,64 @@ class Comment(models.Model):
     updated = models.DateTimeField(auto_now=True)
     active = models.BooleanField(default=True)  # useful for censorship
 
+    objects = CommentQuerySet.as_manager()
+
     class Meta:
         ordering = ["created"]  # oldest first?
         indexes = [
             models.Index(fields=["created"]),
+            # post.comments.filter(active=True) ordered by created (post_detail) and the active comment counts
+            models.Index(fields=["post", "created"], condition=Q(active=True), name="blog_comment_active_idx"),
         ]  # post_id index is automatically created!
 
     def __str__(self):
         return f"Comment by {self.name} on post {self.post}"  # self.post uses __str__ !
+
+
+class SimilarPost(models.Model):
+    """One of the precomputed similar posts of a post (see similarity.py)"""
+
+    # NOTE: no index for "post" alone, the unique constraint (post, rank) already starts with post_id
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="similar_post_links", db_index=False)
+    # Post.published.filter(similar_in__post=post) are the posts similar to "post"
+    similar = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="similar_in")
+    same_tags = models.PositiveIntegerField()  # number of tags in common
+    rank = models.PositiveSmallIntegerField()  # 0 is the most similar
+
+    class Meta:
+        ordering = ["post", "rank"]
+        constraints = [models.UniqueConstraint(fields=["post", "rank"], name="blog_similarpost_post_rank_uniq")]
+
+    def __str__(self):
+        return f"{self.similar} is similar to {self.post} (#{self.rank + 1})"
+
+
+class OutgoingEmail(models.Model):
+    """An email waiting to be sent by ./manage.py sendemails (see outbox.py)"""
+
+    class Status(models.TextChoices):
+        PENDING = "PD", "Pending"
+        SENT = "ST", "Sent"
+        FAILED = "FL", "Failed"  # gave up after settings.BLOG_EMAIL_MAX_ATTEMPTS
+
+    subject = models.CharField(max_length=998)  # maximum line length of an email header
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)  # empty: settings.DEFAULT_FROM_EMAIL
+    recipients = models.JSONField()  # list of addresses
+    status = models.CharField(max_length=2, choices=Status, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When the email can be (re)tried. Also pushed forward while a worker is sending it, see outbox.claim_emails()
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created"]
+        indexes = [
+            # The queue: pending emails by due time. Sent and failed emails stay out of the index. "PD" = PENDING
+            models.Index(fields=["next_attempt"], condition=Q(status="PD"), name="blog_email_pending_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients)} ({self.get_status_display()})"
@@ -0,0 +1,108 @@
+"""
+Outbox of emails: views queue them with queue_mail() (one INSERT) and ``./manage.py sendemails`` delivers them.
+
+The request no longer waits for the SMTP round trips (connect, TLS, login, DATA...) nor fails when the server
+is down. The worker sends each batch of emails over a single connection of settings.EMAIL_BACKEND, and retries
+failed emails with exponential backoff. Any email backend works (locmem in the tests, console or filebased in
+development): there is no broker, the queue is the OutgoingEmail table.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+# Longest wait between 2 attempts of an email
+MAX_RETRY_DELAY = timedelta(hours=6)
+
+
+def queue_mail(
+    subject: str, message: str, recipient_list: list[str], from_email: str | None = None
+):
+    """Like send_mail(), but the email is sent later by the sendemails command"""
+    return OutgoingEmail.objects.create(
+        subject=subject, body=message, from_email=from_email or "", recipients=list(recipient_list)
+    )
+
+
+def claim_emails(batch_size: int) -> list[OutgoingEmail]:
+    """
+    Take up to `batch_size` due emails, oldest first. They are leased for settings.BLOG_EMAIL_LEASE seconds:
+    other workers skip them meanwhile, and if this worker dies they are retried once the lease expires
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # NOTE: SKIP LOCKED lets concurrent workers claim different emails instead of waiting for each other
+        emails = list(
+            OutgoingEmail.objects.filter(status=OutgoingEmail.Status.PENDING, next_attempt__lte=now)
+            .order_by("next_attempt")
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt=now + timedelta(seconds=settings.BLOG_EMAIL_LEASE)
+        )
+    return emails
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """settings.BLOG_EMAIL_RETRY_DELAY seconds after the first failed attempt, doubled after each one"""
+    return min(
+        timedelta(seconds=settings.BLOG_EMAIL_RETRY_DELAY * 2 ** (attempts - 1)), MAX_RETRY_DELAY
+    )
+
+
+def send_emails(emails: list[OutgoingEmail], connection=None) -> tuple[int, int]:
+    """Send claimed emails over one connection of the email backend. Returns (sent, failed)"""
+    connection = connection or get_connection()
+    sent = failed = 0
+    # Opened once for the whole batch (SMTP: a single connect, TLS handshake and login)
+    # NOTE: opened in the loop, so that a server that can't be reached counts as a failed attempt of the email
+    reopen = True
+    try:
+        for email in emails:
+            message = EmailMessage(
+                email.subject,
+                email.body,
+                email.from_email or None,
+                email.recipients,
+                connection=connection,
+            )
+            try:
+                if reopen:
+                    connection.open()
+                    reopen = False
+                message.send()
+            except Exception as error:  # noqa: BLE001 SMTPException, OSError (connection refused, timeouts)...
+                email_failed(email, error)
+                failed += 1
+                # The connection may be broken: start a new one for the rest of the batch
+                connection.close()
+                reopen = True
+            else:
+                # NOTE: marked one by one, a worker dying mid-batch resends as few emails as possible
+                OutgoingEmail.objects.filter(pk=email.pk).update(
+                    status=OutgoingEmail.Status.SENT,
+                    sent=timezone.now(),
+                    attempts=F("attempts") + 1,
+                    last_error="",
+                )
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def email_failed(email: OutgoingEmail, error: Exception):
+    """Schedule the next attempt of an email, or give up after settings.BLOG_EMAIL_MAX_ATTEMPTS"""
+    attempts = email.attempts + 1
+    changes = {"attempts": attempts, "last_error": f"{type(error).__name__}: {error}"}
+    if attempts >= settings.BLOG_EMAIL_MAX_ATTEMPTS:
+        changes["status"] = OutgoingEmail.Status.FAILED
+    else:
+        changes["next_attempt"] = timezone.now() + retry_delay(attempts)
+    OutgoingEmail.objects.filter(pk=email.pk).update(**changes)
@@ -0,0 +1,180 @@
+import base64
+import binascii
+import json
+from collections.abc import Sequence
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+
+
+class KeysetPage(Sequence):
+    """One page of a KeysetPaginator. Iterates like django.core.paginator.Page"""
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f"<KeysetPage of {len(self)} objects>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Cursor ("keyset" or "seek") pagination. Instead of OFFSET and COUNT(*) each page is fetched with:
+        WHERE (publish, id) < (<last publish>, <last id>) ORDER BY publish DESC, id DESC LIMIT per_page
+    so page 10000 costs the same as page 1 when the first key is indexed (e.g. the "-publish" index of Post).
+
+    Cursors are opaque strings with the key values of the first/last object of a page:
+        paginator.page(after=request.GET.get("after"), before=request.GET.get("before"))
+    """
+
+    # Template used to render the previous/next links
+    template_name = "keyset_pagination.html"
+
+    def __init__(
+        self, queryset: QuerySet, per_page: int, ordering: Sequence[str] = ("-publish", "-id")
+    ):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+        # (field name, descending?) for each key
+        self.keys = [(field.removeprefix("-"), field.startswith("-")) for field in self.ordering]
+
+    def page(self, after: str | None = None, before: str | None = None) -> KeysetPage:
+        """Page following the `after` cursor or preceding the `before` cursor. First page if none (or invalid)"""
+        queryset, after_values, before_values = self._page_queryset(after, before)
+        return self._make_page(list(queryset), after_values, before_values)
+
+    async def apage(self, after: str | None = None, before: str | None = None) -> KeysetPage:
+        """page() for async views"""
+        queryset, after_values, before_values = self._page_queryset(after, before)
+        return self._make_page([obj async for obj in queryset], after_values, before_values)
+
+    def _page_queryset(self, after: str | None, before: str | None):
+        after_values = self.decode_cursor(after)
+        before_values = self.decode_cursor(before) if after_values is None else None
+
+        if before_values is not None:
+            # Walk backwards (reversed ordering), _make_page() flips the results back
+            queryset = self.queryset.filter(self._seek(before_values, forward=False)).order_by(
+                *[self._reversed(field) for field in self.ordering]
+            )
+        else:
+            queryset = self.queryset.order_by(*self.ordering)
+            if after_values is not None:
+                queryset = queryset.filter(self._seek(after_values, forward=True))
+        # 1 extra object tells us if there are more pages
+        return queryset[: self.per_page + 1], after_values, before_values
+
+    def _make_page(self, objects: list, after_values, before_values) -> KeysetPage:
+        if before_values is not None:
+            has_previous = len(objects) > self.per_page
+            objects = objects[: self.per_page][::-1]
+            has_next = True
+        else:
+            has_next = len(objects) > self.per_page
+            objects = objects[: self.per_page]
+            has_previous = after_values is not None
+
+        return KeysetPage(
+            objects,
+            self,
+            next_cursor=self.encode_cursor(objects[-1]) if has_next and objects else None,
+            previous_cursor=self.encode_cursor(objects[0]) if has_previous and objects else None,
+        )
+
+    def encode_cursor(self, obj) -> str:
+        opts = self.queryset.model._meta
+        values = [opts.get_field(name).value_to_string(obj) for name, _ in self.keys]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor: str | None) -> list | None:
+        """Key values stored in the cursor or None if it's missing or can't be parsed"""
+        if not cursor:
+            return None
+        opts = self.queryset.model._meta
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.keys):
+                return None
+            return [
+                opts.get_field(name).to_python(value) for (name, _), value in zip(self.keys, values)
+            ]
+        except (binascii.Error, ValueError, TypeError, ValidationError):
+            return None
+
+    def _seek(self, values: list, forward: bool) -> Q:
+        """Rows strictly after (forward) or before the given key values, in the paginator ordering"""
+        # Lexicographic comparison: k1 < v1 OR (k1 = v1 AND k2 < v2) OR ...
+        condition = Q()
+        for i, (name, descending) in enumerate(self.keys):
+            lookup = "lt" if descending == forward else "gt"
+            equal = {key: value for (key, _), value in zip(self.keys[:i], values[:i])}
+            condition |= Q(**equal, **{f"{name}__{lookup}": values[i]})
+        # Redundant bound on the first key only, so the database can use it as an index condition
+        first_name, first_descending = self.keys[0]
+        first_lookup = "lte" if first_descending == forward else "gte"
+        return Q(**{f"{first_name}__{first_lookup}": values[0]}) & condition
+
+    @staticmethod
+    def _reversed(field: str) -> str:
+        return field.removeprefix("-") if field.startswith("-") else f"-{field}"
+
+
+async def aget_page(paginator: Paginator, number) -> Page:
+    """Paginator.get_page() for async views: the COUNT(*) and the objects are fetched with the async ORM"""
+    if not isinstance(paginator.object_list, QuerySet):
+        # Already fetched (e.g. the results of trigram_search())
+        return paginator.get_page(number)
+    # NOTE: count is a cached_property, setting it skips the sync COUNT(*) of the paginator
+    paginator.count = await paginator.object_list.acount()
+    page = paginator.get_page(number)
+    page.object_list = [obj async for obj in page.object_list]
+    return page
+
+
+def estimated_count(queryset: QuerySet) -> int:
+    """Number of rows the PostgreSQL planner expects the queryset to return (EXPLAIN: the query isn't run)"""
+    # NOTE: the estimates come from the table statistics (ANALYZE, autovacuum): they can be far off for
+    # complex filters, but are right within a few percent for a whole table
+    plan = json.loads(queryset.order_by().explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for big tables (e.g. the admin changelists): COUNT(*) reads every row that matches, so with
+    millions of rows it's slower than fetching the page itself. Instead, the count is the planner's estimate
+    when it's above settings.BLOG_ADMIN_EXACT_COUNT_LIMIT (smaller results are counted exactly).
+
+    The number of pages is approximate then: the last pages may be empty or a few pages may be missing
+    """
+
+    @cached_property
+    def count(self) -> int:
+        if not isinstance(self.object_list, QuerySet):
+            return super().count
+        estimate = estimated_count(self.object_list)
+        if estimate < settings.BLOG_ADMIN_EXACT_COUNT_LIMIT:
+            return super().count
+        return estimate
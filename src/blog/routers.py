@@ -0,0 +1,119 @@
+"""
+Read replicas: ReplicaRouter sends the reads of public GET/HEAD requests to the replicas of
+settings.BLOG_READ_REPLICAS (see DB_REPLICA_HOSTS in settings.py) and everything else to the primary ("default"):
+writes, reads in a transaction, POST requests, the admin, management commands...
+
+Replica reads are enabled per request by middleware.ReplicaMiddleware. The rest of a request is "pinned" to the
+primary after its first write (read-after-write, e.g. post_comment rendering the new comment), and for pages
+whose data changed too recently for the replicas to have it (see cache.public_page: a stale page would be cached
+as the new version). A client that wrote something gets a cookie that pins its next requests too, so it sees
+its own writes after a redirect.
+
+Replicas further behind the primary than settings.BLOG_REPLICA_MAX_LAG seconds, or that can't be reached, are
+not used (the primary serves the reads meanwhile). The lag of each replica is checked at most every
+settings.BLOG_REPLICA_CHECK_INTERVAL seconds per process.
+"""
+
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.urls import reverse
+
+PIN_COOKIE = "blog_primary"
+# 0 if the replica replayed everything it received (an idle primary doesn't make it lag), NULL on a primary
+LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+# NOTE: context variables are per thread/async task and asgiref copies them in and out of sync_to_async(),
+# so each request (sync or async) sees its own values
+_replica_reads = ContextVar("blog_replica_reads", default=False)
+_wrote = ContextVar("blog_wrote", default=False)
+# {alias: (time.monotonic() of the check, lag in seconds or None if unreachable)}
+_lag_checks = {}
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # NOTE: in a transaction of the primary (transaction.atomic()) reads see its uncommitted writes and its locks
+        if not _replica_reads.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return choose_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas have the same data as the primary
+        return True
+
+
+def pin_seconds() -> float:
+    # A replica used right after a check can fall behind until the next one
+    return settings.BLOG_REPLICA_MAX_LAG + settings.BLOG_REPLICA_CHECK_INTERVAL
+
+
+def pin_primary():
+    """Read from the primary for the rest of the current request"""
+    _replica_reads.set(False)
+
+
+def pin_recent_changes(last_modified: float):
+    """Read from the primary if data changed at `last_modified` (a timestamp) may not be on the replicas yet"""
+    if _replica_reads.get() and time.time() - last_modified < pin_seconds():
+        pin_primary()
+
+
+def start_request(request):
+    """Enable replica reads for a public GET/HEAD request. Returns the state to pass to finish_request()"""
+    use_replicas = (
+        bool(settings.BLOG_READ_REPLICAS)
+        and request.method in ("GET", "HEAD")
+        and PIN_COOKIE not in request.COOKIES
+        and not request.path.startswith(reverse("admin:index"))
+    )
+    return _replica_reads.set(use_replicas), _wrote.set(False)
+
+
+def finish_request(state, response):
+    """Restore the state of start_request(). Pins the client if the request wrote something"""
+    if _wrote.get() and settings.BLOG_READ_REPLICAS:
+        response.set_cookie(PIN_COOKIE, "1", max_age=pin_seconds(), httponly=True, samesite="Lax")
+    _replica_reads.reset(state[0])
+    _wrote.reset(state[1])
+
+
+def choose_replica() -> str | None:
+    """A random replica among the ones that are available and up to date enough"""
+    replicas = [alias for alias in settings.BLOG_READ_REPLICAS if replica_available(alias)]
+    return random.choice(replicas) if replicas else None
+
+
+def replica_available(alias: str) -> bool:
+    checked, lag = _lag_checks.get(alias, (None, None))
+    if checked is None or time.monotonic() - checked >= settings.BLOG_REPLICA_CHECK_INTERVAL:
+        lag = replica_lag(alias)
+        _lag_checks[alias] = (time.monotonic(), lag)
+    return lag is not None and lag <= settings.BLOG_REPLICA_MAX_LAG
+
+
+def replica_lag(alias: str) -> float | None:
+    """Seconds the replica is behind the primary, None if it can't be reached"""
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        connection.close()
+        return None
+    # NULL: not a replica (e.g. a copy standing in for one in the tests)
+    return float(lag or 0)
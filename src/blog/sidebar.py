@@ -0,0 +1,59 @@
+"""
+Data of the sidebar of blog/base.html (see templatetags/blog_tags.py), cached until a post or comment changes.
+
+Async views can't let the template tags query the database (no sync DB access inside the event loop), so
+they load the sidebar beforehand with asidebar() and pass it to the template as the "sidebar" variable.
+"""
+
+import asyncio
+
+from .cache import cached_sidebar
+from .models import Post
+
+# Number of latest and most commented posts loaded by asidebar() (the template tags can show fewer)
+SIDEBAR_POSTS = 5
+
+
+@cached_sidebar
+def total_posts() -> int:
+    return Post.published.count()
+
+
+@cached_sidebar
+def most_commented_posts(count: int = SIDEBAR_POSTS) -> list[Post]:
+    # Only the fields needed to render the links are fetched (and cached)
+    # NOTE: comment_count is denormalized and indexed: no need to annotate(total_comments=Count("comments"))
+    return list(Post.published.order_by("-comment_count").only("title", "slug", "publish")[:count])
+
+
+@cached_sidebar
+def latest_posts(count: int = SIDEBAR_POSTS) -> list[Post]:
+    return list(Post.published.order_by("-publish").only("title", "slug", "publish")[:count])
+
+
+@cached_sidebar
+async def atotal_posts() -> int:
+    return await Post.published.acount()
+
+
+@cached_sidebar
+async def amost_commented_posts(count: int = SIDEBAR_POSTS) -> list[Post]:
+    queryset = Post.published.order_by("-comment_count").only("title", "slug", "publish")[:count]
+    return [post async for post in queryset]
+
+
+@cached_sidebar
+async def alatest_posts(count: int = SIDEBAR_POSTS) -> list[Post]:
+    queryset = Post.published.order_by("-publish").only("title", "slug", "publish")[:count]
+    return [post async for post in queryset]
+
+
+async def asidebar() -> dict:
+    """
+    All the sidebar data, only the parts missing from the cache are queried.
+    NOTE: gather() doesn't run the queries in parallel: the async ORM runs them one at a time, in one thread
+    """
+    total, latest, most_commented = await asyncio.gather(
+        atotal_posts(), alatest_posts(), amost_commented_posts()
+    )
+    return {"total_posts": total, "latest_posts": latest, "most_commented_posts": most_commented}
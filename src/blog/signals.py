@@ -0,0 +1,192 @@
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from taggit.models import Tag, TaggedItem
+
+from .cache import (
+    LIST_PAGES,
+    invalidate_admin_facets,
+    invalidate_sidebar,
+    post_detail_pages,
+    render_post_html,
+    tag_pages,
+    touch_pages,
+    touch_post_pages,
+)
+from .feeds import feed_key, refresh_feeds
+from .models import Comment, Post, adjust_comment_counts, recount_comments
+from .similarity import refresh_similar_posts_around
+
+
+# The sidebar shows post counts, latest posts and comment counts
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_sidebar_cache(sender, **kwargs):
+    invalidate_sidebar()
+
+
+# Facet counts of the admin changelists (see admin.py)
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_admin_facets_cache(sender, **kwargs):
+    invalidate_admin_facets(sender)
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_comment_facets_on_post_delete(sender, **kwargs):
+    # Its comments are deleted in bulk, without signals (see models.delete_comments_of)
+    invalidate_admin_facets(Comment)
+
+
+@receiver(post_save, sender=Comment)
+def update_comment_count_on_save(sender, instance, created, **kwargs):
+    if created:
+        if instance.active:
+            adjust_comment_counts({instance.post_id: 1})
+    else:
+        # The comment may have been (de)activated: recount the comments of its post
+        recount_comments(Post.objects.filter(pk=instance.post_id))
+
+
+@receiver(post_delete, sender=Comment)
+def update_comment_count_on_delete(sender, instance, **kwargs):
+    if instance.active:
+        adjust_comment_counts({instance.post_id: -1})
+
+
+@receiver(post_save, sender=Post)
+def render_post_markdown(sender, instance, raw=False, **kwargs):
+    # Warm the HTML cache for the new version of the post (don't render while loading fixtures)
+    if not raw:
+        render_post_html(instance)
+
+
+# SIMILAR POSTS: recomputed for the posts whose ranking changes (see similarity.py)
+
+
+# django-taggit sends m2m_changed with the TaggedItem model as sender when tags are added/removed
+@receiver(m2m_changed, sender=TaggedItem)
+def update_similar_posts_on_tags_change(sender, instance, action, pk_set, **kwargs):
+    if not isinstance(instance, Post):
+        return
+    if action in ("post_add", "post_remove"):
+        refresh_similar_posts_around(instance.pk, pk_set)
+    elif action == "pre_clear":
+        # The tags are gone after the clear
+        instance._cleared_tag_ids = list(instance.tags.values_list("id", flat=True))
+    elif action == "post_clear":
+        refresh_similar_posts_around(instance.pk, instance.__dict__.pop("_cleared_tag_ids", []))
+
+
+@receiver(pre_save, sender=Post)
+def check_similar_posts_ranking(sender, instance, raw=False, **kwargs):
+    # Only published posts are listed, ties are broken by the publish date
+    if not raw and instance.pk is not None:
+        previous = Post.objects.filter(pk=instance.pk).values_list("status", "publish").first()
+        ranking = (instance.status, instance.publish)
+        instance._ranking_changed = previous is not None and previous != ranking
+
+
+@receiver(post_save, sender=Post)
+def update_similar_posts_on_post_save(sender, instance, raw=False, **kwargs):
+    # NOTE: a new post has no tags yet, they are added afterwards (m2m_changed)
+    if not raw and instance.__dict__.pop("_ranking_changed", False):
+        refresh_similar_posts_around(instance.pk, instance.tags.values_list("id", flat=True))
+
+
+@receiver(pre_delete, sender=Post)
+def remember_tags_on_post_delete(sender, instance, **kwargs):
+    instance._deleted_tag_ids = list(instance.tags.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def update_similar_posts_on_post_delete(sender, instance, **kwargs):
+    # The posts listing it lost a row (deleted by the cascade)
+    refresh_similar_posts_around(instance.pk, instance.__dict__.pop("_deleted_tag_ids", []))
+
+
+# PAGE CACHE: touch the page groups (see cache.public_page) showing the changed data
+
+
+@receiver(pre_save, sender=Post)
+def touch_previous_post_url(sender, instance, raw=False, **kwargs):
+    # If the slug or the publish date change, the page at the old URL changes too (it's now a 404)
+    if not raw and instance.pk is not None:
+        previous = Post.objects.filter(pk=instance.pk).only("slug", "publish").first()
+        if previous is not None:
+            touch_pages(post_detail_pages(previous))
+
+
+@receiver(post_save, sender=Post)
+def touch_pages_on_post_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        touch_post_pages(instance, when=instance.updated)
+
+
+# NOTE: pre_delete because the tags of the post are deleted with it
+@receiver(pre_delete, sender=Post)
+def touch_pages_on_post_delete(sender, instance, **kwargs):
+    touch_post_pages(instance)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def touch_pages_on_comment_change(sender, instance, raw=False, **kwargs):
+    # Comments are only shown in the detail page of their post
+    if raw:
+        return
+    try:
+        touch_pages(post_detail_pages(instance.post))
+    except Post.DoesNotExist:  # the comment is being deleted together with its post
+        pass
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def touch_pages_on_tags_change(sender, instance, action, pk_set, **kwargs):
+    if not isinstance(instance, Post):
+        return
+    if action in ("post_add", "post_remove"):
+        slugs = Tag.objects.filter(pk__in=pk_set).values_list("slug", flat=True)
+    elif action == "pre_clear":
+        slugs = instance.tags.values_list("slug", flat=True)
+    else:
+        return
+    touch_pages(post_detail_pages(instance), LIST_PAGES, *(tag_pages(slug) for slug in slugs))
+
+
+# FEED SNAPSHOTS: rebuilt when the posts they show change (see feeds.py)
+
+
+@receiver(post_save, sender=Post)
+def refresh_feeds_on_post_save(sender, instance, raw=False, **kwargs):
+    # NOTE: also when a post is unpublished (a draft that stays a draft rebuilds them for nothing, but drafts are rare)
+    if not raw:
+        refresh_feeds(instance.tags.values_list("slug", flat=True))
+
+
+@receiver(pre_delete, sender=Post)
+def refresh_feeds_on_post_delete(sender, instance, **kwargs):
+    refresh_feeds(list(instance.tags.values_list("slug", flat=True)))
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def refresh_feeds_on_tags_change(sender, instance, action, pk_set, **kwargs):
+    # Only the feeds of the added/removed tags: the feed of the latest posts doesn't show tags
+    if not isinstance(instance, Post) or instance.status != Post.Status.PUBLISHED:
+        return
+    if action in ("post_add", "post_remove"):
+        refresh_feeds(
+            Tag.objects.filter(pk__in=pk_set).values_list("slug", flat=True), latest=False
+        )
+    elif action == "pre_clear":
+        refresh_feeds(list(instance.tags.values_list("slug", flat=True)), latest=False)
+
+
+@receiver(post_delete, sender=Tag)
+def drop_tag_feed(sender, instance, **kwargs):
+    # A deleted tag's feed becomes a 404 on the next poll
+    cache.delete(feed_key(instance.slug))
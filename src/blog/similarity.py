@@ -0,0 +1,95 @@
+"""
+Precomputed "similar posts": the published posts sharing the most tags with each post.
+
+post_detail reads them from the SimilarPost table with one indexed query. Rows are recomputed inside the
+database by one statement (REFRESH_SQL): in bulk by ``./manage.py similarposts``, and for the posts affected by
+a change (tags added or removed, a post published, unpublished or deleted, see signals.py) by
+refresh_similar_posts_around(). The detail pages of the refreshed posts are touched (see cache.public_page).
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from taggit.models import TaggedItem
+
+from .cache import post_pages, touch_pages
+from .models import Post, SimilarPost
+
+# Ranks the published posts sharing tags with the refreshed posts, keeps the top N of each one.
+# The refreshed posts are selected by a condition on a column with post ids: ID_RANGE or SHARING_TAGS
+REFRESH_SQL = """
+DELETE FROM {similar_table} WHERE {refreshed_post_id};
+INSERT INTO {similar_table} (post_id, similar_id, same_tags, rank)
+SELECT post_id, similar_id, same_tags, rank - 1
+FROM (
+    SELECT
+        mine.object_id AS post_id,
+        theirs.object_id AS similar_id,
+        COUNT(*) AS same_tags,
+        ROW_NUMBER() OVER (
+            PARTITION BY mine.object_id ORDER BY COUNT(*) DESC, candidate.publish DESC, candidate.id DESC
+        ) AS rank
+    FROM {tagged_table} mine
+    JOIN {tagged_table} theirs
+        ON theirs.tag_id = mine.tag_id
+        AND theirs.content_type_id = mine.content_type_id
+        AND theirs.object_id <> mine.object_id
+    JOIN {post_table} candidate ON candidate.id = theirs.object_id AND candidate.status = %(published)s
+    WHERE mine.content_type_id = %(content_type_id)s AND {refreshed_object_id}
+    GROUP BY mine.object_id, theirs.object_id, candidate.publish, candidate.id
+) ranked
+WHERE rank <= %(limit)s
+"""
+# Date and slug of the refreshed posts: the URL of their detail page
+REFRESHED_PAGES_SQL = "SELECT publish, slug FROM {post_table} WHERE {refreshed_id}"
+# Posts of an id range
+ID_RANGE = "{column} BETWEEN %(first_id)s AND %(last_id)s"
+# A post and the posts with some of the given tags: the only posts whose ranking changes when the post gains or
+# loses these tags (a post sharing other tags with it keeps the same count), is (un)published or deleted
+SHARING_TAGS = """(
+    {column} = %(post_id)s
+    OR {column} IN (
+        SELECT object_id FROM {tagged_table}
+        WHERE content_type_id = %(content_type_id)s AND tag_id = ANY(%(tag_ids)s::bigint[])
+    )
+)"""
+
+
+def refresh_similar_posts(first_id: int, last_id: int):
+    """Recompute the similar posts of all the posts with first_id <= id <= last_id inside the database"""
+    _refresh(ID_RANGE, {"first_id": first_id, "last_id": last_id})
+
+
+def refresh_similar_posts_around(post_id: int, tag_ids):
+    """Recompute the similar posts of a post and of every post tagged with one of `tag_ids` (one statement)"""
+    _refresh(SHARING_TAGS, {"post_id": post_id, "tag_ids": list(tag_ids)})
+
+
+def _refresh(refreshed: str, params: dict):
+    quote_name = connection.ops.quote_name
+    tagged_table = quote_name(TaggedItem._meta.db_table)
+    post_table = quote_name(Post._meta.db_table)
+    sql = REFRESH_SQL.format(
+        similar_table=quote_name(SimilarPost._meta.db_table),
+        tagged_table=tagged_table,
+        post_table=post_table,
+        refreshed_post_id=refreshed.format(column="post_id", tagged_table=tagged_table),
+        refreshed_object_id=refreshed.format(column="mine.object_id", tagged_table=tagged_table),
+    )
+    pages_sql = REFRESHED_PAGES_SQL.format(
+        post_table=post_table,
+        refreshed_id=refreshed.format(column="id", tagged_table=tagged_table),
+    )
+    params = {
+        **params,
+        "published": Post.Status.PUBLISHED,
+        "content_type_id": ContentType.objects.get_for_model(Post).id,
+        "limit": settings.BLOG_SIMILAR_POSTS,
+    }
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        cursor.execute(pages_sql, params)
+        pages = [
+            post_pages(publish.year, publish.month, publish.day, slug) for publish, slug in cursor
+        ]
+    touch_pages(*pages)
@@ -1,18 +1,120 @@
-from django.contrib.sitemaps import Sitemap
+"""
+Sitemap index of the published posts, split in shards of settings.BLOG_SITEMAP_SHARD_SIZE URLs.
 
+NOTE: django.contrib.sitemaps loads every object of a page in memory and calls get_absolute_url()
+(a reverse() call) for each of them. Here shards are keyset ranges of (publish, id), oldest posts first
+so new posts only change the last shard, and each shard is streamed from a server-side cursor that
+fetches only slug, publish and updated.
+"""
+
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+
+from .cache import SITEMAP_PAGES, pages_last_modified, public_page
 from .models import Post
+from .urlbuilders import post_detail_url
+
+SITEMAP_XMLNS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+# Relevance of the posts in the site
+POST_PRIORITY = 0.9
+# URLs written at once to the streamed response
+CHUNK_SIZE = 2000
+URLSET_START = f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_XMLNS}">\n'
+URLSET_END = "\n</urlset>\n"
+
+
+def _from_key(publish, pk) -> Q:
+    # (publish, id) >= (publish, pk). The first condition alone can be used as an index condition
+    return Q(publish__gte=publish) & (Q(publish__gt=publish) | Q(pk__gte=pk))
+
+
+def _before_key(publish, pk) -> Q:
+    # (publish, id) < (publish, pk)
+    return Q(publish__lte=publish) & (Q(publish__lt=publish) | Q(pk__lt=pk))
+
+
+def shard_starts() -> list[tuple]:
+    """(publish, id) of the first post of every shard but the first one. Cached until a post changes"""
+    shard_size = settings.BLOG_SITEMAP_SHARD_SIZE
+    key = f"blog:sitemap:starts:{shard_size}:{pages_last_modified([SITEMAP_PAGES])}"
+    starts = cache.get(key)
+    if starts is None:
+        starts = []
+        keys = Post.published.order_by("publish", "id").values_list("publish", "id")
+        while True:
+            # Seek to the start of the previous shard and skip one shard: reads each index entry once
+            remaining = keys.filter(_from_key(*starts[-1])) if starts else keys
+            start = list(remaining[shard_size : shard_size + 1])
+            if not start:
+                break
+            starts.append(start[0])
+        cache.set(key, starts, timeout=settings.BLOG_PAGE_CACHE_TIMEOUT)
+    return starts
+
+
+def _site_url(request) -> str:
+    return f"{request.scheme}://{get_current_site(request).domain}"
+
+
+@public_page(lambda request: [SITEMAP_PAGES])
+def sitemap_index(request):
+    return HttpResponse(
+        _sitemapindex(_site_url(request), len(shard_starts()) + 1), content_type="application/xml"
+    )
+
+
+def _sitemapindex(site_url: str, shards: int) -> str:
+    locations = (
+        site_url + reverse("sitemap_shard", args=[shard]) for shard in range(1, shards + 1)
+    )
+    sitemaps = "".join(
+        f"<sitemap><loc>{escape(location)}</loc></sitemap>" for location in locations
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<sitemapindex xmlns="{SITEMAP_XMLNS}">\n{sitemaps}\n</sitemapindex>\n'
+    )
+
+
+# NOTE: streamed, so not page-cached (store=False): clients that have the shard get a 304 from its ETag
+@public_page(lambda request, shard: [SITEMAP_PAGES], store=False)
+def sitemap_shard(request, shard: int):
+    starts = shard_starts()
+    if not 1 <= shard <= len(starts) + 1:
+        raise Http404("No such sitemap")
+
+    posts = Post.published.order_by("publish", "id")
+    if shard > 1:
+        posts = posts.filter(_from_key(*starts[shard - 2]))
+    if shard <= len(starts):
+        posts = posts.filter(_before_key(*starts[shard - 1]))
+    # NOTE: iterator() uses a server-side cursor in PostgreSQL: only CHUNK_SIZE rows in memory at a time
+    rows = posts.values_list("slug", "publish", "updated").iterator(chunk_size=CHUNK_SIZE)
+    return StreamingHttpResponse(_urlset(rows, _site_url(request)), content_type="application/xml")
 
 
-class PostSitemap(Sitemap):
-    # Both change_freq and priority can be methods or atributes
-    change_freq = "weekly"
-    priority = 0.9  # relevance of the object in this site
+def _urlset(rows, site_url: str):
+    yield URLSET_START
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield _url_entries(chunk, site_url)
+            chunk = []
+    yield _url_entries(chunk, site_url) + URLSET_END
 
-    def items(self):
-        # NOTE: by default Django will call get_absolute_url() to get the URL of each object
-        # to specify another location for objects add a "location" method here
-        return Post.published.order_by("-publish")[:100]
 
-    def lastmod(self, obj):
-        # Last modification of each object returned by items()
-        return obj.updated
+def _url_entries(rows, site_url: str) -> str:
+    """<url> elements of a chunk of (slug, publish, updated) rows"""
+    post_url = post_detail_url.formatter()
+    return "".join(
+        f"<url><loc>{escape(site_url + post_url(publish.year, publish.month, publish.day, slug))}</loc>"
+        f"<lastmod>{updated.date().isoformat()}</lastmod><priority>{POST_PRIORITY}</priority></url>"
+        for slug, publish, updated in rows
+    )
@@ -2,34 +2,39 @@ from typing import Any
 
 from django import template
 from django.conf import settings
-from django.db.models import Count
 from django.utils.safestring import mark_safe
 from markdown import markdown
 
-from ..models import Post
+from .. import sidebar as sidebar_data
+from ..urlbuilders import tag_url
 
 # Register custom templating tags {% custom %}
 register = template.Library()
 
 
 # SIMPLE TAG: receives data and outputs a str
-@register.simple_tag  # use name="custom_name" to add another name
-def total_posts():
-    return Post.published.count()
+# NOTE: the sidebar tags run on every page, their results are cached (see sidebar.py) until a post or comment changes
+# Async views load the sidebar beforehand and pass it as the "sidebar" context variable (no DB access from templates)
+@register.simple_tag(takes_context=True)  # use name="custom_name" to add another name
+def total_posts(context):
+    sidebar = context.get("sidebar")
+    return sidebar["total_posts"] if sidebar else sidebar_data.total_posts()
 
 
-# Simple template tag that returns a queryset that can be reused in multiple places:
-@register.simple_tag
-def get_most_commented_posts(count=5):
-    return Post.published.annotate(total_comments=Count("comments")).order_by("-total_comments")[:count]
+# Simple template tag that returns a list of posts that can be reused in multiple places:
+@register.simple_tag(takes_context=True)
+def get_most_commented_posts(context, count=5):
+    sidebar = context.get("sidebar")
+    return sidebar["most_commented_posts"][:count] if sidebar else sidebar_data.most_commented_posts(count)
 
 
 # INCLUSION TAG: allow you to render a template with context variables
 # They always must return a dictionary!
 # No need to use {% load tagname %}
-@register.inclusion_tag("blog/post/latest_posts.html")
-def show_latest_posts(count: int = 5) -> dict[str, Any]:  # optional argument
-    latest_posts = Post.published.order_by("-publish")[:count]
+@register.inclusion_tag("blog/post/latest_posts.html", takes_context=True)
+def show_latest_posts(context, count: int = 5) -> dict[str, Any]:  # optional argument
+    sidebar = context.get("sidebar")
+    latest_posts = sidebar["latest_posts"][:count] if sidebar else sidebar_data.latest_posts(count)
     return {"latest_posts": latest_posts}
 
 
@@ -39,6 +44,12 @@ def markdown_format(text):
     return mark_safe(markdown(text))
 
 
+@register.filter(name="tag_url")
+def tag_url_filter(slug):
+    # {% url 'blog:post_list_by_tag' tag.slug %} without a reverse() per tag
+    return tag_url(slug)
+
+
 @register.filter(name="get")
 def get(o, index):
     try:
@@ -1,3 +1,1681 @@
-from django.test import TestCase
+import base64
+import itertools
+import json
+import os
+import re
+import shutil
+import smtplib
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    connection,
+    connections,
+    router,
+    transaction,
+)
+from django.db.models import Count, Q
+from django.http import Http404, HttpResponse
+from django.test import (
+    AsyncRequestFactory,
+    Client,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, set_script_prefix
+from django.utils import timezone
+from taggit.models import Tag, TaggedItem
+
+from . import async_views, benchmarks, checks, routers, sitemaps, views
+from .cache import (
+    BLANK_CSRF_TOKEN,
+    LIST_PAGES,
+    SIDEBAR_PAGES,
+    blank_csrf_token,
+    pages_key,
+    post_detail_pages,
+    post_pages,
+    touch_pages,
+)
+from .comments import enqueue_comment, flush_comments, queue_key, queued_comments
+from .export import MANIFEST_FILE, export_file
+from .feeds import feed_key
+from .middleware import (
+    QueryStats,
+    RequestTimingMiddleware,
+    arecord_timing,
+    record_timing,
+    timing_summary,
+    timing_window,
+)
+from .models import Comment, OutgoingEmail, Post, SimilarPost
+from .outbox import queue_mail, retry_delay
+from .paginators import EstimatedCountPaginator, KeysetPaginator, estimated_count
+from .sidebar import asidebar
+from .similarity import refresh_similar_posts
+from .urlbuilders import URLBuilder, post_detail_url, tag_url
+
+
+class QueryCountTestMixin:
+    """Helpers to catch N+1 queries: the number of queries of a page must not depend on how many objects it shows"""
+
+    def count_queries(self, url: str) -> int:
+        # Cold cache: cached template tags would otherwise make the first request more expensive
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url: str, max_queries: int, page_sizes=(1, 5, 10)):
+        """Render `url` with different BLOG_POSTS_PER_PAGE values and compare the query counts"""
+        counts = {}
+        for page_size in page_sizes:
+            with override_settings(BLOG_POSTS_PER_PAGE=page_size):
+                counts[page_size] = self.count_queries(url)
+        self.assertEqual(
+            len(set(counts.values())), 1, f"Query count grows with the page size {counts}"
+        )
+        self.assertLessEqual(
+            counts[page_sizes[0]], max_queries, f"More queries than expected {counts}"
+        )
+
+
+class PostListQueriesTest(QueryCountTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        for i in range(10):
+            # A different author for each post so that authors can't be reused
+            author = User.objects.create_user(username=f"author{i}", password="password")
+            post = Post.objects.create(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Some **markdown**",
+                status=Post.Status.PUBLISHED,
+            )
+            post.tags.add("django", f"tag{i}")
+
+    # Posts (1), tags of all the posts (1), COUNT(*) of the paginator (1), sidebar tags (3)
+    def test_post_list(self):
+        self.assertConstantQueries(reverse("blog:post_list"), max_queries=6)
+
+    def test_post_list_by_tag(self):
+        # + the Tag lookup
+        self.assertConstantQueries(reverse("blog:post_list_by_tag", args=["django"]), max_queries=7)
+
+    @override_settings(BLOG_KEYSET_PAGINATION=True)
+    def test_post_list_keyset(self):
+        # No COUNT(*) with keyset pagination
+        self.assertConstantQueries(reverse("blog:post_list"), max_queries=5)
+
+
+class KeysetPaginatorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        now = timezone.now()
+        # 3 posts per publish date: pages must be split by id too
+        for i in range(8):
+            Post.objects.create(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Body",
+                publish=now - timedelta(days=i // 3),
+                status=Post.Status.PUBLISHED,
+            )
+        cls.expected = list(Post.published.order_by("-publish", "-id"))
+
+    def setUp(self):
+        self.paginator = KeysetPaginator(Post.published.all(), 3)
+
+    def test_cursor_round_trip(self):
+        post = self.expected[4]
+        cursor = self.paginator.encode_cursor(post)
+        self.assertEqual(self.paginator.decode_cursor(cursor), [post.publish, post.id])
+
+    def test_forward_and_back(self):
+        pages = [self.paginator.page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.page(after=pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        # Every post once, ties on publish broken by id
+        self.assertEqual([post for page in pages for post in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        # Back to the first page, which knows it's the first one
+        page = pages[-1]
+        for expected_page in reversed(pages[:-1]):
+            page = self.paginator.page(before=page.previous_cursor)
+            self.assertEqual(list(page), list(expected_page))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_past_both_ends(self):
+        after_last = self.paginator.page(after=self.paginator.encode_cursor(self.expected[-1]))
+        before_first = self.paginator.page(before=self.paginator.encode_cursor(self.expected[0]))
+        for page in (after_last, before_first):
+            self.assertEqual(list(page), [])
+            self.assertFalse(page.has_other_pages())
+
+    def test_tampered_cursors(self):
+        post = self.expected[0]
+        cursors = [
+            "not a cursor",
+            base64.urlsafe_b64encode(b"not json").decode(),
+            base64.urlsafe_b64encode(b"42").decode(),
+            base64.urlsafe_b64encode(json.dumps([str(post.publish)]).encode()).decode(),
+            base64.urlsafe_b64encode(json.dumps([str(post.publish), "x"]).encode()).decode(),
+            base64.urlsafe_b64encode(json.dumps(["yesterday", post.id]).encode()).decode(),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                # Ignored: the first page
+                self.assertIsNone(self.paginator.decode_cursor(cursor))
+                self.assertEqual(list(self.paginator.page(after=cursor)), self.expected[:3])
+                self.assertEqual(list(self.paginator.page(before=cursor)), self.expected[:3])
+
+
+# Without the page cache, which would hide the queries of the sidebar
+@override_settings(BLOG_PAGE_CACHE_TIMEOUT=0)
+class SidebarCacheTest(QueryCountTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = get_user_model().objects.create_user(username="author", password="password")
+        cls.post = Post.objects.create(
+            title="Cached",
+            slug="cached",
+            author=cls.author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_warm_cache_sidebar_has_no_queries(self):
+        url = reverse("blog:post_list")
+        self.client.get(url)
+        # Only the posts of the page, their tags and the paginator COUNT(*)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+    def test_post_and_comment_changes_invalidate_sidebar(self):
+        url = reverse("blog:post_list")
+        response = self.client.get(url)
+        self.assertContains(response, "a total of 1 posts")
+
+        Post.objects.create(
+            title="New", slug="new", author=self.author, body="Body", status=Post.Status.PUBLISHED
+        )
+        response = self.client.get(url)
+        self.assertContains(response, "a total of 2 posts")
+
+        # Comments change the "most commented posts"
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        warm_queries = len(context.captured_queries)
+        Comment.objects.create(
+            post=self.post, name="Name", email="name@example.com", body="Comment"
+        )
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        self.assertGreater(len(context.captured_queries), warm_queries)
+
+
+class CacheSettingsTest(TestCase):
+    def test_local_memory_cache_limits(self):
+        # Far above the 300 keys of Django's default, which would drop versions and queued comments
+        self.assertGreaterEqual(cache._max_entries, 10000)
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ["blog.W001"])
+        redis = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache"}}
+        with override_settings(CACHES=redis):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class CommentCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.post = Post.objects.create(title="Post", slug="post", author=author, body="Body")
+
+    def add_comments(self, number, active=True):
+        for i in range(number):
+            Comment.objects.create(
+                post=self.post, name=f"name{i}", email="a@example.com", body="Hi", active=active
+            )
+
+    def assertCommentCount(self, expected):
+        self.post.refresh_from_db(fields=["comment_count"])
+        self.assertEqual(self.post.comment_count, expected)
+
+    def test_create_and_delete(self):
+        self.add_comments(3)
+        self.add_comments(2, active=False)
+        self.assertCommentCount(3)
+        Comment.objects.filter(active=True).first().delete()
+        Comment.objects.filter(active=False).first().delete()
+        self.assertCommentCount(2)
+
+    def test_save_existing_comment(self):
+        self.add_comments(2)
+        comment = Comment.objects.first()
+        comment.active = False
+        comment.save()
+        self.assertCommentCount(1)
+
+    def test_bulk_actions(self):
+        self.add_comments(3)
+        self.add_comments(2, active=False)
+        Comment.objects.all().toggle_active()
+        self.assertCommentCount(2)
+        Comment.objects.all().deactivate()
+        self.assertCommentCount(0)
+
+    def test_saving_post_keeps_count(self):
+        stale_post = Post.objects.get(pk=self.post.pk)
+        self.add_comments(2)
+        stale_post.title = "New title"
+        stale_post.save()
+        self.assertCommentCount(2)
+
+    def test_deleting_post_deletes_comments_in_bulk(self):
+        self.add_comments(5)
+        other_post = Post.objects.create(
+            title="Other", slug="other", author=self.post.author, body="Body"
+        )
+        Comment.objects.create(post=other_post, name="name", email="a@example.com", body="Hi")
+        for delete in (self.post.delete, Post.objects.filter(pk=other_post.pk).delete):
+            with CaptureQueriesContext(connection) as queries:
+                _, per_model = delete()
+            sqls = [query["sql"] for query in queries]
+            # One DELETE for all the comments, which are not counted down one by one
+            self.assertEqual(
+                sum(sql.startswith('DELETE FROM "blog_comment"') for sql in sqls), 1, sqls
+            )
+            self.assertFalse([sql for sql in sqls if 'SET "comment_count"' in sql])
+        self.assertEqual(per_model["blog.Comment"], 1)
+        self.assertFalse(Comment.objects.exists())
+        self.assertEqual(Post.objects.filter(pk=0).delete(), (0, {}))
+
+
+class SimilarPostsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.posts = [
+            Post.objects.create(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Body",
+                status=Post.Status.PUBLISHED,
+            )
+            for i in range(4)
+        ]
+
+    def similar_ids(self, post):
+        return list(SimilarPost.objects.filter(post=post).values_list("similar_id", flat=True))
+
+    def test_tags_change_updates_similar_posts(self):
+        first, second, third, _ = self.posts
+        first.tags.add("django", "python")
+        second.tags.add("django", "python")
+        third.tags.add("django")
+        # second shares 2 tags with first, third only 1
+        self.assertEqual(self.similar_ids(first), [second.id, third.id])
+        self.assertEqual(self.similar_ids(third), [second.id, first.id])
+
+        second.tags.clear()
+        self.assertEqual(self.similar_ids(first), [third.id])
+
+    def test_new_tag_refreshes_posts_sharing_it(self):
+        first, second, third, fourth = self.posts
+        first.tags.add("django")
+        second.tags.add("python")
+        third.tags.add("python")
+        self.assertEqual(self.similar_ids(second), [third.id])
+        # first now shares "python" with second and third, which never listed it
+        with CaptureQueriesContext(connection) as context:
+            first.tags.add("python")
+        # One statement for all the affected posts
+        refreshes = [
+            query for query in context.captured_queries if "blog_similarpost" in query["sql"]
+        ]
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(self.similar_ids(second), [third.id, first.id])
+        self.assertEqual(self.similar_ids(third), [second.id, first.id])
+
+        # Unpublished, published again and deleted
+        first.status = Post.Status.DRAFT
+        first.save()
+        self.assertEqual(self.similar_ids(second), [third.id])
+        first.status = Post.Status.PUBLISHED
+        first.save()
+        self.assertEqual(self.similar_ids(second), [third.id, first.id])
+        fourth.tags.add("python")
+        first.delete()
+        self.assertEqual(self.similar_ids(second), [fourth.id, third.id])
+
+    def test_batch_refresh_matches_incremental(self):
+        for post, tags in zip(self.posts, [["a", "b"], ["a", "b", "c"], ["b", "c"], ["c"]]):
+            post.tags.add(*tags)
+        incremental = {post.id: self.similar_ids(post) for post in self.posts}
+        SimilarPost.objects.all().delete()
+        refresh_similar_posts(self.posts[0].id, self.posts[-1].id)
+        self.assertEqual({post.id: self.similar_ids(post) for post in self.posts}, incremental)
+
+    def test_post_detail_shows_similar_posts(self):
+        first, second, *_ = self.posts
+        first.tags.add("django")
+        second.tags.add("django")
+        response = self.client.get(first.get_absolute_url())
+        self.assertEqual(list(response.context["similar_posts"]), [second])
+
+
+class PublicPagesCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = get_user_model().objects.create_user(username="author", password="password")
+        cls.post = Post.objects.create(
+            title="Cached page",
+            slug="cached-page",
+            author=cls.author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+        cls.post.tags.add("django")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_page_cache_until_post_changes(self):
+        url = reverse("blog:post_list")
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(url), "Cached page")
+
+        self.post.title = "Edited title"
+        self.post.save()
+        self.assertContains(self.client.get(url), "Edited title")
+        self.assertContains(
+            self.client.get(reverse("blog:post_list_by_tag", args=["django"])), "Edited title"
+        )
+
+    def test_conditional_get(self):
+        for url in [
+            reverse("blog:post_list"),
+            self.post.get_absolute_url(),
+            reverse("blog:post_feed"),
+            "/sitemap.xml",
+        ]:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                with self.assertNumQueries(0):
+                    response = self.client.get(url, headers={"if-none-match": response["ETag"]})
+                self.assertEqual(response.status_code, 304)
+
+    def test_comment_touches_detail_and_sidebar_pages(self):
+        list_etag = self.client.get(reverse("blog:post_list"))["ETag"]
+        detail_etag = self.client.get(self.post.get_absolute_url())["ETag"]
+        Comment.objects.create(
+            post=self.post, name="Name", email="name@example.com", body="New comment"
+        )
+
+        response = self.client.get(
+            self.post.get_absolute_url(), headers={"if-none-match": detail_etag}
+        )
+        self.assertContains(response, "New comment")
+        # The comment counts of the sidebar ("most commented posts") changed
+        response = self.client.get(reverse("blog:post_list"), headers={"if-none-match": list_etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_similar_posts_touch_detail_page(self):
+        other = Post.objects.create(
+            title="Similar post",
+            slug="similar-post",
+            author=self.author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+        url = self.post.get_absolute_url()
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, headers={"if-none-match": etag}).status_code, 304)
+
+        other.tags.add("django")
+        response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(list(response.context["similar_posts"]), [other])
+
+    def test_missing_pages_not_stored(self):
+        publish = self.post.publish
+        for slug, status_code in [("missing", 404), (self.post.slug, 200)]:
+            with self.subTest(slug=slug):
+                group = post_pages(publish.year, publish.month, publish.day, slug)
+                response = self.client.get(
+                    reverse(
+                        "blog:post_detail", args=[publish.year, publish.month, publish.day, slug]
+                    )
+                )
+                self.assertEqual(response.status_code, status_code)
+                # Only the timestamp of a page that exists is stored (then the page is cached)
+                self.assertEqual(cache.get(pages_key(group)) is not None, status_code == 200)
+
+    def test_cached_page_has_csrf_token_of_visitor(self):
+        url = self.post.get_absolute_url()
+        comment_url = reverse("blog:post_comment", args=[self.post.id])
+        data = {"name": "Name", "email": "name@example.com", "body": "New comment"}
+        Client(enforce_csrf_checks=True).get(url)
+        for _ in range(2):
+            # Served from the page cache, with a token for the cookie of this client
+            client = Client(enforce_csrf_checks=True)
+            with self.assertNumQueries(0):
+                response = client.get(url)
+            token = re.search(rb'name="csrfmiddlewaretoken" value="(\w+)"', response.content).group(
+                1
+            )
+            self.assertEqual(client.post(comment_url, data).status_code, 403)
+            response = client.post(comment_url, {**data, "csrfmiddlewaretoken": token.decode()})
+            self.assertContains(response, "has been added")
+            cache.clear()
+            client.get(url)
+
+        # The token of pages without one (static export)
+        client = Client(enforce_csrf_checks=True)
+        token = client.get(reverse("blog:csrf_token")).json()["token"]
+        response = client.post(
+            comment_url, {**data, "body": "Other comment", "csrfmiddlewaretoken": token}
+        )
+        self.assertContains(response, "has been added")
+
+
+@override_settings(BLOG_FEED_ITEMS=2)
+class FeedSnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = get_user_model().objects.create_user(username="author", password="password")
+        now = timezone.now()
+        for i in range(3):
+            post = Post.objects.create(
+                title=f"Feed post {i}",
+                slug=f"feed-post-{i}",
+                author=cls.author,
+                body="Body",
+                publish=now - timedelta(days=3 - i),
+                status=Post.Status.PUBLISHED,
+            )
+            post.tags.add("odd" if i % 2 else "even")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_poll_is_a_cache_read(self):
+        url = reverse("blog:post_feed")
+        response = self.client.get(url)
+        # The 2 latest posts
+        self.assertContains(response, "Feed post 2")
+        self.assertContains(response, "Feed post 1")
+        self.assertNotContains(response, "Feed post 0")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, response.content)
+            response = self.client.get(url, headers={"if-none-match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_tag_feed(self):
+        response = self.client.get(reverse("blog:post_feed_by_tag", args=["even"]))
+        self.assertContains(response, "Feed post 0")
+        self.assertContains(response, "Feed post 2")
+        self.assertNotContains(response, "Feed post 1")
+        self.assertContains(response, "http://example.com/blog/tag/even/feed/")
+
+        # Unknown tags aren't stored: clients can't fill the cache with made-up slugs
+        url = reverse("blog:post_feed_by_tag", args=["missing"])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertIsNone(cache.get(feed_key("missing")))
+        # ... and a tag created later has its feed right away
+        Post.objects.get(slug="feed-post-1").tags.add("missing")
+        self.assertContains(self.client.get(url), "Feed post 1")
+
+    def test_rebuilt_when_posts_change(self):
+        for url in [reverse("blog:post_feed"), reverse("blog:post_feed_by_tag", args=["odd"])]:
+            self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(
+                title="New post", slug="new-post", author=self.author, body="Body"
+            )
+            post.tags.add("odd")
+            post.status = Post.Status.PUBLISHED
+            post.save()
+        # Rebuilt right after the commit, not on the next poll
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(reverse("blog:post_feed")), "New post")
+            response = self.client.get(reverse("blog:post_feed_by_tag", args=["odd"]))
+            self.assertContains(response, "New post")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        self.assertNotContains(self.client.get(reverse("blog:post_feed")), "New post")
+
+
+@override_settings(BLOG_SITEMAP_SHARD_SIZE=2)
+class SitemapTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        now = timezone.now()
+        cls.posts = [
+            Post.objects.create(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Body",
+                # Same publish date for 2 posts: shards must also be split by id
+                publish=now - timedelta(days=i // 2),
+                status=Post.Status.PUBLISHED,
+            )
+            for i in range(5)
+        ]
+        Post.objects.create(title="Draft", slug="draft", author=author, body="Body")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_shards(self):
+        response = self.client.get(reverse("sitemap"))
+        shard_urls = [f"http://example.com{reverse('sitemap_shard', args=[i])}" for i in (1, 2, 3)]
+        for url in shard_urls:
+            self.assertContains(response, f"<loc>{url}</loc>")
+        self.assertNotContains(response, reverse("sitemap_shard", args=[4]))
+
+        locations = []
+        for i in (1, 2, 3):
+            response = self.client.get(reverse("sitemap_shard", args=[i]))
+            self.assertTrue(response.streaming)
+            content = b"".join(response).decode()
+            locations += re.findall(r"<loc>http://example.com(.*?)</loc>", content)
+        # Oldest posts first, every published post once
+        expected = sorted(self.posts, key=lambda post: (post.publish, post.pk))
+        self.assertEqual(locations, [post.get_absolute_url() for post in expected])
+
+        self.assertEqual(self.client.get(reverse("sitemap_shard", args=[4])).status_code, 404)
+
+    def test_unchanged_shard(self):
+        url = reverse("sitemap_shard", args=[1])
+        response = self.client.get(url)
+        content = b"".join(response)
+        self.assertIn("Last-Modified", response)
+        # Shards are streamed, never buffered in the page cache: streamed again from the database...
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(b"".join(self.client.get(url)), content)
+        self.assertTrue(queries)
+        # ... unless the client has it (304)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers={"if-none-match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+
+class URLBuilderTest(TestCase):
+    def test_same_urls_as_reverse(self):
+        for args in [(2025, 1, 31, "my-post"), (1999, 12, 1, "under_score-2")]:
+            with self.subTest(args=args):
+                self.assertEqual(post_detail_url(*args), reverse("blog:post_detail", args=args))
+        self.assertEqual(tag_url("django"), reverse("blog:post_list_by_tag", args=["django"]))
+
+    def test_script_prefix(self):
+        try:
+            set_script_prefix("/mounted/")
+            url = post_detail_url(2025, 1, 31, "my-post")
+            self.assertEqual(url, "/mounted/blog/2025/1/31/my-post/")
+            self.assertEqual(url, reverse("blog:post_detail", args=[2025, 1, 31, "my-post"]))
+        finally:
+            set_script_prefix("/")
+        self.assertEqual(post_detail_url(2025, 1, 31, "my-post"), "/blog/2025/1/31/my-post/")
+
+    def test_ambiguous_sentinel_falls_back_to_reverse(self):
+        # "blog" also appears in the "blog/" prefix of the URL
+        builder = URLBuilder("blog:post_list_by_tag", ["blog"])
+        self.assertIsNone(builder.url_format())
+        self.assertEqual(builder("django"), reverse("blog:post_list_by_tag", args=["django"]))
+
+
+class ExplainTestMixin:
+    """EXPLAIN helpers: the plan of a query must read an index instead of scanning the whole table"""
+
+    @staticmethod
+    def create_posts(author, count: int, **fields):
+        """bulk_create `count` posts (one per hour) and ANALYZE so the planner knows the table is large"""
+        now = timezone.now()
+        Post.objects.bulk_create(
+            Post(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Body",
+                publish=now - timedelta(hours=i),
+                **fields,
+            )
+            for i in range(count)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Post._meta.db_table}")
+
+    def assertIndexScan(self, queryset, index_name: str):
+        plan = queryset.explain()
+        # "Index Scan using <index>", "Index Only Scan using <index>" or "Bitmap Index Scan on <index>"
+        self.assertRegex(plan, rf"(using|on) {index_name}\b", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+
+class PostDetailLookupTest(ExplainTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = get_user_model().objects.create_user(username="author", password="password")
+        cls.create_posts(cls.author, 5000, status=Post.Status.PUBLISHED)
+        cls.post = Post.objects.get(slug="post-100")
+
+    def test_detail_lookup_uses_index(self):
+        publish = self.post.publish
+        posts = Post.published.on_date(publish.year, publish.month, publish.day).filter(
+            slug=self.post.slug
+        )
+        self.assertIndexScan(posts, "blog_post_slug_publish_idx")
+        self.assertEqual(list(posts), [self.post])
+
+    def test_detail_view(self):
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertEqual(response.context["post"], self.post)
+        self.assertEqual(self.client.get("/blog/2025/2/30/post-100/").status_code, 404)
+
+    def test_unique_slug_for_date(self):
+        # Another second of the same minute, so the same day
+        same_day = self.post.publish.replace(second=(self.post.publish.second + 1) % 60)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Post.objects.create(
+                title="Copy", slug=self.post.slug, author=self.author, body="Body", publish=same_day
+            )
+        # Same slug on another day is fine
+        Post.objects.create(
+            title="Copy",
+            slug=self.post.slug,
+            author=self.author,
+            body="Body",
+            publish=self.post.publish - timedelta(days=1),
+        )
+
+
+class PostSearchTest(ExplainTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.create_posts(author, 5000, status=Post.Status.PUBLISHED)
+        cls.in_title = Post.objects.create(
+            title="Django tips",
+            slug="django-tips",
+            author=author,
+            body="Some advice",
+            status=Post.Status.PUBLISHED,
+        )
+        cls.in_body = Post.objects.create(
+            title="Weekly notes",
+            slug="weekly-notes",
+            author=author,
+            body="A Django release",
+            status=Post.Status.PUBLISHED,
+        )
+        Post.objects.create(title="Django draft", slug="django-draft", author=author, body="Django")
+        # The rows inserted by other tests (rolled back) are still in the GIN "pending list" (fastupdate), which the
+        # planner counts in the cost of the index: merge it into the index, as VACUUM would
+        cls.gin_index = next(
+            index.name for index in Post._meta.indexes if isinstance(index, GinIndex)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT gin_clean_pending_list(%s::regclass)", [cls.gin_index])
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, **params):
+        return self.client.get(reverse("blog:post_search"), params)
+
+    def test_search_vector_weights(self):
+        # Title lexemes weigh "A", body lexemes "B" (positions continue after the title)
+        vector = Post.objects.values_list("search_vector", flat=True).get(pk=self.in_title.pk)
+        self.assertEqual(vector, "'advic':4B 'django':1A 'tip':2A")
+
+    def test_search_vector_follows_updates(self):
+        # Generated by PostgreSQL: also kept current by QuerySet.update(), which runs no Python code
+        Post.objects.filter(pk=self.in_title.pk).update(title="Flask tips")
+        self.assertEqual(list(Post.published.search("flask")), [self.in_title])
+        self.assertNotIn(self.in_title, Post.published.search("django", min_rank=0))
+
+    def test_title_matches_rank_first(self):
+        results = list(Post.published.search("django", min_rank=0))
+        self.assertEqual(results, [self.in_title, self.in_body])
+        self.assertGreater(results[0].rank, results[1].rank)
+        # A single match in the body is below the default min_rank
+        self.assertEqual(list(Post.published.search("django")), [self.in_title])
+
+    def test_search_uses_gin_index(self):
+        self.assertIndexScan(Post.published.search("django"), self.gin_index)
+
+    def test_search_view(self):
+        response = self.search(query="django")
+        self.assertEqual(response.context["query"], "django")
+        self.assertEqual(list(response.context["results"]), [self.in_title])
+        self.assertContains(response, "Found 1 result")
+
+    @override_settings(BLOG_SEARCH_RESULTS_LIMIT=3, BLOG_SEARCH_RESULTS_PER_PAGE=2)
+    def test_results_capped_and_paginated(self):
+        Post.objects.bulk_create(
+            Post(
+                title=f"Django {i}",
+                slug=f"django-{i}",
+                author=self.in_title.author,
+                body="Body",
+                status=Post.Status.PUBLISHED,
+            )
+            for i in range(4)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(query="django")
+        # 5 matches, only the top 3 are kept: the LIMIT is in the count query too
+        self.assertEqual(response.context["results"].paginator.count, 3)
+        self.assertContains(response, "Found 3 results")
+        count_sql = next(query["sql"] for query in queries if "COUNT(" in query["sql"])
+        self.assertIn("LIMIT 3", count_sql)
+
+        for page, expected_number, expected_length in [
+            ("2", 2, 1),
+            ("99", 2, 1),
+            ("abc", 1, 2),
+            ("0", 2, 1),
+        ]:
+            with self.subTest(page=page):
+                results = self.search(query="django", page=page).context["results"]
+                self.assertEqual((results.number, len(results)), (expected_number, expected_length))
+
+    def test_trigram_view(self):
+        response = self.search(query="djnago tips", trigram="on")
+        self.assertEqual(list(response.context["results"]), [self.in_title])
+        # Without the flag it's a full-text search, where the typo matches nothing
+        self.assertEqual(list(self.search(query="djnago tips").context["results"]), [])
+
+    def test_trigram_threshold(self):
+        for threshold, expected in [(0.9, []), (0.3, [self.in_title])]:
+            with self.subTest(threshold=threshold):
+                results = Post.published.trigram_search("djnago tips", threshold=threshold)
+                self.assertEqual(results, expected)
+
+    def test_trigram_ordered_by_distance(self):
+        results = Post.published.trigram_search("django notes", threshold=0.2, limit=3)
+        similarities = [post.similarity for post in results]
+        self.assertEqual(similarities, sorted(similarities, reverse=True))
+        self.assertEqual(results[:2], [self.in_title, self.in_body])
+        # KNN ordering read from the GiST index, not a sort of every similar title
+        queryset = Post.published.trigram_similar("django notes", limit=3)
+        self.assertIn("<->", str(queryset.query))
+        self.assertIndexScan(queryset, "blog_post_title_trgm_idx")
+
+
+class TrigramThresholdTest(TransactionTestCase):
+    """Outside of the transaction of a TestCase: the threshold only lasts for the transaction of the search"""
+
+    def test_threshold_not_kept_by_the_connection(self):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        post = Post.objects.create(
+            title="Django tips",
+            slug="django-tips",
+            author=author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+        self.assertEqual(Post.published.trigram_search("djnago tips", threshold=0.2), [post])
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW pg_trgm.similarity_threshold")
+            self.assertEqual(float(cursor.fetchone()[0]), 0.3)
+
+
+# Without the sidebar and page caches: every query of the pages must run
+@override_settings(
+    BLOG_PAGE_CACHE_TIMEOUT=0, BLOG_SIDEBAR_CACHE_TIMEOUT=0, BLOG_SITEMAP_SHARD_SIZE=1000
+)
+class HotQueriesPlanTest(ExplainTestMixin, TestCase):
+    """EXPLAIN every query of the public pages: none of them may scan a whole table of the blog"""
+
+    # Tables that grow with the content (small tables like auth_user or taggit_tag are fine to scan)
+    LARGE_TABLES = ("blog_post", "blog_comment", "blog_similarpost", "taggit_taggeditem")
+
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.create_posts(author, 5000, status=Post.Status.PUBLISHED)
+        # Drafts make the partial indexes smaller than the table
+        draft_ids = list(Post.objects.order_by("pk").values_list("pk", flat=True))[::2]
+        Post.objects.filter(pk__in=draft_ids).update(status=Post.Status.DRAFT)
+        cls.post = Post.published.order_by("-publish")[10]
+        cls.post.tags.add("django")
+        posts = list(Post.objects.all())
+        Comment.objects.bulk_create(
+            Comment(
+                post=post, name="Name", email="a@example.com", body="Comment", active=i % 10 != 0
+            )
+            for post in posts
+            for i in range(3)
+        )
+        # 1 of 50 tags for each post, "django" for 100 posts
+        tags = Tag.objects.bulk_create(Tag(name=f"tag{i}", slug=f"tag{i}") for i in range(50))
+        django = Tag.objects.get(slug="django")
+        TaggedItem.objects.bulk_create(
+            [TaggedItem(content_object=post, tag=tags[i % 50]) for i, post in enumerate(posts)]
+            + [
+                TaggedItem(content_object=post, tag=django)
+                for post in posts[:100]
+                if post != cls.post
+            ]
+        )
+        refresh_similar_posts(0, posts[-1].pk)
+        with connection.cursor() as cursor:
+            for table in cls.LARGE_TABLES:
+                cursor.execute(f"ANALYZE {table}")
+
+    def setUp(self):
+        cache.clear()
+
+    def assertNoSeqScans(self, url: str):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+            if response.streaming:
+                b"".join(response)
+        self.assertEqual(response.status_code, 200)
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                # Server-side cursors (QuerySet.iterator()) are logged as "DECLARE ... CURSOR FOR SELECT ..."
+                sql = re.sub(r"^DECLARE .*? CURSOR .*?FOR ", "", query["sql"])
+                if not sql.startswith("SELECT"):
+                    continue
+                cursor.execute(f"EXPLAIN {sql}")
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+                for table in self.LARGE_TABLES:
+                    self.assertNotIn(f"Seq Scan on {table} ", plan, f"{url}\n{sql}\n{plan}")
+
+    def test_post_list(self):
+        self.assertNoSeqScans(reverse("blog:post_list"))
+        self.assertNoSeqScans(reverse("blog:post_list") + "?page=100")
+
+    @override_settings(BLOG_KEYSET_PAGINATION=True)
+    def test_post_list_keyset(self):
+        self.assertNoSeqScans(reverse("blog:post_list"))
+
+    def test_post_list_by_tag(self):
+        self.assertNoSeqScans(reverse("blog:post_list_by_tag", args=["django"]))
+
+    def test_post_detail(self):
+        self.assertNoSeqScans(self.post.get_absolute_url())
+
+    def test_feed(self):
+        self.assertNoSeqScans(reverse("blog:post_feed"))
+
+    def test_tag_feed(self):
+        self.assertNoSeqScans(reverse("blog:post_feed_by_tag", args=["django"]))
+
+    def test_sitemap(self):
+        self.assertNoSeqScans(reverse("sitemap"))
+        self.assertNoSeqScans(reverse("sitemap_shard", args=[2]))
+
+
+@override_settings(BLOG_TIMING_SAMPLE_RATE=1.0, BLOG_PAGE_CACHE_TIMEOUT=0)
+class RequestTimingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = get_user_model().objects.create_user(username="author", password="password")
+        Post.objects.create(
+            title="Timed",
+            slug="timed",
+            author=cls.author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("blog:post_list"))
+        header = response["Server-Timing"]
+        # The COUNT(*) of the paginator and the one of the total_posts tag (cold sidebar cache) are the same query
+        self.assertIn(f'{len(context.captured_queries)} queries, 1 duplicated"', header)
+        self.assertRegex(header, r"db;dur=[\d.]+.*, app;dur=[\d.]+, total;dur=[\d.]+")
+
+    def test_summary(self):
+        for _ in range(3):
+            self.client.get(reverse("blog:post_list"))
+        self.client.get(reverse("blog:post_search"))
+        summary = timing_summary()
+        self.assertEqual(summary["blog:post_list"]["samples"], 3)
+        self.assertLessEqual(
+            summary["blog:post_list"]["p50_ms"], summary["blog:post_list"]["p95_ms"]
+        )
+        self.assertIn("blog:post_search", summary)
+
+        # The command needs a cache shared with the server processes
+        with self.assertRaisesMessage(CommandError, "CACHE_REDIS_URL"):
+            call_command("timings")
+        output = StringIO()
+        with mock.patch("blog.management.commands.timings.shared_cache", return_value=True):
+            call_command("timings", stdout=output)
+        self.assertIn("blog:post_list", output.getvalue())
+
+        # The admin page is served by the process that measured the requests
+        self.client.force_login(get_user_model().objects.create_superuser(username="admin"))
+        response = self.client.get(reverse("request_timings"))
+        self.assertContains(response, "blog:post_search")
+        self.assertContains(response, "The cache is per process")
+
+    def test_counters(self):
+        stats = QueryStats()
+        stats.count, stats.duration = 2, 0.001
+        for _ in range(9):
+            record_timing("view", 0.010, stats)
+        async_to_sync(arecord_timing)("view", 1.0, stats)
+        summary = timing_summary()["view"]
+        self.assertEqual(summary["samples"], 10)
+        # The upper bounds of the buckets, within 25% of the times
+        self.assertTrue(10 <= summary["p50_ms"] < 12.5)
+        self.assertTrue(1000 <= summary["p95_ms"] < 1250)
+        self.assertTrue(1 <= summary["db_p95_ms"] < 1.25)
+        self.assertEqual((summary["queries"], summary["duplicates"]), (2, 0))
+
+        # The previous window still counts, not the ones before
+        window = timing_window()
+        with mock.patch("blog.middleware.timing_window", return_value=window + 1):
+            self.assertEqual(timing_summary()["view"]["samples"], 10)
+        with mock.patch("blog.middleware.timing_window", return_value=window + 2):
+            self.assertEqual(timing_summary(), {})
+
+    @override_settings(BLOG_TIMING_SAMPLE_RATE=0.0)
+    def test_not_sampled(self):
+        response = self.client.get(reverse("blog:post_list"))
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(timing_summary(), {})
+
+
+# Without the page cache: both views must run
+@override_settings(BLOG_PAGE_CACHE_TIMEOUT=0, BLOG_TIMING_SAMPLE_RATE=0)
+class AsyncViewsTest(TestCase):
+    """The async views (called directly, urls.py serves the sync ones by default) render the same pages"""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.posts = [
+            Post.objects.create(
+                title=f"World post {i}",
+                slug=f"world-{i}",
+                author=author,
+                body="Body about the world",
+                status=Post.Status.PUBLISHED,
+            )
+            for i in range(4)
+        ]
+        for post in cls.posts[:2]:
+            post.tags.add("django")
+        Comment.objects.create(
+            post=cls.posts[0], name="Name", email="name@example.com", body="Async comment"
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.factory = AsyncRequestFactory()
+
+    async def assertSameContent(self, sync_view, async_view, path: str, *args):
+        sync_response = await sync_to_async(sync_view)(self.factory.get(path), *args)
+        async_response = await async_view(self.factory.get(path), *args)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.content, sync_response.content)
+
+    async def test_post_list(self):
+        await self.assertSameContent(views.post_list, async_views.post_list, "/blog/?page=2")
+        await self.assertSameContent(
+            views.post_list, async_views.post_list, "/blog/tag/django/", "django"
+        )
+        with self.assertRaises(Http404):
+            await async_views.post_list(self.factory.get("/blog/tag/missing/"), "missing")
+
+    @override_settings(BLOG_KEYSET_PAGINATION=True)
+    async def test_post_list_keyset(self):
+        await self.assertSameContent(views.post_list, async_views.post_list, "/blog/")
+
+    async def test_post_search(self):
+        for query in ["world", "wrld&trigram=on"]:
+            await self.assertSameContent(
+                views.post_search, async_views.post_search, f"/blog/search/?query={query}"
+            )
+
+    async def test_post_detail(self):
+        post = self.posts[0]
+        await sync_to_async(refresh_similar_posts)(post.id, self.posts[-1].id)
+        kwargs = {"year": post.publish.year, "month": post.publish.month, "day": post.publish.day}
+        request = self.factory.get(post.get_absolute_url())
+        response = await async_views.post_detail(request, slug=post.slug, **kwargs)
+        self.assertContains(response, "Async comment")
+        self.assertContains(response, self.posts[1].get_absolute_url())
+        self.assertContains(response, "written a total of 4 posts")
+        with self.assertRaises(Http404):
+            await async_views.post_detail(
+                self.factory.get("/"), year=2025, month=2, day=30, slug=post.slug
+            )
+
+    @override_settings(BLOG_PAGE_CACHE_TIMEOUT=60)
+    async def test_page_and_sidebar_cache(self):
+        response = await async_views.post_list(self.factory.get("/blog/"))
+        # update() doesn't send the signals: nothing is invalidated
+        await Post.objects.filter(pk=self.posts[-1].pk).aupdate(status=Post.Status.DRAFT)
+        cached = await async_views.post_list(self.factory.get("/blog/"))
+        self.assertEqual(cached.content, response.content)
+        request = self.factory.get("/blog/", headers={"if-none-match": response["ETag"]})
+        self.assertEqual((await async_views.post_list(request)).status_code, 304)
+        # Cached by the first page
+        self.assertEqual((await asidebar())["total_posts"], 4)
+
+    async def test_feed_and_sitemap(self):
+        feed = await async_views.post_feed(self.factory.get("/blog/feed/"))
+        self.assertContains(feed, "World post 3")
+        await self.assertSameContent(
+            sitemaps.sitemap_index, async_views.sitemap_index, "/sitemap.xml"
+        )
+
+        response = await async_views.sitemap_shard(self.factory.get("/sitemap-posts-1.xml"), 1)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        for post in self.posts:
+            self.assertIn(post.get_absolute_url().encode(), content)
+
+    @override_settings(BLOG_TIMING_SAMPLE_RATE=1.0)
+    async def test_timing_middleware(self):
+        post = self.posts[0]
+        kwargs = {"year": post.publish.year, "month": post.publish.month, "day": post.publish.day}
+
+        async def get_response(request):
+            return await async_views.post_detail(request, slug=post.slug, **kwargs)
+
+        middleware = RequestTimingMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(self.factory.get(post.get_absolute_url()))
+        # Post, comments, similar posts and the 3 sidebar queries (cold cache)
+        self.assertIn("db;dur=", response["Server-Timing"])
+        self.assertIn('6 queries, 0 duplicated"', response["Server-Timing"])
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """locmem backend counting its connections. Refuses the recipients starting with "fail" """
+
+    connections = 0
+
+    def open(self):
+        type(self).connections += 1
+        return True
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any(recipient.startswith("fail") for recipient in message.recipients()):
+                raise smtplib.SMTPDataError(550, "Mailbox unavailable")
+        return super().send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND="blog.tests.FlakyEmailBackend",
+    BLOG_EMAIL_RETRY_DELAY=60,
+    BLOG_EMAIL_MAX_ATTEMPTS=2,
+)
+class OutboxTest(TestCase):
+    def setUp(self):
+        FlakyEmailBackend.connections = 0
+
+    def send_emails(self) -> str:
+        output = StringIO()
+        call_command("sendemails", stdout=output)
+        return output.getvalue()
+
+    def test_post_share_queues_email(self):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        post = Post.objects.create(
+            title="Shared", slug="shared", author=author, body="Body", status=Post.Status.PUBLISHED
+        )
+        data = {"name": "Me", "email": "me@example.com", "to": "you@example.com", "comments": ""}
+        response = self.client.post(reverse("blog:post_share", args=[post.id]), data)
+        self.assertContains(response, "successfully sent")
+        # Nothing sent during the request
+        self.assertEqual(mail.outbox, [])
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.recipients, ["you@example.com"])
+
+        self.send_emails()
+        self.assertEqual(mail.outbox[0].to, ["you@example.com"])
+        self.assertIn(post.get_absolute_url(), mail.outbox[0].body)
+
+    def test_batch_over_one_connection(self):
+        for i in range(3):
+            queue_mail(f"Email {i}", "Body", [f"user{i}@example.com"])
+        self.assertIn("Sent 3 emails", self.send_emails())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(FlakyEmailBackend.connections, 1)
+        self.assertFalse(OutgoingEmail.objects.exclude(status=OutgoingEmail.Status.SENT).exists())
+        # Already sent
+        self.assertIn("Sent 0 emails", self.send_emails())
+
+    def test_retry_with_backoff(self):
+        failing = queue_mail("Failing", "Body", ["fail@example.com"])
+        queue_mail("Working", "Body", ["user@example.com"])
+        self.send_emails()
+        # The failure didn't stop the batch, a new connection was opened after it
+        self.assertEqual([message.subject for message in mail.outbox], ["Working"])
+        self.assertEqual(FlakyEmailBackend.connections, 2)
+
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, OutgoingEmail.Status.PENDING)
+        self.assertEqual(failing.attempts, 1)
+        self.assertIn("SMTPDataError", failing.last_error)
+        self.assertAlmostEqual(
+            failing.next_attempt, timezone.now() + timedelta(seconds=60), delta=timedelta(seconds=5)
+        )
+        # Not due yet
+        self.assertIn("0 failed attempts", self.send_emails())
+
+        # Second (and last) attempt
+        OutgoingEmail.objects.filter(pk=failing.pk).update(next_attempt=timezone.now())
+        self.assertIn("1 failed attempts", self.send_emails())
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, OutgoingEmail.Status.FAILED)
+        self.assertEqual(retry_delay(2), timedelta(seconds=120))
+
+
+@override_settings(BLOG_PAGE_CACHE_TIMEOUT=0, BLOG_COMMENT_RATE_LIMIT=3)
+class CommentWritePathTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.post = Post.objects.create(
+            title="Commented",
+            slug="commented",
+            author=author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+        cls.url = reverse("blog:post_comment", args=[cls.post.id])
+
+    def setUp(self):
+        cache.clear()
+
+    def comment(self, body: str, ip: str = "10.0.0.1"):
+        data = {"name": "Name", "email": "name@example.com", "body": body}
+        return self.client.post(self.url, data, REMOTE_ADDR=ip)
+
+    def test_duplicate_submission(self):
+        self.assertContains(self.comment("Same  comment"), "has been added")
+        # Same text with different whitespace and case: same result, not saved twice
+        self.assertContains(self.comment("same comment "), "has been added")
+        self.assertEqual(Comment.objects.count(), 1)
+
+    def test_rate_limit_per_ip_and_post(self):
+        for i in range(3):
+            self.assertEqual(self.comment(f"Comment {i}").status_code, 200)
+        self.assertEqual(self.comment("One too many").status_code, 429)
+        self.assertEqual(self.comment("From another client", ip="10.0.0.2").status_code, 200)
+        self.assertEqual(Comment.objects.count(), 4)
+
+    @override_settings(BLOG_BUFFERED_COMMENTS=True)
+    def test_buffered_comments(self):
+        detail_etag = self.client.get(self.post.get_absolute_url())["ETag"]
+        self.comment("First")
+        # Post and sidebar cached: the following comments don't query the database
+        with self.assertNumQueries(0):
+            self.assertContains(self.comment("Second"), "has been added")
+            self.comment("Third", ip="10.0.0.2")
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertEqual(queued_comments(), 3)
+
+        output = StringIO()
+        call_command("flushcomments", "--batch-size", "2", stdout=output)
+        self.assertIn("Flushed 3 queued comments", output.getvalue())
+        self.assertEqual(queued_comments(), 0)
+        self.assertEqual(
+            list(self.post.comments.values_list("body", flat=True)), ["First", "Second", "Third"]
+        )
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 3)
+        # The page of the post changed
+        response = self.client.get(
+            self.post.get_absolute_url(), headers={"if-none-match": detail_etag}
+        )
+        self.assertContains(response, "Third")
+
+    def test_flush_waits_for_missing_entries(self):
+        data = {"name": "Name", "email": "name@example.com", "body": "Body"}
+        for _ in range(3):
+            enqueue_comment(self.post.id, data)
+        # The second one is still being written (or was evicted)
+        cache.delete(queue_key(2))
+        self.assertEqual(flush_comments(10), 1)
+        self.assertEqual(queued_comments(), 2)
+
+        # Once newer comments are old enough, the missing one is skipped
+        entry = cache.get(queue_key(3))
+        entry["queued"] -= 60
+        cache.set(queue_key(3), entry)
+        self.assertEqual(flush_comments(10), 2)
+        self.assertEqual(Comment.objects.count(), 2)
+
+
+class AddPostsCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        get_user_model().objects.create_user(username="author", password="password")
+
+    def addposts(self, *args) -> str:
+        output = StringIO()
+        call_command("addposts", *args, "--seed", "1", stdout=output)
+        return output.getvalue()
+
+    def generated(self) -> list[tuple]:
+        """(title, comment_count, number of tags) of every post, the counts checked against the rows"""
+        posts = Post.objects.annotate(
+            active_comments=Count("comments", filter=Q(comments__active=True), distinct=True),
+            tag_count=Count("tags", distinct=True),
+        ).order_by("title")
+        for post in posts:
+            self.assertEqual(post.comment_count, post.active_comments, post)
+            self.assertEqual(post.tag_count, 2, post)
+        self.assertEqual(Comment.objects.count(), 3 * len(posts))
+        return [(post.title, post.comment_count, post.tag_count) for post in posts]
+
+    def test_batches(self):
+        output = self.addposts(
+            "5", "--comments", "3", "--tags", "2", "--tag-pool", "4", "--batch-size", "2", "-v", "2"
+        )
+        self.assertEqual(re.findall(r"Inserted (\d+)/5 posts", output), ["2", "4", "5"])
+        self.assertEqual(Tag.objects.count(), 4)
+        self.assertEqual(len(self.generated()), 5)
+        # Searchable right away: the vector is generated by the database
+        post = Post.objects.first()
+        self.assertIn(post, Post.objects.filter(search_vector=SearchQuery(post.title)))
+
+    def test_copy(self):
+        args = ["4", "--comments", "3", "--tags", "2", "--tag-pool", "4"]
+        self.addposts(*args)
+        inserted = self.generated()
+        Post.objects.all().delete()
+        self.addposts(*args, "--copy")
+        # The same rows as bulk_create()
+        self.assertEqual(self.generated(), inserted)
+
+    def test_max_posts(self):
+        with mock.patch("blog.management.commands.addposts.MAX_POSTS", 3):
+            self.addposts("5", "--comments", "0")
+        self.assertEqual(Post.objects.count(), 3)
+        self.assertIn("greater or equal to 1", self.addposts("0"))
+        self.assertEqual(Post.objects.count(), 3)
+
+
+class BenchmarkCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        post = Post.objects.create(
+            title="World news",
+            slug="world",
+            author=author,
+            body="Body",
+            status=Post.Status.PUBLISHED,
+        )
+        post.tags.add("django")
+
+    def run_benchmark(self, *args) -> str:
+        output = StringIO()
+        call_command("benchmark", "endpoints", "--repeat", "1", *args, stdout=output)
+        return output.getvalue()
+
+    def test_json_and_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "baseline.json")
+            self.run_benchmark("--json", path)
+            with open(path) as file:
+                results = json.load(file)["results"]
+            self.assertIn("post_list_by_tag 'django'", results)
+            self.assertGreater(results["post_detail"]["queries"], 0)
+
+            # Same queries and a huge threshold: no regressions
+            self.assertIn("baseline", self.run_benchmark("--compare", path, "--threshold", "1000"))
+
+            # Fewer queries in the baseline: flagged
+            results["post_detail"]["queries"] -= 1
+            with open(path, "w") as file:
+                json.dump({"scenario": "endpoints", "results": results}, file)
+            with self.assertRaisesMessage(CommandError, "post_detail"):
+                self.run_benchmark("--compare", path, "--threshold", "1000")
+
+    def test_connection_modes(self):
+        modes = benchmarks.connection_modes()
+        original = connections["default"]
+        for mode, kept in (("new connection per request", False), ("persistent connection", True)):
+            with benchmarks.default_connection(modes[mode]) as wrapper:
+                benchmarks.select_one()
+                # NOTE: not close_old_connections(), it would close the connections of the test transaction
+                wrapper.close_if_unusable_or_obsolete()
+                self.assertEqual(wrapper.connection is not None, kept, mode)
+            self.assertIsNone(wrapper.connection)
+        self.assertIs(connections["default"], original)
+
+
+@override_settings(BLOG_POSTS_PER_PAGE=2, BLOG_PAGE_CACHE_TIMEOUT=0)
+class ExportSiteTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        now = timezone.now()
+        cls.posts = []
+        for i in range(8):
+            post = Post.objects.create(
+                title=f"Post {i}",
+                slug=f"post-{i}",
+                author=author,
+                body="Body",
+                status=Post.Status.PUBLISHED,
+                publish=now - timedelta(days=8 - i),
+            )
+            post.tags.add("even" if i % 2 == 0 else "odd")
+            cls.posts.append(post)
+        # The sidebar shows the 5 newest posts, which are also the most commented ones (2, 4... 10 comments)
+        for i, post in enumerate(cls.posts[3:], start=1):
+            for _ in range(2 * i):
+                Comment.objects.create(post=post, name="Name", email="name@example.com", body="Hi")
+        Post.objects.create(title="Draft", slug="draft", author=author, body="Body")
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def export(self, *args) -> str:
+        output = StringIO()
+        # Changes are only seen by incremental exports if they are newer than the previous export
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("exportsite", self.directory, "--workers", "1", *args, stdout=output)
+        return output.getvalue()
+
+    def read(self, url: str) -> bytes:
+        with open(os.path.join(self.directory, export_file(url)), "rb") as file:
+            return file.read()
+
+    def test_export_matches_views(self):
+        self.assertIn("Exported 24 pages", self.export())
+        # Detail pages, list pages (as linked by the pagination), tags, feeds and sitemap
+        url = self.posts[0].get_absolute_url()
+        # The same page without the CSRF token of the comment form
+        self.assertIn(BLANK_CSRF_TOKEN, self.read(url))
+        self.assertEqual(self.read(url), blank_csrf_token(self.client.get(url).content))
+        self.assertIn(b'href="?page=2"', self.read("/blog/"))
+        self.assertIn(b"Post 0", self.read("/blog/?page=4"))
+        self.assertIn(b"Post 6", self.read(tag_url("even")))
+        self.assertIn(b"<rss", self.read(reverse("blog:post_feed_by_tag", args=["odd"])))
+        self.assertIn(b"/blog/", self.read("/sitemap-posts-1.xml"))
+        self.assertIn("matches the views", self.export("--verify"))
+        # The manifest: the export, then a line per published post
+        with open(os.path.join(self.directory, MANIFEST_FILE)) as file:
+            self.assertEqual(len(file.readlines()), 1 + len(self.posts))
+
+        # A changed file (or one no page maps to) is reported
+        with open(os.path.join(self.directory, export_file("/blog/?page=2")), "ab") as file:
+            file.write(b"<!-- edited -->")
+        with self.assertRaisesMessage(CommandError, "1 pages differ from the views, 0 stale files"):
+            self.export("--verify")
+
+    @override_settings(BLOG_KEYSET_PAGINATION=True)
+    def test_keyset_pages(self):
+        self.export()
+        first_page = self.read("/blog/").decode()
+        next_url = "/blog/" + re.search(r'href="(\?after=[^"]+)"', first_page).group(1)
+        second_page = self.read(next_url).decode()
+        self.assertIn("Post 5", second_page)
+        previous_url = "/blog/" + re.search(r'href="(\?before=[^"]+)"', second_page).group(1)
+        self.assertIn("Post 7", self.read(previous_url).decode())
+        self.assertIn("matches the views", self.export("--verify"))
+
+    def test_incremental(self):
+        self.export()
+        old_detail = self.posts[1].get_absolute_url()
+
+        # An old post (not in the sidebar) is edited and moved to another day
+        post = self.posts[1]
+        post.title = "Edited"
+        post.publish -= timedelta(days=1)
+        post.save()
+        output = self.export("--incremental")
+        self.assertIn("incremental", output)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, export_file(old_detail))))
+        self.assertIn(b"Edited", self.read(post.get_absolute_url()))
+        self.assertIn(b"Edited", self.read(tag_url("odd") + "?page=2"))
+        self.assertIn("matches the views", self.export("--verify"))
+
+        # Moderated comments count as changes of their post
+        Comment.objects.filter(pk=self.posts[7].comments.first().pk).deactivate()
+        self.assertIn("Exported 1 pages", self.export("--incremental"))
+        self.assertIn(b"9 comments", self.read(self.posts[7].get_absolute_url()))
+
+        # The sidebar changes: everything is rendered again, the pages of the unpublished post are removed
+        self.posts[7].status = Post.Status.DRAFT
+        self.posts[7].save()
+        self.assertIn("full", self.export("--incremental"))
+        unpublished = os.path.join(self.directory, export_file(self.posts[7].get_absolute_url()))
+        self.assertFalse(os.path.exists(unpublished))
+        self.assertIn("matches the views", self.export("--verify"))
+
+
+@contextmanager
+def stand_in_replica(alias: str):
+    """
+    Create a test database on the server of the primary, standing in for a replica with different data
+    NOTE: override_settings(DATABASES=...) can't add it: the connections read the settings once
+    """
+    primary = connections[DEFAULT_DB_ALIAS].settings_dict
+    connections.settings[alias] = {
+        **primary,
+        "TEST": {**primary["TEST"], "NAME": f"{primary['NAME']}_{alias}"},
+    }
+    creation = connections[alias].creation
+    old_name = connections[alias].settings_dict["NAME"]
+    creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        creation.destroy_test_db(old_name, verbosity=0)
+        del connections[alias]
+        del connections.settings[alias]
+
+
+@override_settings(
+    BLOG_READ_REPLICAS=["replica"], BLOG_PAGE_CACHE_TIMEOUT=0, BLOG_SIDEBAR_CACHE_TIMEOUT=0
+)
+class ReplicaRouterTest(TransactionTestCase):
+    """
+    The "replica" test database stands in for a replica, with different data than the primary
+    NOTE: not a TestCase: its transaction around each test would send every read to the primary
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # NOTE: not a class attribute: the test runner would check the connection before it exists
+        cls.enterClassContext(stand_in_replica("replica"))
+        cls.databases = {"default", "replica"}
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+        routers._lag_checks.clear()
+        publish = timezone.now() - timedelta(days=1)
+        for alias, title in [("default", "On the primary"), ("replica", "On the replica")]:
+            author = get_user_model().objects.db_manager(alias).create_user(username="author")
+            # NOTE: bulk_create() doesn't send the signals (they'd touch the primary)
+            Post.objects.using(alias).bulk_create(
+                [
+                    Post(
+                        title=title,
+                        slug="post",
+                        author=author,
+                        body="Body",
+                        status=Post.Status.PUBLISHED,
+                        publish=publish,
+                    )
+                ]
+            )
+        self.post = Post.objects.get()
+        self.age_pages()
+
+    def age_pages(self):
+        # Changed long ago: every replica has the changes
+        touch_pages(
+            LIST_PAGES,
+            SIDEBAR_PAGES,
+            post_detail_pages(self.post),
+            when=timezone.now() - timedelta(hours=1),
+        )
+
+    def test_public_pages_read_from_replica(self):
+        self.assertContains(self.client.get(reverse("blog:post_list")), "On the replica")
+        self.assertContains(self.client.get(self.post.get_absolute_url()), "On the replica")
+        self.assertEqual(routers.replica_lag("replica"), 0)
+
+    def test_recent_changes_read_from_primary(self):
+        touch_pages(LIST_PAGES)
+        self.assertContains(self.client.get(reverse("blog:post_list")), "On the primary")
+
+    def test_write_pins_request_and_client(self):
+        request = RequestFactory().get("/")
+        state = routers.start_request(request)
+        self.assertEqual(router.db_for_read(Post), "replica")
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Post), "default")
+        self.assertEqual(router.db_for_write(Comment), "default")
+        # Read-after-write in the same request
+        self.assertEqual(router.db_for_read(Post), "default")
+        response = HttpResponse()
+        routers.finish_request(state, response)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(router.db_for_read(Post), "default")  # outside of requests
+
+        # post_comment (POST) reads the post and renders the new comment from the primary
+        data = {"name": "Name", "email": "name@example.com", "body": "New comment"}
+        response = self.client.post(reverse("blog:post_comment", args=[self.post.id]), data)
+        self.assertContains(response, "has been added")
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        # The client sees its own comment on the next pages
+        self.age_pages()
+        self.assertContains(self.client.get(self.post.get_absolute_url()), "New comment")
+        self.client.cookies.pop(routers.PIN_COOKIE)
+        self.assertNotContains(self.client.get(self.post.get_absolute_url()), "New comment")
+
+    def test_lagging_or_unreachable_replica(self):
+        for lag in [60, None]:
+            routers._lag_checks.clear()
+            with mock.patch("blog.routers.replica_lag", return_value=lag):
+                self.assertContains(self.client.get(reverse("blog:post_list")), "On the primary")
+
+    @override_settings(BLOG_READ_REPLICAS=["replica", "default"])
+    def test_trigram_threshold_on_replica_used(self):
+        # Two replicas, the router takes turns between them
+        aliases = itertools.cycle(["replica", "default"])
+        state = routers.start_request(RequestFactory().get(reverse("blog:post_search")))
+        try:
+            with mock.patch(
+                "blog.routers.random.choice", side_effect=lambda replicas: next(aliases)
+            ):
+                # Similarity 0.27 with "On the replica": found with the threshold, not with the default 0.3
+                results = Post.published.trigram_search("replicas here now", threshold=0.2)
+                self.assertEqual([post.title for post in results], ["On the replica"])
+                # The next search runs on the primary, where no title is similar
+                self.assertEqual(
+                    Post.published.trigram_search("replicas here now", threshold=0.2), []
+                )
+        finally:
+            routers.finish_request(state, HttpResponse())
+
+    def test_admin_reads_from_primary(self):
+        self.client.force_login(get_user_model().objects.create_superuser(username="admin"))
+        response = self.client.get(reverse("admin:blog_post_changelist"))
+        self.assertContains(response, "On the primary")
+
+
+class AdminChangelistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = get_user_model().objects.create_user(username="author", password="password")
+        cls.post = Post.objects.create(title="Post", slug="post", author=author, body="Body")
+        for i in range(3):
+            Comment.objects.create(post=cls.post, name=f"name{i}", email="a@example.com", body="Hi")
+        cls.admin = get_user_model().objects.create_superuser(username="admin")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def get_changelist(self, query: str = "_facets=True"):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"{reverse('admin:blog_comment_changelist')}?{query}")
+        self.assertEqual(response.status_code, 200)
+        return response, [query["sql"] for query in context.captured_queries]
+
+    def test_cached_facets(self):
+        response, queries = self.get_changelist()
+        self.assertContains(response, "Yes (3)")
+        # The filters (active, created, updated) don't count again
+        response, cached_queries = self.get_changelist()
+        self.assertContains(response, "Yes (3)")
+        self.assertEqual(len(cached_queries), len(queries) - 3)
+
+        # Other filters: other counts
+        response, _ = self.get_changelist("_facets=True&active__exact=0")
+        self.assertContains(response, "Yes (3)")
+        self.assertContains(response, "No (0)")
+
+        # Invalidated by saving a comment and by the admin actions
+        comment = Comment.objects.first()
+        comment.active = False
+        comment.save()
+        self.assertContains(self.get_changelist()[0], "Yes (2)")
+        data = {"action": "toggle_activate", "_selected_action": [comment.pk]}
+        self.client.post(reverse("admin:blog_comment_changelist"), data)
+        self.assertContains(self.get_changelist()[0], "Yes (3)")
+
+    def test_estimated_count(self):
+        paginator = EstimatedCountPaginator(Comment.objects.order_by("pk"), 2)
+        with mock.patch("blog.paginators.estimated_count", return_value=1_000_000):
+            with override_settings(BLOG_ADMIN_EXACT_COUNT_LIMIT=10_000):
+                self.assertEqual(paginator.count, 1_000_000)
+            del paginator.count
+            with override_settings(BLOG_ADMIN_EXACT_COUNT_LIMIT=10_000_000):
+                self.assertEqual(paginator.count, 3)
+        self.assertGreaterEqual(estimated_count(Comment.objects.all()), 0)
+
+        # The changelist doesn't run COUNT(*) for big tables
+        with override_settings(BLOG_ADMIN_EXACT_COUNT_LIMIT=0):
+            response, queries = self.get_changelist("")
+        self.assertContains(response, "name0")
+        self.assertFalse([sql for sql in queries if "COUNT(" in sql])
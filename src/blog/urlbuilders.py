@@ -0,0 +1,85 @@
+"""
+URL builders: reverse() compiled once per URL pattern.
+
+reverse() looks up the pattern, checks every argument against its converter and quotes the result on
+each call, which adds up when a page links dozens of posts. A URLBuilder calls reverse() once with
+"sentinel" arguments and turns the result into a format string, so building a URL is a str.format().
+
+The format string is cached per (URLconf resolver, script prefix): a different ROOT_URLCONF, a
+request.urlconf or a deployment under a sub-path (SCRIPT_NAME) compiles it again.
+"""
+
+import re
+from urllib.parse import quote
+
+from django.urls import get_resolver, get_script_prefix, get_urlconf, reverse
+
+# Same safe characters as reverse()
+SAFE_CHARS = "/#!$&'()*+,;=~:@"
+# Arguments that quote() would leave unchanged (e.g. ASCII slugs)
+UNQUOTED_ARG = re.compile(r"[-\w.~]*", re.ASCII)
+
+
+class URLBuilder:
+    """
+    Build the URL of a view from positional arguments. `sentinels` are valid example arguments for the
+    converters of the pattern that don't appear anywhere else in the URL:
+        post_url = URLBuilder("blog:post_detail", [1000000001, 1000000002, 1000000003, "sentinel-slug"])
+        post_url(2025, 1, 31, "my-post")  # "/blog/2025/1/31/my-post/"
+    NOTE: the arguments are not validated against the converters (reverse() raises NoReverseMatch)
+    """
+
+    def __init__(self, viewname: str, sentinels: list):
+        self.viewname = viewname
+        self.sentinels = [str(sentinel) for sentinel in sentinels]
+        # {(id(resolver), script prefix): (resolver, format string or None)}
+        self._compiled = {}
+
+    def __call__(self, *args) -> str:
+        return self.formatter()(*args)
+
+    def formatter(self):
+        """
+        Function building URLs with the current URLconf and script prefix. Skips looking them up
+        (thread/async locals) on each call when building many URLs at once, e.g. in the sitemap
+        """
+        url_format = self.url_format()
+        if url_format is None:
+            return lambda *args: reverse(self.viewname, args=args)
+        return lambda *args: url_format.format(*map(_quote, args))
+
+    def url_format(self) -> str | None:
+        """Format string of the current URLconf and script prefix (None if it can't be compiled)"""
+        resolver = get_resolver(get_urlconf())
+        key = (id(resolver), get_script_prefix())
+        compiled = self._compiled.get(key)
+        # NOTE: the resolver is kept in the entry so its id can't be reused by another resolver
+        if compiled is None or compiled[0] is not resolver:
+            compiled = (resolver, self._compile())
+            self._compiled[key] = compiled
+        return compiled[1]
+
+    def _compile(self) -> str | None:
+        url = reverse(self.viewname, args=self.sentinels).replace("{", "{{").replace("}", "}}")
+        for sentinel in self.sentinels:
+            if url.count(sentinel) != 1:
+                return None  # Ambiguous sentinel: fall back to reverse()
+            url = url.replace(sentinel, "{}")
+        # The arguments must appear in the URL in the same order
+        if url.format(*self.sentinels) != reverse(self.viewname, args=self.sentinels):
+            return None
+        return url
+
+
+def _quote(arg) -> str:
+    if isinstance(arg, int):
+        return str(arg)
+    arg = str(arg)
+    # NOTE: quote() is the slowest part of building a URL, most arguments don't need it
+    return arg if UNQUOTED_ARG.fullmatch(arg) else quote(arg, safe=SAFE_CHARS)
+
+
+post_detail_url = URLBuilder(
+    "blog:post_detail", [1000000001, 1000000002, 1000000003, "sentinel-post-slug"]
+)
+tag_url = URLBuilder("blog:post_list_by_tag", ["sentinel-tag-slug"])
@@ -1,24 +1,34 @@
+from django.conf import settings
 from django.urls import path
 
-from blog.feeds import LatestPostsFeed
+from . import async_views, feeds, views
 
-from . import views
+# Views of the public read-only pages: sync (views.py) or async (async_views.py, for ASGI deployments)
+if settings.BLOG_ASYNC_VIEWS:
+    read_views = async_views
+    post_feed = async_views.post_feed
+else:
+    read_views = views
+    # Feeds served from their prebuilt snapshots (see feeds.py)
+    # NOTE: the Feed classes are views too: path("feed/", LatestPostsFeed()) (notice that we call the feed!)
+    post_feed = feeds.post_feed
 
 # DEFINES AN APPLICATION NAMESPACE
 app_name = "blog"
 # Needed for namespace URL reversing (e.g. reverse("blog:post_detail"))
 # If you only use "namespace" in the "include" function of the global urlpatterns you won't be able to reverse URL within this app
 urlpatterns = [
-    path("", views.post_list, name="post_list"),
+    path("", read_views.post_list, name="post_list"),
     # path("", views.PostListView.as_view(), name="post_list"),
-    path("tag/<slug:tag_slug>/", views.post_list, name="post_list_by_tag"),  # different name for the view
+    path("tag/<slug:tag_slug>/", read_views.post_list, name="post_list_by_tag"),  # different name for the view
     # Can we use <int:pk> too?
     # path("<int:id>", views.post_detail, name="post_detail"),
     # This will be called as post_detail(request, id=<id>)
-    path("<int:year>/<int:month>/<int:day>/<slug:slug>/", views.post_detail, name="post_detail"),
+    path("<int:year>/<int:month>/<int:day>/<slug:slug>/", read_views.post_detail, name="post_detail"),
     path("<int:post_id>/share/", views.post_share, name="post_share"),
     path("<int:post_id>/comment/", views.post_comment, name="post_comment"),
-    path("feed/", LatestPostsFeed(), name="post_feed"),
-    # NOTE: notice that we call the feed!
-    path("search/", views.post_search, name="post_search"),
+    path("csrf-token/", views.csrf_token, name="csrf_token"),
+    path("feed/", post_feed, name="post_feed"),
+    path("tag/<slug:tag_slug>/feed/", post_feed, name="post_feed_by_tag"),
+    path("search/", read_views.post_search, name="post_search"),
 ]
@@ -1,20 +1,29 @@
-from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
-from django.core.mail import send_mail
+from django.conf import settings
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db.models import Count
-from django.http import Http404
+from django.http import Http404, HttpResponse, JsonResponse
 from django.http.request import HttpRequest
+from django.middleware.csrf import get_token
 from django.shortcuts import get_object_or_404, render
-from django.views.decorators.http import require_POST
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import ListView
 from taggit.models import Tag
 
+from .cache import LIST_PAGES, SIDEBAR_PAGES, post_pages, public_page, tag_pages
+from .comments import enqueue_comment, is_duplicate, published_post, rate_limited
 from .forms import CommentForm, EmailPostForm, SearchForm
 from .models import Post
+from .outbox import queue_mail
+from .paginators import KeysetPaginator
 
 
+# ETag/Last-Modified and page cache, until a post of the list (or of the tag) or the sidebar changes
+@public_page(
+    lambda request, tag_slug=None: [tag_pages(tag_slug) if tag_slug else LIST_PAGES, SIDEBAR_PAGES]
+)
 def post_list(request: HttpRequest, tag_slug=None):
-    post_list = Post.published.all()
+    # The template shows the author and tags of every post: JOIN the author and fetch all tags in 1 extra query
+    post_list = Post.published.select_related("author").prefetch_related("tags")
     tag = None
 
     if tag_slug:  # path parameter only passed in "tag/<slug>"
@@ -22,15 +31,20 @@ def post_list(request: HttpRequest, tag_slug=None):
         # Start from the existing Post Queryset
         post_list = post_list.filter(tags__in=[tag])
 
-    paginator = Paginator(post_list, 3)  # 3 posts per page
-    page_number = request.GET.get("page", 1)
-    try:
-        posts = paginator.page(page_number)
-        # "posts" is an object of type Page
-    except PageNotAnInteger:
-        posts = paginator.page(1)
-    except EmptyPage:
-        posts = paginator.page(paginator.num_pages)
+    if settings.BLOG_KEYSET_PAGINATION:
+        # No COUNT(*) and no OFFSET: pages are fetched with the ?after=/?before= cursors
+        paginator = KeysetPaginator(post_list, settings.BLOG_POSTS_PER_PAGE)
+        posts = paginator.page(after=request.GET.get("after"), before=request.GET.get("before"))
+    else:
+        paginator = Paginator(post_list, settings.BLOG_POSTS_PER_PAGE)
+        page_number = request.GET.get("page", 1)
+        try:
+            posts = paginator.page(page_number)
+            # "posts" is an object of type Page
+        except PageNotAnInteger:
+            posts = paginator.page(1)
+        except EmptyPage:
+            posts = paginator.page(paginator.num_pages)
 
     return render(request, "blog/post/list.html", {"posts": posts, "tag": tag})
 
@@ -38,17 +52,31 @@ def post_list(request: HttpRequest, tag_slug=None):
 class PostListView(ListView):
     """Alternative to post_list"""
 
-    queryset = Post.published.all()
-    # queryset = Post.published.all().prefetch_related('tags')
+    # NOTE: without select_related/prefetch_related every post would run 2 more queries (author and tags)
+    queryset = Post.published.select_related("author").prefetch_related("tags")
     # NOTE: using queryset = Post <===> queryset = Post.objects.all()
     context_object_name = "posts"  # how to pass the result of queryset to template context
-    paginate_by = 3
+    # paginate_by = 3 --> settings.BLOG_POSTS_PER_PAGE, see get_paginate_by()
     # Page is passed to context as "page_obj"
     template_name = "blog/post/list.html"  # default: "blog/post_list.html"
 
     # NOTE: 404 will be returned if trying to access a nonexisting pagination page
 
+    def get_paginate_by(self, queryset):
+        return settings.BLOG_POSTS_PER_PAGE
+
+    def paginate_queryset(self, queryset, page_size):
+        if not settings.BLOG_KEYSET_PAGINATION:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size)
+        page = paginator.page(after=self.request.GET.get("after"), before=self.request.GET.get("before"))
+        # The page itself is passed as "posts" so that the template can render its cursors
+        return (paginator, page, page, page.has_other_pages())
+
 
+# ETag/Last-Modified and page cache, until the post, its comments, its similar posts or the sidebar change
+# NOTE: the page is cached without the CSRF token of the comment form, see cache.public_page
+@public_page(lambda request, **kwargs: [post_pages(**kwargs), SIDEBAR_PAGES])
 # def post_detail(request: HttpRequest, id: int):
 def post_detail(request: HttpRequest, year: int, month: int, day: int, slug: str):
     # try:
@@ -58,24 +86,27 @@ def post_detail(request: HttpRequest, year: int, month: int, day: int, slug: str
     #     raise Http404(f"Post ID {id} not found")
     # ALTERNATIVE: cant use the manager though
     # post = get_object_or_404(Post, id=id, status=Post.Status.PUBLISHED)
-    post = get_object_or_404(
-        Post, status=Post.Status.PUBLISHED, slug=slug, publish__year=year, publish__month=month, publish__day=day
-    )
+    # post = get_object_or_404(
+    #     Post, status=Post.Status.PUBLISHED, slug=slug, publish__year=year, publish__month=month, publish__day=day
+    # )
+    # NOTE: a publish range + slug uses the (slug, publish) index, the constraint makes it a single row
+    try:
+        posts = Post.published.on_date(year, month, day)
+    except (ValueError, OverflowError):
+        raise Http404("Invalid date")
+    post = get_object_or_404(posts, slug=slug)
 
     # Show only active comments
     comments = post.comments.filter(active=True)  # Notice that we return a Queryset!
     form = CommentForm()
 
-    # List of similar posts by using tags
-    # values_lists returns a list of tuples of the specified columns.
-    # Flat makes it a single list if only 1 column is retrieved
-    post_tags_ids = post.tags.values_list("id", flat=True)
-    similar_posts = Post.published.filter(tags__in=post_tags_ids).exclude(id=post.id)
-
-    N_SIMILAR_POSTS = 4
-    # "annotate" is used to add new fields to the objects (usually functions)
-    similar_posts = similar_posts.annotate(same_tags=Count("tags")).order_by("-same_tags", "-publish")[:N_SIMILAR_POSTS]
-    # TODO: check taggit's builtin post.tags.similar_objects() function
+    # Similar posts (sharing the most tags) are precomputed in the SimilarPost table, see similarity.py
+    # NOTE: Filtering on the status: posts may have been unpublished since the table was refreshed
+    similar_posts = (
+        Post.published.filter(similar_in__post=post)
+        .order_by("similar_in__rank")
+        .only("title", "slug", "publish")[: settings.BLOG_SIMILAR_POSTS]
+    )
     return render(
         request,
         "blog/post/detail.html",
@@ -104,9 +135,11 @@ def post_share(request: HttpRequest, post_id: int):
             subject = f"{data['name']} ({data['email']} recommends you read {post.title})"
             message = f"Read {post.title} at {post_url}\n\n{data['name']}'s comments: {data['comments']}"
             # from_email=None will make it use settings.DEFAULT_FROM_EMAIL
-            send_mail(
-                subject=subject, message=message, from_email=None, recipient_list=[data["to"]], fail_silently=False
-            )
+            # send_mail(
+            #     subject=subject, message=message, from_email=None, recipient_list=[data["to"]], fail_silently=False
+            # )
+            # NOTE: queued in the outbox (sent by ./manage.py sendemails): the response doesn't wait for the SMTP server
+            queue_mail(subject=subject, message=message, from_email=None, recipient_list=[data["to"]])
             sent = True
         # Else: form will be returns to template with: form.errors
     else:
@@ -117,9 +150,19 @@ def post_share(request: HttpRequest, post_id: int):
 # Only form submissions are allowed in this view. Otherwise a 405 status code will be returned
 @require_POST
 def post_comment(request: HttpRequest, post_id: int):
-    post = get_object_or_404(Post, id=post_id, status=Post.Status.PUBLISHED)
+    if settings.BLOG_BUFFERED_COMMENTS:
+        # Cached lookup, the comment is checked again against the published posts when it's saved
+        post = published_post(post_id)
+        if post is None:
+            raise Http404("No Post matches the given query.")
+    else:
+        post = get_object_or_404(Post, id=post_id, status=Post.Status.PUBLISHED)
     comment = None
 
+    # NOTE: limits and duplicates are tracked in the cache, no queries
+    if rate_limited(request, post_id):
+        return HttpResponse("Too many comments, try again later", status=429)
+
     form = CommentForm(data=request.POST)
 
     if form.is_valid():
@@ -128,16 +171,32 @@ def post_comment(request: HttpRequest, post_id: int):
 
         # assign it to the post
         comment.post = post
-        comment.save()
+        # A resubmitted form (e.g. double click, reload) shows the same result, but only 1 comment is saved
+        if not is_duplicate(post_id, form.cleaned_data):
+            if settings.BLOG_BUFFERED_COMMENTS:
+                # Saved in a batch by ./manage.py flushcomments
+                enqueue_comment(post_id, form.cleaned_data)
+            else:
+                comment.save()
 
     # If form is invalid will render the template with the form errors
     return render(request, "blog/post/comment.html", {"post": post, "form": form, "comment": comment})
 
 
+@require_GET
+@never_cache
+def csrf_token(request: HttpRequest):
+    """
+    CSRF token (and cookie) for the comment form of the pages of the static export, which have no token
+    (see export.py and the script of blog/post/includes/comment_form.html)
+    """
+    return JsonResponse({"token": get_token(request)})
+
+
 def post_search(request: HttpRequest):
     form = SearchForm()
     query = None
-    results = []
+    results = Post.published.none()
 
     # IMPORTANT: this form will be submitted with a GET request so that the query is in the params and the URL be shareable
     if "query" in request.GET:
@@ -147,24 +206,18 @@ def post_search(request: HttpRequest):
             query = form.cleaned_data["query"]
 
             if form.cleaned_data["trigram"]:
-                results = (
-                    Post.published.annotate(similarity=TrigramSimilarity("title", query))
-                    .filter(similarity__gt=0.1)
-                    .order_by("-similarity")
-                )
+                # Top settings.BLOG_TRIGRAM_RESULTS titles by similarity, using the trigram index
+                results = Post.published.trigram_search(query)
             else:
-                # NOTE: adding the config language will use stemming and stop words!
-                # search_vector = SearchVector("title", "body", config="spanish")
-                search_vector = SearchVector("title", weight="A") + SearchVector("body", weight="B")
-                # creates a text-search vector of lexemes (word roots)
-                search_query = SearchQuery(query)  # , config="spanish")
-                # REMEMBER: with annotate you define a new result field (you can then use it to filter, order, ...)
-                results = (
-                    Post.published.annotate(search=search_vector, rank=SearchRank(search_vector, search_query))
-                    .filter(rank__gte=0.3)
-                    .order_by("-rank")
-                    # Filtering by search would only include results that match the search query
-                    # .filter(search=search_query)
-                )
+                # NOTE: the weighted vector (title "A", body "B") is stored in Post.search_vector and GIN-indexed,
+                # so we no longer build SearchVector("title", weight="A") + SearchVector("body", weight="B") per query
+                # NOTE: the config language (stemming and stop words) is fixed by models.SEARCH_CONFIG
+                # NOTE: only the top settings.BLOG_SEARCH_RESULTS_LIMIT posts are kept (LIMIT in SQL)
+                results = Post.published.search(query)[: settings.BLOG_SEARCH_RESULTS_LIMIT]
+
+    # Results are paginated like post_list. The paginator counts the (capped) results in SQL
+    paginator = Paginator(results, settings.BLOG_SEARCH_RESULTS_PER_PAGE)
+    # get_page() falls back to the first/last page for invalid/out of range page numbers
+    results = paginator.get_page(request.GET.get("page"))
 
     return render(request, "blog/post/search.html", {"form": form, "query": query, "results": results})
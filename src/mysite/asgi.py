@@ -3,6 +3,9 @@ ASGI config for mysite project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Database connections: set DB_POOL=True (see settings.py), sync code runs in a new thread
+per request and wouldn't reuse persistent connections.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -50,6 +50,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it measures the other middleware too
+    "blog.middleware.RequestTimingMiddleware",
+    # Before any middleware reading the database (e.g. the session)
+    "blog.middleware.ReplicaMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -96,6 +100,77 @@ DATABASES = {
     }
 }
 
+# Reused connections (https://docs.djangoproject.com/en/5.1/ref/databases/#connection-management). Two modes:
+# * Persistent connections (default): each thread keeps its connection for DB_CONN_MAX_AGE seconds. Suits
+#   WSGI servers, whose threads serve request after request
+# * Pool (DB_POOL=True, needs psycopg 3: `pip install .[pool]`): each process keeps a psycopg_pool of
+#   DB_POOL_MIN_SIZE to DB_POOL_MAX_SIZE connections, lent to each request. Use it under ASGI: the sync code of
+#   each request runs in a new thread, so a persistent connection is never reused (and stays open until the
+#   thread is garbage collected)
+# NOTE: the limits are per process: workers * (DB_POOL_MAX_SIZE or threads per worker) * (1 + replicas) must stay
+# below PostgreSQL's max_connections. A request waits up to DB_POOL_TIMEOUT seconds for a connection of a
+# full pool (and fails with an error then)
+# Benchmark: python manage.py benchmark connections
+DB_POOL = config("DB_POOL", default=False, cast=bool)
+if DB_POOL:
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": config("DB_POOL_MIN_SIZE", default=2, cast=int),
+            "max_size": config("DB_POOL_MAX_SIZE", default=10, cast=int),
+            "timeout": config("DB_POOL_TIMEOUT", default=10, cast=float),
+            # Idle connections above min_size are closed after these seconds
+            "max_idle": config("DB_POOL_MAX_IDLE", default=300, cast=float),
+        }
+    }
+else:
+    DATABASES["default"]["CONN_MAX_AGE"] = config("DB_CONN_MAX_AGE", default=60, cast=int)
+# Persistent connections: checked before the first query of a request. Pool: checked when lent to a request
+# (ConnectionPool.check_connection). Broken connections are replaced
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
+# Read replicas (see blog/routers.py), e.g. DB_REPLICA_HOSTS=replica1.example.com,replica2.example.com
+# They use the name, user and password of the primary
+# NOTE: run the tests without replicas (they'd be test mirrors of default, on connections that don't see the data
+# of the test transactions)
+DB_REPLICA_HOSTS = config("DB_REPLICA_HOSTS", default="", cast=Csv())
+for number, host in enumerate(DB_REPLICA_HOSTS, start=1):
+    DATABASES[f"replica{number}"] = {**DATABASES["default"], "HOST": host, "TEST": {"MIRROR": "default"}}
+
+DATABASE_ROUTERS = ["blog.routers.ReplicaRouter"]
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# NOTE: besides cached values, the cache holds state that must not be lost, set with timeout=None: the
+# generations of the sidebar and of the admin facets, the last modification of the page groups (ETags), the feed
+# snapshots, the queued comments (BLOG_BUFFERED_COMMENTS) and the request timings. Two backends:
+# * Redis (CACHE_REDIS_URL=redis://localhost:6379/0, needs `pip install .[redis]`): shared by every process
+#   (server workers and management commands). Configure Redis with `maxmemory-policy volatile-lru` (or
+#   noeviction), so that it never evicts the keys without an expiry
+# * Local memory (default): per process, only for a single process (e.g. runserver): invalidations and queued
+#   comments don't reach the other processes. When it holds CACHE_MAX_ENTRIES keys it evicts the least recently
+#   used 1/CACHE_CULL_FREQUENCY of them, whatever their timeout: keep it far above the number of cached pages
+#   (the defaults of Django, 300 keys and a third of them, would drop versions and queued comments)
+# `./manage.py check --deploy` warns about the local memory cache (see blog/checks.py)
+CACHE_REDIS_URL = config("CACHE_REDIS_URL", default="")
+if CACHE_REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {
+                "MAX_ENTRIES": config("CACHE_MAX_ENTRIES", default=50000, cast=int),
+                "CULL_FREQUENCY": config("CACHE_CULL_FREQUENCY", default=10, cast=int),
+            },
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -142,6 +217,68 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # TODO: AUTH_USER_MODEL ???
 
 
+# BLOG SETTINGS
+# Minimum pg_trgm similarity (0-1) for a title to match a trigram search
+BLOG_TRIGRAM_SIMILARITY_THRESHOLD = config("BLOG_TRIGRAM_SIMILARITY_THRESHOLD", default=0.1, cast=float)
+# Number of closest titles returned by a trigram search
+BLOG_TRIGRAM_RESULTS = config("BLOG_TRIGRAM_RESULTS", default=10, cast=int)
+# Maximum number of full-text search results (top ranked) and results per page
+BLOG_SEARCH_RESULTS_LIMIT = config("BLOG_SEARCH_RESULTS_LIMIT", default=100, cast=int)
+BLOG_SEARCH_RESULTS_PER_PAGE = config("BLOG_SEARCH_RESULTS_PER_PAGE", default=10, cast=int)
+# Number of posts per page in post lists
+BLOG_POSTS_PER_PAGE = config("BLOG_POSTS_PER_PAGE", default=3, cast=int)
+# Paginate post lists with (publish, id) cursors instead of page numbers (no COUNT(*), no OFFSET)
+BLOG_KEYSET_PAGINATION = config("BLOG_KEYSET_PAGINATION", default=False, cast=bool)
+# Seconds to cache the sidebar of blog/base.html (total posts, latest and most commented posts). 0 disables it
+BLOG_SIDEBAR_CACHE_TIMEOUT = config("BLOG_SIDEBAR_CACHE_TIMEOUT", default=60 * 15, cast=int)
+# Seconds to keep public pages (post lists, tag pages, feed, sitemap) in the cache. 0 disables it
+# NOTE: pages are invalidated when the posts/comments they show (or their sidebar) change
+BLOG_PAGE_CACHE_TIMEOUT = config("BLOG_PAGE_CACHE_TIMEOUT", default=60 * 5, cast=int)
+# Number of posts in the feeds (latest posts and latest posts of each tag)
+BLOG_FEED_ITEMS = config("BLOG_FEED_ITEMS", default=5, cast=int)
+# Scheme of the links in the feeds: they are rendered ahead of time, not for a request (see blog/feeds.py)
+BLOG_FEED_SCHEME = config("BLOG_FEED_SCHEME", default="http")
+# Seconds to keep a feed snapshot: rebuilt when its posts change, so this only bounds how long the snapshots
+# of feeds nobody polls anymore stay in the cache
+BLOG_FEED_SNAPSHOT_TIMEOUT = config("BLOG_FEED_SNAPSHOT_TIMEOUT", default=60 * 60 * 24, cast=int)
+# Number of post URLs per sitemap shard (the sitemap protocol allows up to 50000)
+BLOG_SITEMAP_SHARD_SIZE = config("BLOG_SITEMAP_SHARD_SIZE", default=50000, cast=int)
+# Number of similar posts (sharing the most tags) precomputed for each post and shown in post_detail
+BLOG_SIMILAR_POSTS = config("BLOG_SIMILAR_POSTS", default=4, cast=int)
+# Seconds to cache the HTML rendered from the Markdown of a post (keys change when the post is updated)
+BLOG_POST_HTML_CACHE_TIMEOUT = config("BLOG_POST_HTML_CACHE_TIMEOUT", default=60 * 60 * 24, cast=int)
+# Fraction of the requests measured by RequestTimingMiddleware (Server-Timing header and ./manage.py timings)
+BLOG_TIMING_SAMPLE_RATE = config("BLOG_TIMING_SAMPLE_RATE", default=0.1, cast=float)
+# Seconds of the windows in which the measured requests of each view are counted: the p50/p95 summary covers the
+# current and the previous window
+BLOG_TIMING_WINDOW = config("BLOG_TIMING_WINDOW", default=60 * 60, cast=int)
+# Serve post lists, posts, search, feed and sitemap with the async views of blog/async_views.py (run under ASGI)
+BLOG_ASYNC_VIEWS = config("BLOG_ASYNC_VIEWS", default=False, cast=bool)
+# Outbox (./manage.py sendemails): attempts before giving up on an email, seconds before the first retry
+# (doubled after each failed attempt) and seconds an email is reserved by the worker sending it
+BLOG_EMAIL_MAX_ATTEMPTS = config("BLOG_EMAIL_MAX_ATTEMPTS", default=5, cast=int)
+BLOG_EMAIL_RETRY_DELAY = config("BLOG_EMAIL_RETRY_DELAY", default=60, cast=int)
+BLOG_EMAIL_LEASE = config("BLOG_EMAIL_LEASE", default=60 * 5, cast=int)
+# Queue comments in the cache and save them in batches with ./manage.py flushcomments (see blog/comments.py)
+# NOTE: needs a cache shared by all the processes (not LocMemCache)
+BLOG_BUFFERED_COMMENTS = config("BLOG_BUFFERED_COMMENTS", default=False, cast=bool)
+# Comments a client (IP) can send to a post every BLOG_COMMENT_RATE_WINDOW seconds. 0 disables the limit
+BLOG_COMMENT_RATE_LIMIT = config("BLOG_COMMENT_RATE_LIMIT", default=5, cast=int)
+BLOG_COMMENT_RATE_WINDOW = config("BLOG_COMMENT_RATE_WINDOW", default=60, cast=int)
+# Seconds during which the same comment (same post, author and text) submitted again is ignored
+BLOG_COMMENT_DUPLICATE_TIMEOUT = config("BLOG_COMMENT_DUPLICATE_TIMEOUT", default=60 * 60, cast=int)
+# Database aliases of the read replicas used by public pages (see blog/routers.py)
+BLOG_READ_REPLICAS = [f"replica{number}" for number in range(1, len(DB_REPLICA_HOSTS) + 1)]
+# Seconds a replica can be behind the primary and still be used
+BLOG_REPLICA_MAX_LAG = config("BLOG_REPLICA_MAX_LAG", default=5, cast=float)
+# Seconds between checks of the lag of each replica (per process)
+BLOG_REPLICA_CHECK_INTERVAL = config("BLOG_REPLICA_CHECK_INTERVAL", default=2, cast=float)
+# Seconds the facet counts of the admin changelists are cached (0: not cached), see blog/admin.py
+BLOG_ADMIN_FACETS_CACHE_TIMEOUT = config("BLOG_ADMIN_FACETS_CACHE_TIMEOUT", default=60 * 5, cast=int)
+# Admin changelists of big tables count their rows exactly only if the planner estimates fewer rows than this
+BLOG_ADMIN_EXACT_COUNT_LIMIT = config("BLOG_ADMIN_EXACT_COUNT_LIMIT", default=10000, cast=int)
+
+
 if DEBUG:
     EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 # EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
@@ -182,6 +319,12 @@ LOGGING = {
         },
     },
     "loggers": {
-        "django.db.backends": {"handlers": ["console"], "level": LOGGING_LEVEL, "propagate": False},
+        # NOTE: every SQL statement is logged at DEBUG level (and only with DEBUG=True). Formatting and writing each
+        # one is slow and noisy, RequestTimingMiddleware gives the number and time of queries per request instead
+        "django.db.backends": {
+            "handlers": ["console"],
+            "level": config("DB_LOG_LEVEL", default="WARNING"),
+            "propagate": False,
+        },
     },
 }
@@ -15,17 +15,22 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+from django.conf import settings
 from django.contrib import admin
-from django.contrib.sitemaps.views import sitemap
 from django.urls import include, path
 
-from blog.sitemaps import PostSitemap
+from blog import async_views, sitemaps
+from blog.admin import request_timings
 
-sitemaps = {"posts": PostSitemap}
+# Sync or async sitemap views, like the views of blog/urls.py
+sitemap_views = async_views if settings.BLOG_ASYNC_VIEWS else sitemaps
 
 urlpatterns = [
+    # Before the admin URLs, which would take it for an app label
+    path("admin/timings/", request_timings, name="request_timings"),
     path("admin/", admin.site.urls),
     path("blog/", include("blog.urls", namespace="blog")),
-    path("sitemap.xml", sitemap, {"sitemaps": sitemaps}, name="django.contrib.sitemapts.views.sitemap"),
-    # sitemap(request, {"sitemaps": sitemaps})
+    # Sitemap index pointing to the shards with the URLs of the posts (see blog/sitemaps.py)
+    path("sitemap.xml", sitemap_views.sitemap_index, name="sitemap"),
+    path("sitemap-posts-<int:shard>.xml", sitemap_views.sitemap_shard, name="sitemap_shard"),
 ]
@@ -3,6 +3,9 @@ WSGI config for mysite project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+Database connections: persistent per server thread by default (DB_CONN_MAX_AGE in
+settings.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 """